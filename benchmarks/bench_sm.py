@@ -0,0 +1,183 @@
+"""
+Timing benchmarks for C{libdw.sm}.  Run from the top of the source
+tree with::
+
+    python benchmarks/bench_sm.py
+
+Each benchmark prints the best of several runs, in seconds.
+"""
+import os
+import random
+import sys
+import time
+from libdw import sm, lti, fsm
+
+def bestTime(f, repeat = 3):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        f()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def stepLoop(m, inps):
+    """
+    The way C{transduce} used to run a machine: C{isDone} and C{step}
+    (with its debugging check) on every step
+    """
+    m.start()
+    result = []
+    i = 0
+    n = len(inps)
+    while i < n and not m.isDone():
+        result.append(m.step(inps[i]))
+        i = i + 1
+    return result
+
+def deepCascade(depth):
+    m = sm.Cascade(sm.Gain(0.5), sm.R(0))
+    for i in range(depth - 1):
+        m = sm.Cascade(m, sm.Cascade(sm.PureFunction(abs), sm.R(0)))
+    return m
+
+def controller():
+    return sm.FeedbackSubtract(sm.Cascade(sm.Gain(0.9),
+                                          sm.PureFunction(lambda x: x)),
+                               sm.Cascade(sm.R(0), sm.Gain(0.1)))
+
+def terminating():
+    return sm.Sequence([sm.Until(lambda x: x > 1e9, sm.R(0)),
+                        sm.Cascade(sm.Gain(2), sm.R(0))])
+
+def report(name, t):
+    print '  %-40s %8.3f' % (name, t)
+
+def benchFastPath(n = 100000):
+    print 'Fast execution path (%d steps)' % n
+    inps = [0.5] * n
+    for (name, m) in (('30-deep cascade', deepCascade(30)),
+                      ('feedback controller', controller()),
+                      ('terminating sequence', terminating())):
+        slow = bestTime(lambda: stepLoop(m, inps))
+        fast = bestTime(lambda: m.transduce(inps))
+        report(name + ', step loop', slow)
+        report(name + ', transduce', fast)
+        print '  %-40s %8.2fx' % ('speedup', slow / fast)
+
+def allMachines(m):
+    result = [m]
+    for sub in m.subMachines():
+        result.extend(allMachines(sub))
+    return result
+
+def benchTraceDispatch(n = 5000, depth = 30):
+    machines = allMachines(deepCascade(depth))
+    for (i, m) in enumerate(machines):
+        m.name = 'm%d' % i
+    top = machines[0]
+    inps = [0.5] * n
+    ignore = lambda x: None
+    print 'Trace task dispatch (%d-machine cascade, %d steps)' % \
+          (len(machines), n)
+    report('no trace tasks', bestTime(lambda: top.transduce(inps)))
+    # One traced machine, and more and more tasks for machines that
+    # are not in this one
+    for tasks in (1, 16, 64):
+        traceTasks = [('m1', 'output', ignore)] + \
+                     [('other%d' % i, 'output', ignore) \
+                      for i in range(tasks - 1)]
+        report('1 traced machine, %d tasks' % tasks,
+               bestTime(lambda: top.transduce(inps, traceTasks = traceTasks)))
+    # More and more traced machines, one task each
+    for traced in (4, 16, 64):
+        traceTasks = [(m.name, 'output', ignore) \
+                      for m in machines[-traced:]]
+        report('%d traced machines, %d tasks' % (traced, traced),
+               bestTime(lambda: top.transduce(inps, traceTasks = traceTasks)))
+
+class ModCounter(sm.SM):
+    """
+    Counts 1 inputs modulo C{n};  outputs 1 when the count wraps around
+    """
+    legalInputs = [0, 1]
+    def __init__(self, n):
+        self.n = n
+        self.startState = 0
+    def getNextValues(self, state, inp):
+        state = (state + inp) % self.n
+        return (state, int(state == 0 and inp == 1))
+
+def benchTabulate(n = 100000, depth = 4):
+    m = ModCounter(5)
+    for i in range(depth - 1):
+        m = sm.Cascade(m, ModCounter(5))
+    table = fsm.tabulate(m)
+    inps = [random.choice([0, 1]) for i in range(n)]
+    print 'Transition tables (%d counters in cascade, %d states, %d steps)' \
+          % (depth, len(table.states), n)
+    report('tabulate', bestTime(lambda: fsm.tabulate(m)))
+    slow = bestTime(lambda: m.transduce(inps))
+    fast = bestTime(lambda: table.transduce(inps))
+    report('transduce, interpreted', slow)
+    report('transduce, tabulated', fast)
+    print '  %-40s %8.2fx' % ('speedup', slow / fast)
+
+def pipelineStages(depth):
+    return [sm.Cascade(sm.PureFunction(abs), sm.R(0)) for i in range(depth)]
+
+def benchFlatCascade(n = 20000, depth = 30):
+    print 'Nested Cascade and CascadeN (%d stages, %d steps)' % (depth, n)
+    inps = [0.5] * n
+    stages = pipelineStages(depth)
+    nested = stages[-1]
+    for m in reversed(stages[:-1]):
+        nested = sm.Cascade(m, nested)
+    flat = sm.CascadeN(stages)
+    report('transduce, nested Cascade',
+           bestTime(lambda: nested.transduce(inps)))
+    report('transduce, CascadeN', bestTime(lambda: flat.transduce(inps)))
+    report('verbose transduce, nested Cascade',
+           bestTime(lambda: quietly(nested.transduce, inps[:2000])))
+    report('verbose transduce, CascadeN',
+           bestTime(lambda: quietly(flat.transduce, inps[:2000])))
+
+def benchInPlace(n = 20000, depth = 20):
+    print 'In-place state records (%d-stage loop, %d steps)' % (depth, n)
+    m = sm.FeedbackSubtract(sm.CascadeN([sm.Cascade(sm.Gain(0.5), sm.R(0)) \
+                                         for i in range(depth)]),
+                            sm.Gain(0.1))
+    inps = [0.5] * n
+    for inPlace in (False, True):
+        report('transduce, inPlace = %s' % inPlace,
+               bestTime(lambda: m.transduce(inps, inPlace = inPlace)))
+    for inPlace in (False, True):
+        report('step loop, inPlace = %s' % inPlace,
+               bestTime(lambda: stepEach(m, inps, inPlace)))
+
+def stepEach(m, inps, inPlace):
+    m.start(inPlace = inPlace)
+    for inp in inps:
+        m.step(inp)
+
+def quietly(f, inps):
+    """
+    Run C{f(inps, verbose = True)} without printing anything
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return f(inps, verbose = True)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+if __name__ == '__main__':
+    # Measure the interpreter, not the vectorized LTI engine
+    lti.useEngine = False
+    benchFastPath()
+    benchTraceDispatch()
+    benchTabulate()
+    benchFlatCascade()
+    benchInPlace()
@@ -0,0 +1,254 @@
+
+"""
+Compiling finite state machines into transition tables.  A
+deterministic machine with a finite list of C{legalInputs} that can
+only reach finitely many states is explored once, from its start
+state, with every legal input;  the states it reaches are numbered,
+and its steps are stored in tables indexed by state number and input
+number.  Stepping the resulting C{TabulatedSM} is then a dictionary
+lookup for the input and two array lookups, however complicated the
+original machine was.
+
+Typical use::
+
+    fast = fsm.tabulate(m)
+    fast.transduce(inputs)
+"""
+import array
+import sm
+
+maxStates = 10000
+"""Default limit on the number of states that C{tabulate} explores"""
+
+class TabulatedSM(sm.SM):
+    """
+    Machine that steps by looking up tables made by C{tabulate}.  Its
+    states are the numbers of the states of the original machine,
+    starting with 0 for the start state;  C{originalState} converts
+    back.  Its outputs are the outputs of the original machine.  If
+    the original machine declares a delay (C{dependsOnInput} is
+    C{False}), its delayed output in each state is tabulated too, so
+    that the tabulated machine can be used in feedback loops.
+    """
+    startState = 0
+
+    def __init__(self, machine, states, nextTable, outputTable, outputs,
+                 doneTable, delayedTable = None):
+        """
+        @param machine: the original machine
+        @param states: list of the reachable states of C{machine};
+              state C{i} of this machine is C{states[i]}
+        @param nextTable: array with the number of the next state for
+              state C{i} and input C{j} at C{i * len(legalInputs) + j}
+        @param outputTable: array of the numbers of the outputs, in the
+              same order
+        @param outputs: list of the distinct outputs
+        @param doneTable: list of C{machine.done} of each state
+        @param delayedTable: list of the numbers of the delayed outputs
+              of each state, or C{None} if they are not known
+        """
+        self.machine = machine
+        self.states = states
+        self.nextTable = nextTable
+        self.outputTable = outputTable
+        self.outputs = outputs
+        self.doneTable = doneTable
+        self.delayedTable = delayedTable
+        self.name = machine.name
+        self.guaranteeName()
+        self.legalInputs = machine.legalInputs
+        if delayedTable is not None:
+            self.dependsOnInput = False
+        elif machine.dependsOnInput:
+            self.dependsOnInput = True
+        self.width = len(self.legalInputs)
+        # Keyed on the type too, as in internValue
+        try:
+            self.inputIndex = dict([((type(inp), inp), j) for (j, inp) \
+                                    in enumerate(self.legalInputs)])
+        except TypeError:
+            raise CannotTabulate, 'Unhashable legal input'
+
+    def getNextValues(self, state, inp):
+        try:
+            j = self.inputIndex.get((type(inp), inp))
+        except TypeError:
+            j = None
+        if j is None:
+            raise Exception, 'Input ' + str(inp) + \
+                  ' is not in the legal inputs of ' + str(self.name)
+        k = state * self.width + j
+        return (self.nextTable[k], self.outputs[self.outputTable[k]])
+
+    def getDelayedOutput(self, state):
+        if self.delayedTable is None:
+            return sm.SM.getDelayedOutput(self, state)
+        return self.outputs[self.delayedTable[state]]
+
+    def done(self, state):
+        return self.doneTable[state]
+
+    def canTerminate(self):
+        return True in self.doneTable
+
+    def originalState(self, state):
+        """
+        @return: the state of the original machine numbered C{state}
+        """
+        return self.states[state]
+
+    def tableBytes(self):
+        """
+        Memory taken up by the transition and output tables, in bytes
+        """
+        return len(self.nextTable) * self.nextTable.itemsize + \
+               len(self.outputTable) * self.outputTable.itemsize
+
+def tabulate(machine, limit = None):
+    """
+    Explore the states that C{machine} can reach from its start state
+    on its legal inputs, and make a C{TabulatedSM} that behaves the
+    same way.  The machine must be deterministic:  its start state and
+    steps must not depend on anything but its state and input.
+    @param machine: C{SM} with a finite list of C{legalInputs}
+    @param limit: largest number of states to explore;  defaults to
+          C{maxStates}
+    @return: C{TabulatedSM}, or C{machine} itself if it has no legal
+          inputs, its inputs, states or outputs can't be used as
+          dictionary keys, or it has more than C{limit} reachable states
+    """
+    if limit is None:
+        limit = maxStates
+    inputs = machine.legalInputs
+    if not inputs:
+        return machine
+    try:
+        return explore(machine, inputs, limit)
+    except CannotTabulate:
+        return machine
+
+class CannotTabulate(Exception):
+    pass
+
+def internValue(v, index, values):
+    """
+    Internal use only.  Number of C{v} in the list C{values}, adding it
+    if it isn't there yet;  C{index} maps values to their numbers.
+    Keyed on the type too, so that values like 1 and C{True} aren't
+    taken for each other.
+    """
+    key = (type(v), v)
+    try:
+        n = index.get(key)
+    except TypeError:
+        raise CannotTabulate, 'Unhashable value ' + str(v)
+    if n is None:
+        n = index[key] = len(values)
+        values.append(v)
+    return n
+
+def explore(machine, inputs, limit):
+    """
+    Internal use only.  Breadth-first search of the reachable states,
+    numbering each state and output the first time it is seen.
+    """
+    states = []
+    stateIndex = {}
+    internValue(machine.getStartState(), stateIndex, states)
+    outputs = []
+    outputIndex = {}
+    nextTable = array.array('l')
+    outputTable = array.array('l')
+    i = 0
+    # States are numbered in the order they are found, so the rows of
+    # the tables are filled in that order too
+    while i < len(states):
+        s = states[i]
+        for inp in inputs:
+            (nextState, o) = machine.getNextValues(s, inp)
+            nextTable.append(internValue(nextState, stateIndex, states))
+            outputTable.append(internValue(o, outputIndex, outputs))
+            if len(states) > limit:
+                raise CannotTabulate, 'More than ' + str(limit) + ' states'
+        i = i + 1
+    doneTable = [bool(machine.done(s)) for s in states]
+    delayedTable = None
+    if machine.dependsOnInput is False:
+        delayedTable = [internValue(machine.getDelayedOutput(s),
+                                    outputIndex, outputs) for s in states]
+    return TabulatedSM(machine, states, nextTable, outputTable, outputs,
+                       doneTable, delayedTable)
+
+def minimize(table, verbose = False):
+    """
+    Merge the states of a tabulated machine that can't be told apart:
+    states that give the same outputs for every sequence of inputs, or
+    in which the machine is done.  Starts by grouping the states by
+    their row of outputs, then splits groups whose states go to
+    different groups on some input, until no group splits (Moore's
+    algorithm).
+    @param table: C{TabulatedSM}
+    @param verbose: if C{True}, print the reduction in the number of
+          states and the size of the tables
+    @return: C{TabulatedSM} with a state for each group;  the original
+          state of a group is that of its first state
+    """
+    n = len(table.states)
+    w = table.width
+    nextTable = table.nextTable
+    outputTable = table.outputTable
+    # Done states are never stepped, so they are all equivalent
+    groups = {}
+    group = [0] * n
+    for i in range(n):
+        if table.doneTable[i]:
+            key = None
+        else:
+            key = tuple(outputTable[i * w:(i + 1) * w])
+        group[i] = groups.setdefault(key, len(groups))
+    count = len(groups)
+    # Groups are numbered in the order of their first state, so the
+    # start state stays number 0
+    while True:
+        groups = {}
+        newGroup = [0] * n
+        for i in range(n):
+            if table.doneTable[i]:
+                key = (group[i],)
+            else:
+                key = (group[i],) + \
+                      tuple([group[t] for t in nextTable[i * w:(i + 1) * w]])
+            newGroup[i] = groups.setdefault(key, len(groups))
+        group = newGroup
+        if len(groups) == count:
+            break
+        count = len(groups)
+    first = [None] * count
+    for i in range(n):
+        if first[group[i]] is None:
+            first[group[i]] = i
+    newNext = array.array('l')
+    newOutput = array.array('l')
+    for i in first:
+        for j in range(w):
+            newNext.append(group[nextTable[i * w + j]])
+            newOutput.append(outputTable[i * w + j])
+    if table.delayedTable is None:
+        delayedTable = None
+    else:
+        delayedTable = [table.delayedTable[i] for i in first]
+    result = TabulatedSM(table.machine, [table.states[i] for i in first],
+                         newNext, newOutput, table.outputs,
+                         [table.doneTable[i] for i in first], delayedTable)
+    if verbose:
+        print describeReduction(table, result)
+    return result
+
+def describeReduction(before, after):
+    """
+    @return: string describing how much smaller C{after} is than
+          C{before}, both C{TabulatedSM}
+    """
+    return '%d states -> %d states, %d bytes of tables -> %d bytes' % \
+           (len(before.states), len(after.states), before.tableBytes(),
+            after.tableBytes())
@@ -0,0 +1,348 @@
+
+"""
+Analysis and fast simulation of linear time-invariant (LTI) state
+machines:  those built out of C{Gain}, C{Wire}, C{R} (or C{Delay}),
+C{Cascade}, C{ParallelAdd}, C{FeedbackAdd} and C{FeedbackSubtract}
+(and the n-ary C{CascadeN} and C{ParallelAddN}), with numeric gains
+and initial values.
+
+Such a machine is described by the difference equations::
+
+    x[n+1] = A x[n] + B u[n]
+    y[n]   = C x[n] + D u[n]
+
+where C{u} is the input, C{y} the output and the state vector C{x}
+holds the state of each C{R} in the machine.  C{analyze} extracts the
+coefficients C{A}, C{B}, C{C} and C{D} from the composition tree, and
+C{simulate} runs a whole array of inputs through the equations with
+NumPy.  If C{inTransduce} is set, C{sm.SM.transduce} also uses this
+engine for long lists of floating point inputs, when NumPy is
+installed.  It is off by default, since the engine adds up the terms
+in a different order than stepping the machine does:  its outputs can
+differ in the last few bits, and its states are always floats.
+"""
+import sm
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+useEngine = True
+"""Set to C{False} to stop C{transduce} and C{advance} from using the
+engine"""
+
+inTransduce = False
+"""
+Set to C{True} to let C{sm.SM.transduce} use the engine.  Its results
+are then not bit-for-bit the same as those of stepping the machine.
+"""
+
+minLength = 1000
+"""
+Shortest input for which C{transduce} uses the engine;  below this,
+stepping the machine is about as fast.
+"""
+
+blockSize = 128
+"""Number of steps computed together by C{simulate}"""
+
+class StateSpace:
+    """
+    Coefficients of the difference equations of an LTI machine.  The
+    state vector has C{p} entries;  C{A} is a list of C{p} rows of
+    length C{p}, C{B} and C{C} are lists of length C{p}, and C{D} is a
+    number.  C{x0} is the start state vector.
+    """
+    def __init__(self, A, B, C, D, x0):
+        self.A = A
+        self.B = B
+        self.C = C
+        self.D = D
+        self.x0 = x0
+        self.p = len(x0)
+
+    def __repr__(self):
+        return 'StateSpace(A=%s, B=%s, C=%s, D=%s, x0=%s)' % \
+               (self.A, self.B, self.C, self.D, self.x0)
+
+def gain(k):
+    return StateSpace([], [], [], k, [])
+
+def delay(v0):
+    return StateSpace([[0]], [1], [1], 0, [v0])
+
+def blockDiagonal(A1, A2):
+    p1 = len(A1)
+    p2 = len(A2)
+    return [row + [0] * p2 for row in A1] + [[0] * p1 + row for row in A2]
+
+def cascade(ss1, ss2):
+    """
+    Output of C{ss1} is the input of C{ss2}
+    """
+    A = [row + [0] * ss2.p for row in ss1.A] + \
+        [[b * c for c in ss1.C] + row for (b, row) in zip(ss2.B, ss2.A)]
+    B = ss1.B + [b * ss1.D for b in ss2.B]
+    C = [ss2.D * c for c in ss1.C] + ss2.C
+    return StateSpace(A, B, C, ss2.D * ss1.D, ss1.x0 + ss2.x0)
+
+def parallelAdd(ss1, ss2):
+    """
+    Both get the same input;  the output is the sum of their outputs
+    """
+    return StateSpace(blockDiagonal(ss1.A, ss2.A), ss1.B + ss2.B,
+                      ss1.C + ss2.C, ss1.D + ss2.D, ss1.x0 + ss2.x0)
+
+def feedback(ss1, ss2, sign):
+    """
+    Output of C{ss1} is fed back through C{ss2};  the result is
+    multiplied by C{sign} and added to the input of C{ss1}.  Returns
+    C{None} if neither machine has a delay.
+    """
+    if ss1.D * ss2.D != 0:
+        return None
+    # Because ss1.D * ss2.D is 0, the output does not depend on itself:
+    #   y  = C1 x1 + sign D1 C2 x2 + D1 u
+    #   u1 = u + sign (C2 x2 + D2 y)
+    Cy = ss1.C + [sign * ss1.D * c for c in ss2.C]
+    Cu1 = [sign * ss2.D * c for c in Cy]
+    for (k, c) in enumerate(ss2.C):
+        Cu1[ss1.p + k] += sign * c
+    A = blockDiagonal(ss1.A, ss2.A)
+    for (i, b) in enumerate(ss1.B):
+        A[i] = [a + b * c for (a, c) in zip(A[i], Cu1)]
+    for (j, b) in enumerate(ss2.B):
+        A[ss1.p + j] = [a + b * c for (a, c) in zip(A[ss1.p + j], Cy)]
+    B = ss1.B + [b * ss1.D for b in ss2.B]
+    return StateSpace(A, B, Cy, ss1.D, ss1.x0 + ss2.x0)
+
+def analyze(m):
+    """
+    Find the difference equations of an LTI machine.
+    @param m: C{SM}
+    @return: C{StateSpace} for C{m}, or C{None} if C{m} is not an LTI
+          machine that we can analyze
+    """
+    c = m.__class__
+    if c is sm.Gain:
+        if sm.isNumber(m.k):
+            return gain(m.k)
+    elif c is sm.Wire:
+        return gain(1)
+    elif c is sm.R:
+        if sm.isNumber(m.startState):
+            return delay(m.startState)
+    elif c in (sm.Cascade, sm.ParallelAdd, sm.FeedbackAdd,
+               sm.FeedbackSubtract):
+        ss1 = analyze(m.m1)
+        ss2 = analyze(m.m2)
+        if ss1 is None or ss2 is None:
+            return None
+        if c is sm.Cascade:
+            return cascade(ss1, ss2)
+        elif c is sm.ParallelAdd:
+            return parallelAdd(ss1, ss2)
+        elif c is sm.FeedbackAdd:
+            return feedback(ss1, ss2, 1)
+        else:
+            return feedback(ss1, ss2, -1)
+    elif c in (sm.CascadeN, sm.ParallelAddN):
+        parts = [analyze(part) for part in m.smList]
+        if None in parts:
+            return None
+        if c is sm.CascadeN:
+            combine = cascade
+        else:
+            combine = parallelAdd
+        return reduce(combine, parts)
+    return None
+
+def nestedState(m, x):
+    """
+    Convert a state vector of the LTI machine C{m} into the (nested)
+    state that C{m.getNextValues} works with.
+    @param x: list with one entry for each C{R} in C{m}, in order
+    """
+    x = list(x)
+    x.reverse()
+    return unflatten(m, x)
+
+def unflatten(m, x):
+    """
+    Internal use only.  Like C{nestedState}, but consumes the entries
+    from the end of the reversed list C{x}.
+    """
+    c = m.__class__
+    if c is sm.R:
+        return x.pop()
+    elif c in (sm.Gain, sm.Wire):
+        return m.getStartState()
+    elif c in (sm.CascadeN, sm.ParallelAddN):
+        return tuple([unflatten(part, x) for part in m.smList])
+    else:
+        s1 = unflatten(m.m1, x)
+        s2 = unflatten(m.m2, x)
+        return (s1, s2)
+
+def flatState(m, state):
+    """
+    Convert the (nested) state of the LTI machine C{m} into a state
+    vector;  the inverse of C{nestedState}.
+    @return: list of numbers, or C{None} if the state of some C{R} is
+          not a number
+    """
+    x = []
+    if not collectState(m, state, x):
+        return None
+    return x
+
+def collectState(m, state, x):
+    """
+    Internal use only.  Append the entries of the state vector to
+    C{x}, returning C{False} if one is not a number.
+    """
+    c = m.__class__
+    if c is sm.R:
+        x.append(state)
+        return sm.isNumber(state)
+    elif c in (sm.Gain, sm.Wire):
+        return True
+    elif c in (sm.CascadeN, sm.ParallelAddN):
+        for (part, s) in zip(m.smList, state):
+            if not collectState(part, s, x):
+                return False
+        return True
+    else:
+        (s1, s2) = state
+        return collectState(m.m1, s1, x) and collectState(m.m2, s2, x)
+
+def isInteger(v):
+    return isinstance(v, (int, long))
+
+def allIntegers(ss, x, u):
+    """
+    Internal use only.  Whether the coefficients C{ss}, the state
+    vector C{x} and the input C{u} are all integers.
+    """
+    return isInteger(u) and isInteger(ss.D) and \
+           all([isInteger(v) for v in ss.B + ss.C + x]) and \
+           all([isInteger(a) for row in ss.A for a in row])
+
+def advance(m, state, n, u):
+    """
+    Used by C{sm.SM.advance}.  Compute C{n} steps of the LTI machine
+    C{m} from C{state} with constant input C{u}.  With the augmented
+    state C{[x, 1]}, a step is multiplication by the matrix::
+
+        [ A  B u ]
+        [ 0   1  ]
+
+    so C{n - 1} steps are its C{n - 1}'th power, computed by repeated
+    squaring;  the last step is done separately to get its output.
+    The engine works in floating point, so it is not used when the
+    coefficients, the state and the input are all integers:  stepping
+    the machine keeps them integers.
+    @return: pair of the nested state after C{n} steps and the output
+          of the last step, or C{None} if the engine does not apply
+    """
+    if numpy is None or not useEngine or n < 1 or not sm.isNumber(u):
+        return None
+    ss = analyze(m)
+    if ss is None:
+        return None
+    x = flatState(m, state)
+    if x is None:
+        return None
+    if allIntegers(ss, x, u):
+        return None
+    if ss.p == 0:
+        return (state, ss.D * u)
+    p = ss.p
+    A = numpy.array(ss.A, dtype = float)
+    B = numpy.array(ss.B, dtype = float)
+    M = numpy.zeros((p + 1, p + 1))
+    M[:p, :p] = A
+    M[:p, p] = B * u
+    M[p, p] = 1.0
+    v = numpy.dot(numpy.linalg.matrix_power(M, n - 1), x + [1.0])
+    last = v[:p]
+    y = numpy.dot(ss.C, last) + ss.D * u
+    x = numpy.dot(A, last) + B * u
+    return (nestedState(m, x.tolist()), float(y))
+
+def simulate(ss, inps):
+    """
+    Run the difference equations on a whole array of inputs.  The
+    output is computed C{blockSize} steps at a time:  within a block,
+    it is the response to the state at the start of the block plus the
+    response to the inputs in the block, each of which is a single
+    matrix product.  Only the state at the start of each block is
+    computed one block after the other.
+    @param ss: C{StateSpace}
+    @param inps: 1-dimensional NumPy array of inputs
+    @return: pair of the array of outputs and the final state vector
+    """
+    n = len(inps)
+    if ss.p == 0 or n == 0:
+        return (ss.D * inps, list(ss.x0))
+    A = numpy.array(ss.A, dtype = float)
+    B = numpy.array(ss.B, dtype = float)
+    C = numpy.array(ss.C, dtype = float)
+    L = min(blockSize, n)
+    # powers[i] = A^i, for i = 0..L
+    powers = [numpy.eye(ss.p)]
+    for i in range(L):
+        powers.append(numpy.dot(A, powers[-1]))
+    # obs[i] = C A^i: effect of the state at the start of the block on
+    # output i of the block
+    obs = numpy.array([numpy.dot(C, powers[i]) for i in range(L)])
+    # Impulse response h[0] = D, h[k] = C A^(k-1) B;  toeplitz[i, j] is
+    # the effect of input j of a block on output i
+    h = numpy.zeros(L)
+    h[0] = ss.D
+    h[1:] = numpy.dot(obs[:-1], B)
+    index = numpy.arange(L)
+    lag = index[:, None] - index[None, :]
+    toeplitz = numpy.where(lag >= 0, h[numpy.maximum(lag, 0)], 0.0)
+    # ctrl[:, j] = A^(L-1-j) B: effect of input j on the next block's state
+    ctrl = numpy.array([numpy.dot(powers[L - 1 - j], B) \
+                        for j in range(L)]).T
+    blocks = (n + L - 1) // L
+    U = numpy.zeros(blocks * L)
+    U[:n] = inps
+    U = U.reshape(blocks, L)
+    drive = numpy.dot(U, ctrl.T)
+    S = numpy.empty((blocks, ss.p))
+    S[0] = numpy.array(ss.x0, dtype = float)
+    AL = powers[L]
+    for b in range(blocks - 1):
+        S[b + 1] = numpy.dot(AL, S[b]) + drive[b]
+    Y = numpy.dot(U, toeplitz.T) + numpy.dot(S, obs.T)
+    # State after the last real input, which may be part way through
+    # the last block
+    r = n - (blocks - 1) * L
+    last = U[-1, :r]
+    x = numpy.dot(powers[r], S[-1]) + numpy.dot(ctrl[:, L - r:], last)
+    return (Y.ravel()[:n], x.tolist())
+
+def transduce(m, inps):
+    """
+    Used by C{sm.SM.transduce}.  If C{inTransduce} is set, C{m} is an
+    LTI machine, NumPy is available, and C{inps} is a long enough
+    sequence of floating point numbers, run the machine with
+    C{simulate}, leaving it in its final state.
+    @return: list of outputs, or C{None} if the engine does not apply
+    """
+    if numpy is None or not (useEngine and inTransduce) or \
+           not hasattr(inps, '__len__') or len(inps) < minLength:
+        return None
+    u = numpy.asarray(inps)
+    if u.ndim != 1 or u.dtype.kind != 'f':
+        return None
+    ss = analyze(m)
+    if ss is None:
+        return None
+    (y, x) = simulate(ss, u)
+    m.start()
+    m.state = nestedState(m, x)
+    return y.tolist()
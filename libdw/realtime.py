@@ -0,0 +1,291 @@
+
+"""
+Running state machines in real time, at a fixed rate.  A
+C{RealtimeRunner} steps a machine once per period, on a schedule of
+absolute deadlines (the start time plus a whole number of periods), so
+that the time taken by the steps and the error in waking up don't add
+up into drift.  On each step it calls a source for the input and a
+sink with the output, and it keeps histograms of:
+  - jitter:  how late each step started, after its deadline
+  - latency:  how long each step took, from calling the source to
+    returning from the sink
+  - overrun:  for steps that finished after the next deadline, by how
+    much
+
+When steps fall behind the schedule, the C{policy} decides what
+happens:  C{'skip'} drops the deadlines that have already passed and
+waits for the next one, so the rate is kept but ticks are lost;
+C{'catchUp'} runs the late steps back to back, without waiting, until
+the run is back on schedule, so no tick is lost.
+
+Sources and sinks are plain callables, called from the thread that
+runs the machine.  A sensor that delivers its readings from another
+thread can put them in a C{Latest}, which is a source that returns the
+most recent reading.
+
+Typical use::
+
+    runner = realtime.RealtimeRunner(controller, 0.001, sensor.read,
+                                     motor.write)
+    runner.start()
+    ...
+    runner.stop()
+    print runner.report()
+"""
+import threading
+import time
+import sm
+
+clock = getattr(time, 'monotonic', time.time)
+"""
+Clock used for the schedule, in seconds:  C{time.monotonic} where
+there is one, so that setting the system clock doesn't move the
+deadlines, and C{time.time} otherwise
+"""
+
+class Histogram:
+    """
+    Counts of values in C{bins} bins of width C{binWidth}, starting at
+    0, with one more bin for values beyond the last.  Negative values
+    are counted in the first bin.
+    """
+    def __init__(self, binWidth, bins = 40):
+        self.binWidth = binWidth
+        self.counts = [0] * (bins + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, v):
+        i = min(max(int(v / self.binWidth), 0), len(self.counts) - 1)
+        self.counts[i] += 1
+        self.n += 1
+        self.total += v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    def mean(self):
+        if self.n == 0:
+            return None
+        return self.total / self.n
+
+    def percentile(self, p):
+        """
+        @param p: fraction between 0 and 1
+        @return: upper edge of the bin holding the value below which a
+              fraction C{p} of the values lie (C{None} if there are no
+              values, and the largest value if it is in the last bin)
+        """
+        if self.n == 0:
+            return None
+        seen = 0
+        for (i, c) in enumerate(self.counts):
+            seen += c
+            if seen >= p * self.n and c > 0:
+                if i == len(self.counts) - 1:
+                    return self.max
+                return (i + 1) * self.binWidth
+        return self.max
+
+    def rows(self, scale = 1000.0):
+        """
+        @param scale: multiplier for the bin edges;  by default, they
+              are shown in milliseconds
+        @return: list of lines of text, one for each non-empty bin
+        """
+        lines = []
+        last = len(self.counts) - 1
+        for (i, c) in enumerate(self.counts):
+            if c == 0:
+                continue
+            if i == last:
+                label = '>= %8.3f' % (i * self.binWidth * scale)
+            else:
+                label = '%8.3f - %8.3f' % (i * self.binWidth * scale,
+                                           (i + 1) * self.binWidth * scale)
+            lines.append('  %-22s %8d' % (label, c))
+        return lines
+
+class Latest:
+    """
+    Source that returns the most recent value put into it, from any
+    thread
+    """
+    def __init__(self, initial = None):
+        self.value = initial
+        self.lock = threading.Lock()
+
+    def put(self, v):
+        self.lock.acquire()
+        try:
+            self.value = v
+        finally:
+            self.lock.release()
+
+    def __call__(self):
+        self.lock.acquire()
+        try:
+            return self.value
+        finally:
+            self.lock.release()
+
+class RealtimeRunner:
+    """
+    Steps a machine once per C{period} seconds, in real time.  The
+    machine is stepped through its own C{sm.Run}, so the same machine
+    can be used by other runners at the same time.
+    """
+    policies = ('skip', 'catchUp')
+
+    def __init__(self, machine, period, source = None, sink = None,
+                 policy = 'skip', inPlace = False, binWidth = None,
+                 bins = 40):
+        """
+        @param machine: C{SM}
+        @param period: time between deadlines, in seconds
+        @param source: procedure with no arguments that returns the
+              input for a step;  if C{None}, the input is C{None}
+        @param sink: procedure of one argument, called with the output
+              of each step;  if C{None}, outputs are dropped
+        @param policy: C{'skip'} or C{'catchUp'}, for when steps fall
+              behind the schedule
+        @param inPlace: if C{True}, use the in-place mode of C{sm.Run}
+        @param binWidth: width of the bins of the histograms, in
+              seconds;  defaults to a twentieth of the period
+        @param bins: number of bins of the histograms, not counting the
+              last one for values beyond them
+        """
+        if policy not in self.policies:
+            raise Exception, 'Policy must be skip or catchUp'
+        if period <= 0:
+            raise Exception, 'Period must be positive'
+        self.machine = machine
+        self.period = period
+        self.source = source
+        self.sink = sink
+        self.policy = policy
+        self.inPlace = inPlace
+        if binWidth is None:
+            binWidth = period / 20.0
+        self.binWidth = binWidth
+        self.bins = bins
+        self.thread = None
+        self.stopping = False
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new run of the machine, and clear the statistics
+        """
+        self.run = sm.Run(self.machine, inPlace = self.inPlace)
+        self.jitter = Histogram(self.binWidth, self.bins)
+        self.latency = Histogram(self.binWidth, self.bins)
+        self.overrun = Histogram(self.binWidth, self.bins)
+        self.steps = 0
+        self.skipped = 0
+        """Number of deadlines dropped by the C{'skip'} policy"""
+
+    def runFor(self, n = None, duration = None):
+        """
+        Step the machine in the calling thread, until it is done, C{n}
+        steps have been taken, C{duration} seconds have passed on the
+        clock (late steps still to be caught up are then dropped), or
+        C{stop} is called.
+        @return: number of steps taken
+        """
+        self.stopping = False
+        return self.loop(n, duration)
+
+    def loop(self, n, duration):
+        """
+        Internal use only.  Does the work of C{runFor}.
+        """
+        run = self.run
+        source = self.source
+        sink = self.sink
+        period = self.period
+        start = clock()
+        deadline = start
+        if duration is None:
+            end = None
+        else:
+            end = start + duration
+        taken = 0
+        while not self.stopping and (n is None or taken < n):
+            if not run.neverDone and run.isDone():
+                break
+            # Don't sleep past the end of the run, and check for it
+            # after sleeping, so no step is taken after it
+            if end is None:
+                wait = deadline - clock()
+            else:
+                wait = min(deadline, end) - clock()
+            if wait > 0:
+                time.sleep(wait)
+            if end is not None and clock() >= end:
+                break
+            t0 = clock()
+            if source is None:
+                inp = None
+            else:
+                inp = source()
+            o = run.step(inp)
+            if sink is not None:
+                sink(o)
+            t1 = clock()
+            self.jitter.add(t0 - deadline)
+            self.latency.add(t1 - t0)
+            taken += 1
+            # Counted as it goes, for reports while the run goes on
+            self.steps += 1
+            deadline += period
+            if t1 > deadline:
+                self.overrun.add(t1 - deadline)
+                if self.policy == 'skip':
+                    missed = int((t1 - deadline) / period) + 1
+                    deadline += missed * period
+                    self.skipped += missed
+        return taken
+
+    def start(self, n = None, duration = None):
+        """
+        Like C{runFor}, but in a new (daemon) thread;  returns at once.
+        """
+        if self.thread is not None and self.thread.isAlive():
+            raise Exception, 'RealtimeRunner is already running'
+        # Set here too, so that a stop right after start is not lost
+        self.stopping = False
+        self.thread = threading.Thread(target = self.loop,
+                                       args = (n, duration))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """
+        Stop after the current step, and wait for the thread started by
+        C{start} to finish
+        """
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def report(self):
+        """
+        @return: text describing the steps taken and the histograms, in
+              milliseconds
+        """
+        lines = ['%d steps at %.3f ms, %d overruns, %d deadlines skipped' % \
+                 (self.steps, self.period * 1000, self.overrun.n,
+                  self.skipped)]
+        for (name, h) in (('jitter', self.jitter),
+                          ('latency', self.latency),
+                          ('overrun', self.overrun)):
+            if h.n == 0:
+                continue
+            lines.append('%s (ms):  mean %.3f, 99%% %.3f, max %.3f' % \
+                         (name, h.mean() * 1000, h.percentile(0.99) * 1000,
+                          h.max * 1000))
+            lines.extend(h.rows())
+        return '\n'.join(lines)
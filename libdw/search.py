@@ -0,0 +1,240 @@
+
+"""
+Searching for inputs that drive a state machine to a goal.  The
+machine is used as a planning model:  its C{legalInputs} are the
+actions, and C{getNextValues} gives the result of each action.
+C{breadthFirst} finds a path with the fewest steps, and
+C{uniformCost} and C{aStar} find a path with the least total cost,
+where the cost of a step is the output of the machine (or a function
+of it).
+
+Each search returns a path, as a list of C{(input, state)} pairs
+starting with C{(None, startState)}, or C{None} if no goal can be
+reached within the limit on the number of expanded nodes.
+
+States are numbered as they are found, and the search tree is kept in
+arrays of numbers (the parent, input and state of each node), so that
+a search can expand millions of nodes without storing a path for each
+of them.  A C{TransitionModel} remembers the result of every
+C{getNextValues} call;  pass the same model to several searches of
+one machine to reuse them.
+"""
+import array
+import heapq
+
+class TransitionModel:
+    """
+    The states found so far in searches of a machine, and the results
+    of the steps taken from them.  Like the tables of
+    C{fsm.TabulatedSM}, but filled in only as states are expanded:
+    the next state numbers and outputs for state C{i} are at
+    C{i * len(legalInputs) + j} for input number C{j}.
+    """
+    def __init__(self, machine, memoize = True):
+        """
+        @param machine: C{SM} with a finite list of C{legalInputs} and
+              hashable states
+        @param memoize: if C{False}, call C{getNextValues} again every
+              time a state is expanded, instead of remembering the
+              results
+        """
+        if not machine.legalInputs:
+            raise Exception, 'Search needs a machine with legalInputs'
+        self.machine = machine
+        self.inputs = list(machine.legalInputs)
+        self.width = len(self.inputs)
+        self.memoize = memoize
+        self.states = []
+        """State number C{i} is C{states[i]}"""
+        self.stateIndex = {}
+        self.known = bytearray()
+        """For each state number, C{UNKNOWN}, C{STEPPED} or C{DONE}"""
+        self.nextTable = array.array('l')
+        self.outputTable = []
+        self.expanded = 0
+        """Number of nodes expanded by the searches using this model"""
+
+    UNKNOWN = 0
+    STEPPED = 1
+    DONE = 2
+
+    def stateNumber(self, state):
+        i = self.stateIndex.get(state)
+        if i is None:
+            i = self.stateIndex[state] = len(self.states)
+            self.states.append(state)
+            self.known.append(self.UNKNOWN)
+            if self.memoize:
+                self.nextTable.extend([-1] * self.width)
+                self.outputTable.extend([None] * self.width)
+        return i
+
+    def successors(self, i):
+        """
+        @param i: state number
+        @return: list of C{(input number, next state number, output)}
+              for each legal input;  empty if the machine is done in
+              that state
+        """
+        self.expanded += 1
+        known = self.known[i]
+        if known == self.DONE:
+            return []
+        if known == self.STEPPED:
+            k = i * self.width
+            return [(j, self.nextTable[k + j], self.outputTable[k + j]) \
+                    for j in range(self.width)]
+        m = self.machine
+        s = self.states[i]
+        if m.done(s):
+            self.known[i] = self.DONE
+            return []
+        result = []
+        for (j, inp) in enumerate(self.inputs):
+            (nextState, o) = m.getNextValues(s, inp)
+            result.append((j, self.stateNumber(nextState), o))
+        if self.memoize:
+            k = i * self.width
+            for (j, t, o) in result:
+                self.nextTable[k + j] = t
+                self.outputTable[k + j] = o
+            self.known[i] = self.STEPPED
+        return result
+
+class SearchTree:
+    """
+    Internal use only.  Nodes of a search tree, numbered in the order
+    they are made;  for each, the number of its parent (-1 for the
+    root), of the input that led to it, and of its state.
+    """
+    def __init__(self):
+        self.parent = array.array('l')
+        self.inp = array.array('l')
+        self.state = array.array('l')
+
+    def add(self, parent, inp, state):
+        self.parent.append(parent)
+        self.inp.append(inp)
+        self.state.append(state)
+        return len(self.parent) - 1
+
+    def path(self, node, model):
+        result = []
+        while node >= 0:
+            if self.parent[node] < 0:
+                inp = None
+            else:
+                inp = model.inputs[self.inp[node]]
+            result.append((inp, model.states[self.state[node]]))
+            node = self.parent[node]
+        result.reverse()
+        return result
+
+def startNumber(model, initialState):
+    if initialState is None:
+        initialState = model.machine.getStartState()
+    return model.stateNumber(initialState)
+
+def breadthFirst(machine, goalTest, initialState = None, maxNodes = None,
+                 model = None):
+    """
+    Find a shortest sequence of inputs that takes C{machine} to a state
+    that satisfies C{goalTest}.  Each state is visited at most once.
+    @param goalTest: procedure from a state to C{True} or C{False}
+    @param initialState: state to start from;  defaults to the start
+          state of the machine
+    @param maxNodes: give up after expanding this many nodes
+    @param model: C{TransitionModel} of C{machine} to use
+    @return: path, or C{None}
+    """
+    if model is None:
+        model = TransitionModel(machine)
+    tree = SearchTree()
+    start = startNumber(model, initialState)
+    root = tree.add(-1, -1, start)
+    if goalTest(model.states[start]):
+        return tree.path(root, model)
+    visited = set([start])
+    frontier = [root]
+    expanded = 0
+    while frontier:
+        nextFrontier = []
+        for node in frontier:
+            if maxNodes is not None and expanded >= maxNodes:
+                return None
+            expanded += 1
+            for (j, s, o) in model.successors(tree.state[node]):
+                if s in visited:
+                    continue
+                visited.add(s)
+                child = tree.add(node, j, s)
+                if goalTest(model.states[s]):
+                    return tree.path(child, model)
+                nextFrontier.append(child)
+        frontier = nextFrontier
+    return None
+
+def uniformCost(machine, goalTest, initialState = None, cost = None,
+                maxNodes = None, model = None):
+    """
+    Find a sequence of inputs with the least total cost that takes
+    C{machine} to a state that satisfies C{goalTest}.  Costs must not
+    be negative.
+    @param cost: procedure from the output of a step to its cost;  by
+          default, the output itself is the cost
+    See C{breadthFirst} for the rest of the parameters.
+    """
+    return aStar(machine, goalTest, lambda s: 0, initialState, cost,
+                 maxNodes, model)
+
+def aStar(machine, goalTest, heuristic, initialState = None, cost = None,
+          maxNodes = None, model = None):
+    """
+    Like C{uniformCost}, but nodes are expanded in order of their cost
+    so far plus C{heuristic} of their state, an estimate of the least
+    cost to reach a goal from there.  The path found has the least
+    cost if the heuristic never overestimates that cost.  A state is
+    only expanded again if it is reached more cheaply than before.
+    @param heuristic: procedure from a state to a number
+    See C{uniformCost} for the rest of the parameters.
+    """
+    if model is None:
+        model = TransitionModel(machine)
+    tree = SearchTree()
+    start = startNumber(model, initialState)
+    root = tree.add(-1, -1, start)
+    # Cost of the path to each node, and the least cost found so far
+    # of a path to each state number
+    pathCost = array.array('d', [0.0])
+    best = {start: 0.0}
+    estimates = {}
+    agenda = [(heuristic(model.states[start]), root)]
+    expanded = 0
+    while agenda:
+        (f, node) = heapq.heappop(agenda)
+        s = tree.state[node]
+        g = pathCost[node]
+        if g > best[s]:
+            # A cheaper path to this state was found after this one
+            continue
+        if goalTest(model.states[s]):
+            return tree.path(node, model)
+        if maxNodes is not None and expanded >= maxNodes:
+            return None
+        expanded += 1
+        for (j, t, o) in model.successors(s):
+            if cost is None:
+                c = o
+            else:
+                c = cost(o)
+            g2 = g + c
+            if t in best and best[t] <= g2:
+                continue
+            best[t] = g2
+            child = tree.add(node, j, t)
+            pathCost.append(g2)
+            h = estimates.get(t)
+            if h is None:
+                h = estimates[t] = heuristic(model.states[t])
+            heapq.heappush(agenda, (g2 + h, child))
+    return None
@@ -0,0 +1,223 @@
+
+"""
+System functions of linear time-invariant (LTI) state machines.  The
+system function of a machine is the ratio of two polynomials in the
+delay operator C{R}:  if the input is C{X} and the output C{Y}, then
+C{Y = (numerator / denominator) X}.  C{systemFunction} finds it from
+the composition tree of a machine made of C{Gain}, C{Wire}, C{R} (or
+C{Delay}), C{Cascade}, C{ParallelAdd}, C{FeedbackAdd},
+C{FeedbackSubtract}, C{CascadeN} and C{ParallelAddN}, by combining
+the system functions of the parts;  the poles and frequency response
+then follow by algebra, with no simulation.
+
+System functions describe the response of a machine started with all
+of its delays holding 0;  the initial values of C{R} machines are
+ignored.
+
+Polynomials are lists of coefficients of increasing powers of C{R}:
+C{[1, -0.5]} is C{1 - 0.5R}.
+"""
+import sm
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class SystemFunction:
+    """
+    Ratio of two polynomials in C{R}.  The denominator is scaled so
+    that its constant term is 1.
+    """
+    def __init__(self, numerator, denominator):
+        """
+        @param numerator: list of coefficients of increasing powers of R
+        @param denominator: list of coefficients of increasing powers of
+              R;  its constant term must not be 0, which would mean
+              that the output depends on itself without a delay
+        """
+        numerator = trim(numerator)
+        denominator = trim(denominator)
+        if not denominator or denominator[0] == 0:
+            raise Exception, \
+                  'System function denominator must have a constant term'
+        d0 = float(denominator[0])
+        self.numerator = [c / d0 for c in numerator]
+        self.denominator = [c / d0 for c in denominator]
+
+    def __repr__(self):
+        return 'SF(%s / %s)' % (polyString(self.numerator),
+                                polyString(self.denominator))
+
+    def poles(self):
+        """
+        @return: list of the poles:  the roots, in C{z = 1/R}, of the
+              denominator
+        """
+        needNumpy()
+        # Multiplying the denominator by z^N turns its coefficients of
+        # increasing powers of R into coefficients of decreasing powers
+        # of z
+        return list(numpy.roots(self.denominator))
+
+    def dominantPole(self):
+        """
+        @return: the pole with the largest magnitude, or C{None} if
+              there are no poles
+        """
+        poles = self.poles()
+        if not poles:
+            return None
+        return max(poles, key = abs)
+
+    def isStable(self):
+        """
+        @return: C{True} if all of the poles are inside the unit circle,
+              so that the response to a bounded input stays bounded
+        """
+        return all([abs(p) < 1 for p in self.poles()])
+
+    def frequencyResponse(self, omega):
+        """
+        Evaluate the system function at C{R = exp(-j omega)} for a whole
+        array of frequencies at once.
+        @param omega: number or NumPy array of frequencies, in radians
+              per step
+        @return: complex number or NumPy array of the gain and phase
+              shift at each frequency
+        """
+        needNumpy()
+        r = numpy.exp(-1j * numpy.asarray(omega, dtype = float))
+        # polyval wants the coefficients of the highest power first
+        return numpy.polyval(self.numerator[::-1] or [0], r) / \
+               numpy.polyval(self.denominator[::-1], r)
+
+def Gain(k):
+    return SystemFunction([k], [1])
+
+def R():
+    return SystemFunction([0, 1], [1])
+
+def Cascade(sf1, sf2):
+    return SystemFunction(polyMul(sf1.numerator, sf2.numerator),
+                          polyMul(sf1.denominator, sf2.denominator))
+
+def ParallelAdd(sf1, sf2):
+    return SystemFunction(polyAdd(polyMul(sf1.numerator, sf2.denominator),
+                                  polyMul(sf2.numerator, sf1.denominator)),
+                          polyMul(sf1.denominator, sf2.denominator))
+
+def FeedbackAdd(sf1, sf2 = None):
+    """
+    Output of C{sf1} fed back through C{sf2} (a wire by default) and
+    added to the input:  C{H1 / (1 - H1 H2)}
+    """
+    return feedback(sf1, sf2, 1)
+
+def FeedbackSubtract(sf1, sf2 = None):
+    """
+    Like C{FeedbackAdd}, but subtracted from the input:
+    C{H1 / (1 + H1 H2)}
+    """
+    return feedback(sf1, sf2, -1)
+
+def feedback(sf1, sf2, sign):
+    if sf2 is None:
+        sf2 = Gain(1)
+    loop = polyMul(sf1.numerator, sf2.numerator)
+    return SystemFunction(polyMul(sf1.numerator, sf2.denominator),
+                          polyAdd(polyMul(sf1.denominator, sf2.denominator),
+                                  [-sign * c for c in loop]))
+
+def systemFunction(m):
+    """
+    @param m: C{SM}
+    @return: C{SystemFunction} of C{m}, or C{None} if C{m} is not an
+          LTI machine made of the parts listed above, with numeric
+          gains, or has a feedback loop without a delay
+    """
+    c = m.__class__
+    if c is sm.Gain:
+        if sm.isNumber(m.k):
+            return Gain(m.k)
+    elif c is sm.Wire:
+        return Gain(1)
+    elif c is sm.R:
+        return R()
+    elif c in (sm.Cascade, sm.ParallelAdd, sm.FeedbackAdd,
+               sm.FeedbackSubtract):
+        sf1 = systemFunction(m.m1)
+        sf2 = systemFunction(m.m2)
+        if sf1 is None or sf2 is None:
+            return None
+        if c is sm.Cascade:
+            return Cascade(sf1, sf2)
+        elif c is sm.ParallelAdd:
+            return ParallelAdd(sf1, sf2)
+        if c is sm.FeedbackAdd:
+            sign = 1
+        else:
+            sign = -1
+        if delayFree(sf1, sf2, sign):
+            return None
+        return feedback(sf1, sf2, sign)
+    elif c in (sm.CascadeN, sm.ParallelAddN):
+        parts = [systemFunction(part) for part in m.smList]
+        if None in parts:
+            return None
+        if c is sm.CascadeN:
+            return reduce(Cascade, parts)
+        return reduce(ParallelAdd, parts)
+    return None
+
+def delayFree(sf1, sf2, sign):
+    """
+    Would the feedback loop of C{sf1} and C{sf2} make the output depend
+    on itself without a delay?  That is when the constant term of the
+    denominator of the result is 0.
+    """
+    n1 = sf1.numerator[:1] or [0]
+    n2 = sf2.numerator[:1] or [0]
+    return 1 - sign * n1[0] * n2[0] == 0
+
+def needNumpy():
+    if numpy is None:
+        raise Exception, 'Poles and frequency responses need NumPy'
+
+def trim(p):
+    """
+    Drop zero coefficients of the highest powers
+    """
+    p = list(p)
+    while p and p[-1] == 0:
+        p.pop()
+    return p
+
+def polyAdd(p1, p2):
+    n = max(len(p1), len(p2))
+    p1 = p1 + [0] * (n - len(p1))
+    p2 = p2 + [0] * (n - len(p2))
+    return [a + b for (a, b) in zip(p1, p2)]
+
+def polyMul(p1, p2):
+    if not p1 or not p2:
+        return []
+    result = [0] * (len(p1) + len(p2) - 1)
+    for (i, a) in enumerate(p1):
+        for (j, b) in enumerate(p2):
+            result[i + j] += a * b
+    return result
+
+def polyString(p):
+    if not p:
+        return '0'
+    terms = []
+    for (k, c) in enumerate(p):
+        if c == 0:
+            continue
+        if k == 0:
+            terms.append(str(c))
+        elif k == 1:
+            terms.append(str(c) + 'R')
+        else:
+            terms.append(str(c) + 'R**' + str(k))
+    return ' + '.join(terms)
@@ -3,11 +3,23 @@
 Classes for representing and combining state machines.
 """
 import copy
+import hashlib
+import random
 import sys
+import threading
 import types
 import inspect
+import itertools
+import multiprocessing
+import multiprocessing.sharedctypes
+import timeit
 import util
 reload(util)
+import lti
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class SM:
     """
@@ -56,15 +68,134 @@ class SM:
         """
         return self.done(self.state)
 
+    def canTerminate(self):
+        """
+        Can this machine ever be done?  By default, only if it defines
+        its own C{done} method;  compositions ask their sub-machines,
+        unless a subclass defines its own C{done} (see
+        C{overridesDone}).
+        Used to skip checking C{done} on every step for machines that
+        never terminate.
+        """
+        return self.done.im_func is not SM.done.im_func
+
+    def subMachines(self):
+        """
+        List of the machines that this one is made of;  empty for a
+        primitive machine.  Used to walk the composition tree.
+        """
+        return []
+
     legalInputs = []
     """
     By default, the space of legal inputs is not defined.
     """
 
+    dependsOnInput = None
+    """
+    C{True} if the output of the machine depends on its input without
+    a delay, C{False} if it never does, and C{None} if that is not
+    known.  Feedback compositions use it to avoid probing machines
+    that have a delay.
+    """
+
+    def getDelayedOutput(self, state):
+        """
+        Output of the machine in C{state}, for a machine whose output
+        does not depend on its input without a delay.  By default, get
+        it by calling C{getNextValues} with an undefined input;
+        machines with a delay can do better.
+        """
+        (ignore, o) = self.getNextValues(state, 'undefined')
+        return o
+
+    def getStartStateBatch(self, k):
+        """
+        Start states for C{k} lanes of C{transduceBatch}.  By default,
+        a list with the start state of each lane.  Machines that define
+        C{getNextValuesBatch} may use another representation for the
+        states of all the lanes:  a list, a NumPy array, C{None}, or a
+        tuple of such representations.
+        """
+        return [self.getStartState() for i in range(k)]
+
+    def getNextValuesBatch(self, states, inps):
+        """
+        Like C{getNextValues}, but for all the lanes of
+        C{transduceBatch} at once.  By default, calls C{getNextValues}
+        for each lane in turn.
+        @param states: batch of states, as made by C{getStartStateBatch}
+        @param inps: list or NumPy array with the input to each lane
+        @return: pair of the new batch of states and the list or NumPy
+              array of outputs
+        """
+        results = [self.getNextValues(s, i) \
+                   for (s, i) in zip(states, toList(inps))]
+        return ([s for (s, o) in results],
+                asLanes([o for (s, o) in results]))
+
+    def getDelayedOutputBatch(self, states):
+        """
+        Like C{getDelayedOutput}, but for all the lanes at once
+        """
+        return asLanes([self.getDelayedOutput(s) for s in states])
+
+    def doneBatch(self, states):
+        """
+        Like C{done}, but for all the lanes at once.
+        @return: list with a boolean for each lane, or C{None} if no
+              lane is done
+        """
+        if not self.canTerminate():
+            return None
+        return [self.done(s) for s in states]
+
+    def stateToRecord(self, state):
+        """
+        For the in-place mode of C{start}:  make a mutable record
+        holding C{state}, which C{stepInPlace} updates on each step
+        instead of making a new state.  A record is a list, with the
+        value of a primitive machine's state or the records of a
+        composition's parts.  By default, returns C{None}:  the machine
+        has no record, and runs the usual way.
+        """
+        return None
+
+    def recordToState(self, record):
+        """
+        Inverse of C{stateToRecord}:  a new state with the values in
+        C{record}
+        """
+        raise Exception, self.__class__.__name__ + ' has no state record'
+
+    def stepInPlace(self, record, inp):
+        """
+        Like C{getNextValues}, but changes C{record} to hold the next
+        state, and returns only the output
+        """
+        raise Exception, self.__class__.__name__ + ' has no state record'
+
+    def getDelayedOutputInPlace(self, record):
+        """
+        Like C{getDelayedOutput}, but from a record.  By default, makes
+        the state out of the record.
+        """
+        return self.getDelayedOutput(self.recordToState(record))
+
     __debugParams = None # internal use
+    __profiler = None # internal use
+    __record = None # internal use
+
+    def __getattr__(self, name):
+        # In the in-place mode of start, the state lives in a record,
+        # and is only made into a state value when it is asked for
+        if name == 'state' and self.__record is not None:
+            return self.recordToState(self.__record)
+        raise noAttribute(self, name)
     
     def start(self, traceTasks = [], verbose = False,
-              compact = True, printInput = True):
+              compact = True, printInput = True, recorder = None,
+              profiler = None, inPlace = False):
         """
         Call before providing inp to a machine, or to reset it.
         Sets self.state and arranges things for tracing and debugging.
@@ -80,12 +211,43 @@ class SM:
               print the whole input in each step, otherwise don't.
               Useful to set to C{False} when the input is large and
               you don't want to see it all.
+        @param recorder: C{tracestore.TraceRecorder} to record the
+              input, state and output of the machines on each step
+        @param profiler: C{Profiler} to time the steps of this machine
+              and of each machine inside it, until the machine is
+              started again or C{profiler.stop} is called
+        @param inPlace: If C{True}, and the machine and all of its parts
+              have state records (see C{stateToRecord}), keep the state
+              in a record that each step updates, instead of making new
+              state tuples on every step.  C{self.state} can still be
+              read, and is made from the record when it is;  assigning
+              to it replaces the record.  Ignored when tracing,
+              debugging or profiling.
         """
         self.state = self.getStartState()
         """ Instance variable set by start, and updated by step;
               should not be managed by user """
+        self.__record = None
         self.__debugParams = DebugParams(traceTasks, verbose, compact,
-                                         printInput)
+                                         printInput, recorder)
+        if self.__debugParams.doDebugging:
+            self.__debugParams.resolve(self)
+        if self.__profiler is not None:
+            self.__profiler.stop()
+        self.__profiler = profiler
+        if profiler is not None:
+            profiler.install(self)
+        # Without debugging, transduce can use a loop that doesn't
+        # call step, and doesn't check done if it can never be true;
+        # but not if a subclass has its own step, which must be called
+        self.__fast = not self.__debugParams.doDebugging and \
+                      self.step.im_func is SM.step.im_func
+        self.__neverDone = self.__fast and not self.canTerminate()
+        if inPlace and not self.__debugParams.doDebugging and \
+               profiler is None:
+            self.__record = self.stateToRecord(self.state)
+            if self.__record is not None:
+                del self.state
         
     def step(self, inp):
         """
@@ -94,25 +256,30 @@ class SM:
         Error to call C{step} if C{done} is true.
         @param inp: next input to the machine
         """
-        (s, o) = self.getNextValues(self.state, inp)
-
+        if self.__record is not None:
+            return self.stepInPlace(self.currentRecord(), inp)
         if self.__debugParams and self.__debugParams.doDebugging:
-            if self.__debugParams.verbose and not self.__debugParams.compact:
-                print "Step:", self.__debugParams.k
-            self.printDebugInfo(0, self.state, s, inp, o, self.__debugParams)
-            if self.__debugParams.verbose and self.__debugParams.compact:
-                if self.__debugParams.printInput:
-                    print "In:", inp, "Out:", o, "Next State:", s
-                else:
-                    print "Out:", o, "Next State:", s
-            self.__debugParams.k += 1
+            (s, o) = debugStep(self, self.state, inp, self.__debugParams)
+        else:
+            (s, o) = self.getNextValues(self.state, inp)
 
         self.state = s
         return o
 
+    def currentRecord(self):
+        """
+        Internal use only.  The record of the started machine, in the
+        in-place mode;  if C{self.state} has been assigned since the
+        last step, a new record holding that state.
+        """
+        if 'state' in self.__dict__:
+            self.__record = self.stateToRecord(self.__dict__.pop('state'))
+        return self.__record
+
     def transduce(self, inps, verbose = False, traceTasks = [],
                   compact = True, printInput = True,
-                  check = False):
+                  check = False, recorder = None, profiler = None,
+                  inPlace = False):
         """
         Start the machine fresh, and feed a sequence of values into
         the machine, collecting the sequence of outputs
@@ -122,32 +289,164 @@ class SM:
 	it.  See the documentation for the C{check} method for more information
 	about what is tested.
 
+        If C{lti.inTransduce} is set, long lists of floating point
+        inputs to linear time-invariant machines are run through a
+        vectorized engine instead of one step at a time;  see the
+        C{lti} module.
+
         See documentation for the C{start} method for description of
         the rest of the parameters.
         
-        @param inps: list of inputs appropriate for this state machine
+        @param inps: list (or any iterable) of inputs appropriate for
+              this state machine
         @return: list of outputs
         """
         if check:
+            inps = list(inps)
             self.check(inps)
-        i = 0
-        n = len(inps)
-        result = []
+        elif not (verbose or traceTasks or recorder or profiler or inPlace):
+            result = lti.transduce(self, inps)
+            if result is not None:
+                return result
+        self.start(verbose = verbose, compact = compact,
+                   printInput = printInput, traceTasks = traceTasks,
+                   recorder = recorder, profiler = profiler,
+                   inPlace = inPlace)
+        try:
+            if self.__record is not None and self.__fast:
+                return list(self.__inPlaceSteps(iter(inps)))
+            if self.__fast:
+                return self.__fastTransduce(iter(inps))
+            return list(self.__steps(iter(inps), verbose))
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            if recorder is not None:
+                recorder.close()
+
+    def transduceIter(self, inps, verbose = False, traceTasks = [],
+                      compact = True, printInput = True, recorder = None,
+                      profiler = None, inPlace = False):
+        """
+        Like C{transduce}, but lazy: start the machine fresh and return
+        a generator that pulls one value at a time from C{inps} and
+        yields the corresponding output.  Stops when C{inps} is
+        exhausted or the machine is done.  Only the current state is
+        kept, so memory use does not grow with the length of the
+        stream.
+
+        See documentation for the C{start} method for description of
+        the rest of the parameters.
+
+        @param inps: any iterable (possibly infinite) of inputs
+        @return: generator of outputs
+        """
         self.start(verbose = verbose, compact = compact,
-                   printInput = printInput, traceTasks = traceTasks)
+                   printInput = printInput, traceTasks = traceTasks,
+                   recorder = recorder, profiler = profiler,
+                   inPlace = inPlace)
+        if self.__record is not None and self.__fast:
+            return self.__inPlaceSteps(iter(inps))
+        if self.__fast:
+            return self.__fastSteps(iter(inps))
+        return self.__steps(iter(inps), verbose)
+
+    def __steps(self, inps, verbose):
+        """
+        Generator of the outputs of the started machine, calling
+        C{step} on each input, for when debugging is on
+        """
         if verbose:
             print "Start state:", self.state
-        # Consider stopping if next state is done?  (as it is, we get
-        # an output associated with a transition into a done state)
-        while i < n and not self.isDone():
-            result.append(self.step(inps[i]))
+        i = 0
+        # Check for termination before pulling the next input, so that
+        # we never consume an input we are not going to use
+        while not self.isDone():
+            try:
+                inp = next(inps)
+            except StopIteration:
+                return
+            yield self.step(inp)
             i = i + 1
             if i % 100 == 0 and verbose:
                 print 'Step', i
+
+    def __fastSteps(self, inps):
+        """
+        Like C{__steps}, but for when debugging is off:  calls
+        C{getNextValues} directly, and skips C{done} for machines that
+        can't terminate.
+        """
+        getNextValues = self.getNextValues
+        done = self.done
+        state = self.state
+        try:
+            if self.__neverDone:
+                for inp in inps:
+                    (state, o) = getNextValues(state, inp)
+                    self.state = state
+                    yield o
+            else:
+                while not done(state):
+                    try:
+                        inp = next(inps)
+                    except StopIteration:
+                        return
+                    (state, o) = getNextValues(state, inp)
+                    self.state = state
+                    yield o
+        finally:
+            self.state = state
+
+    def __inPlaceSteps(self, inps):
+        """
+        Like C{__fastSteps}, but for the in-place mode:  steps update
+        the record, and no states are made, except to check C{done}
+        for machines that can terminate.
+        """
+        stepInPlace = self.stepInPlace
+        if self.__neverDone:
+            for inp in inps:
+                yield stepInPlace(self.currentRecord(), inp)
+        else:
+            while not self.isDone():
+                try:
+                    inp = next(inps)
+                except StopIteration:
+                    return
+                yield stepInPlace(self.currentRecord(), inp)
+
+    def __fastTransduce(self, inps):
+        """
+        Same as C{list(self.__fastSteps(inps))}, but without the cost
+        of going through a generator.  The state is only stored back in
+        C{self.state} at the end.
+        """
+        result = []
+        append = result.append
+        getNextValues = self.getNextValues
+        done = self.done
+        state = self.state
+        try:
+            if self.__neverDone:
+                for inp in inps:
+                    (state, o) = getNextValues(state, inp)
+                    append(o)
+            else:
+                while not done(state):
+                    try:
+                        inp = next(inps)
+                    except StopIteration:
+                        break
+                    (state, o) = getNextValues(state, inp)
+                    append(o)
+        finally:
+            self.state = state
         return result
 
     def run(self, n = 10, verbose = False, traceTasks = [],
-                   compact = True, printInput = True, check = False):
+                   compact = True, printInput = True, check = False,
+                   recorder = None, profiler = None, inPlace = False):
         """
         For a machine that doesn't consume input (e.g., one made with
         C{feedback}, for C{n} steps or until it terminates. 
@@ -158,23 +457,139 @@ class SM:
         @param n: number of steps to run
         @return: list of outputs
         """
-        return self.transduce([None]*n, verbose = verbose,
+        if check:
+            return self.transduce([None]*n, verbose = verbose,
+                                  traceTasks = traceTasks, compact = compact,
+                                  printInput = printInput, check = check,
+                                  recorder = recorder, profiler = profiler)
+        return self.transduce(itertools.repeat(None, n), verbose = verbose,
                               traceTasks = traceTasks, compact = compact,
-                              printInput = printInput,
-                              check = check)
+                              printInput = printInput, recorder = recorder,
+                              profiler = profiler, inPlace = inPlace)
+
+    def runIter(self, n = None, verbose = False, traceTasks = [],
+                compact = True, printInput = True, recorder = None,
+                profiler = None, inPlace = False):
+        """
+        Like C{run}, but returns a generator of outputs, in the manner
+        of C{transduceIter}.
+        @param n: number of steps to run;  if C{None}, run until the
+              machine terminates (possibly forever)
+        @return: generator of outputs
+        """
+        if n is None:
+            inps = itertools.repeat(None)
+        else:
+            inps = itertools.repeat(None, n)
+        return self.transduceIter(inps, verbose = verbose,
+                                  traceTasks = traceTasks, compact = compact,
+                                  printInput = printInput,
+                                  recorder = recorder, profiler = profiler,
+                                  inPlace = inPlace)
 
     def transduceF(self, inpFn, n = 10, verbose = False,
                    traceTasks = [],
-                   compact = True, printInput = True):
+                   compact = True, printInput = True, recorder = None,
+                   profiler = None, inPlace = False):
         """
         Like C{transduce}, but rather than getting inputs from a list
         of values, get them by calling a function with the input index
-        as the argument. 
+        as the argument.  Inputs are generated one at a time, as they
+        are needed.
         """
-        return self.transduce([inpFn(i) for i in range(n)], 
+        return self.transduce(itertools.imap(inpFn, xrange(n)), 
                               traceTasks = traceTasks, compact = compact,
                               printInput = printInput, verbose =
-                   verbose)
+                   verbose, recorder = recorder, profiler = profiler,
+                              inPlace = inPlace)
+
+    def advance(self, n, inp = None):
+        """
+        Step the started machine C{n} times with the same input, or
+        until it is done, and return the output of the last step.  For
+        a linear time-invariant machine (see the C{lti} module) and a
+        numeric input, the state after C{n} steps is computed directly
+        from the state-space form of the machine by repeated squaring,
+        which takes time proportional to C{log n} rather than C{n};
+        the new state is then made of floats.  Other machines, machines
+        whose gains, state and input are all integers, and machines with
+        debugging on are stepped.
+        @param n: number of steps
+        @param inp: input on every step
+        @return: output of the last step, or C{None} if no step was
+              taken
+        """
+        if not (self.__debugParams and self.__debugParams.doDebugging):
+            result = lti.advance(self, self.state, n, inp)
+            if result is not None:
+                (self.state, o) = result
+                return o
+        o = None
+        for i in xrange(n):
+            if self.isDone():
+                break
+            o = self.step(inp)
+        return o
+
+    def runPeriodic(self, n = None, compact = False):
+        """
+        Like C{run}, for a deterministic machine that doesn't consume
+        input and that eventually repeats a state (for instance, by
+        settling into a cycle or a fixed point).  Once the first repeat
+        is found, by Brent's cycle-finding algorithm, the rest of the
+        outputs are known without taking any more steps.  States are
+        compared with C{==}.  The machine itself is not started or
+        changed.
+        @param n: number of steps to run;  if C{None}, run forever (so
+              the machine must repeat a state or terminate)
+        @param compact: if C{True}, return a pair of the list of outputs
+              before the cycle and the list of outputs in one period of
+              the cycle (empty if the run ends before a cycle is found)
+        @return: C{PeriodicSequence} of outputs, or a pair as above
+        """
+        (prefix, cycle) = findCycle(self, n)
+        if compact:
+            return (prefix, cycle)
+        if not cycle:
+            n = len(prefix)
+        return PeriodicSequence(prefix, cycle, n)
+
+    def runSteady(self, n = None, tolerance = 1e-9, window = 10,
+                  inp = None):
+        """
+        Like C{run}, but stop stepping once the machine has settled:
+        when, for C{window} steps in a row, no number in the output or
+        the state has changed by more than C{tolerance} (and nothing
+        else in them has changed at all).  The outputs for the rest of
+        the C{n} steps are taken to be the same as the last one, and
+        given on demand.  The machine is left in the last state that
+        was computed.
+        @param n: number of steps to run;  if C{None}, run forever (so
+              the machine must settle or terminate)
+        @param inp: input on every step
+        @return: C{SteadyStateSequence} of outputs;  its C{convergedAt}
+              is the number of steps taken before stopping, or C{None}
+              if the machine didn't settle
+        """
+        self.start()
+        getNextValues = self.getNextValues
+        state = self.state
+        outs = []
+        calm = 0
+        while calm < window:
+            if (n is not None and len(outs) == n) or self.done(state):
+                self.state = state
+                return SteadyStateSequence(outs, [], len(outs), None)
+            (nextState, o) = getNextValues(state, inp)
+            if outs and change(o, outs[-1]) <= tolerance and \
+                   change(nextState, state) <= tolerance:
+                calm += 1
+            else:
+                calm = 0
+            outs.append(o)
+            state = nextState
+        self.state = state
+        return SteadyStateSequence(outs, outs[-1:], n, len(outs))
     
     name = None
     """Name used for tracing"""
@@ -187,6 +602,17 @@ class SM:
         if not self.name:
             self.name = util.gensym(self.__class__.__name__)
 
+    def getNextValuesTraced(self, state, inp):
+        """
+        Like C{getNextValues}, but also returns a C{StepTrace} record
+        of the step.  Compositions override this to record the steps of
+        their sub-machines as they take them, so that printing and
+        tracing don't have to run any machine again.
+        @return: C{(nextState, output, trace)}
+        """
+        (s, o) = self.getNextValues(state, inp)
+        return (s, o, StepTrace(self, state, s, inp, o))
+
     def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
         """
         Default method for printing out all of the debugging
@@ -215,16 +641,20 @@ class SM:
         To B{do} a trace task, we call the function C{fun} on the
         specified attribute of the specified mahine.  In particular,
         we execute it right now if its machine name equals the name of
-        this machine.
-        """
-        for (name, mode, fun) in debugParams.traceTasks:
-            if name == self.name:
-                if mode == 'input':
-                    fun(inp)
-                elif mode == 'state':
-                    fun(state)
-                else:
-                    fun(out)
+        this machine.  The tasks are looked up by name in the table
+        made by C{DebugParams.resolve} when the machine was started.
+        If there is a recorder, the step is also recorded in it.
+        """
+        for (mode, fun) in debugParams.tasks.get(self.name, ()):
+            if mode == 'input':
+                fun(inp)
+            elif mode == 'state':
+                fun(state)
+            else:
+                fun(out)
+        if debugParams.recorder is not None:
+            debugParams.recorder.record(self.name, debugParams.k,
+                                        inp, state, out)
 
     def check(thesm, inps = None):
         """
@@ -313,10 +743,152 @@ class SM:
 
                     
                     
+def debugStep(m, state, inp, debugParams):
+    """
+    Internal use only.  Step C{m} from C{state} with tracing, printing
+    and recording as set up in C{debugParams}.
+    @return: pair of the next state and the output
+    """
+    (s, o, trace) = m.getNextValuesTraced(state, inp)
+    if debugParams.verbose and not debugParams.compact:
+        print "Step:", debugParams.k
+    trace.printDebugInfo(0, debugParams)
+    if debugParams.verbose and debugParams.compact:
+        if debugParams.printInput:
+            print "In:", inp, "Out:", o, "Next State:", s
+        else:
+            print "Out:", o, "Next State:", s
+    debugParams.k += 1
+    return (s, o)
+
+def noAttribute(obj, name):
+    """
+    The C{AttributeError} that Python raises for an instance of an
+    old-style class with no attribute C{name}, for C{__getattr__}
+    methods to raise
+    """
+    return AttributeError("%s instance has no attribute '%s'" % \
+                          (obj.__class__.__name__, name))
+
+nameLock = threading.Lock()
+"""Held while naming the machines in a tree, which changes them"""
+
+class Run:
+    """
+    One run of a machine:  the state and debugging parameters that
+    C{start} and C{step} keep in the machine itself.  A machine can
+    only do one run at a time with C{start} and C{step}, but any
+    number of C{Run}s can step the same machine at once (in different
+    threads, say), without copying it or locking it, as long as its
+    C{getNextValues} doesn't change the machine.  The one change made
+    to the machine is that starting a run with tracing, printing or a
+    recorder gives names to all of the machines in it that have none,
+    which is done under C{nameLock};  the steps of the run then only
+    read the names.
+
+    Typical use::
+
+        runs = [sm.Run(controller) for i in range(n)]
+        ...
+        u = runs[i].step(sensorValue)
+    """
+    def __init__(self, machine, traceTasks = [], verbose = False,
+                 compact = True, printInput = True, recorder = None,
+                 inPlace = False):
+        """
+        Start a run of C{machine} in its start state.  See C{SM.start}
+        for the parameters;  there is no profiler, since a C{Profiler}
+        wraps the methods of the machines themselves.  A
+        C{tracestore.TraceRecorder} should not be shared between runs
+        that are stepped at the same time.
+        """
+        self.machine = machine
+        self.record = None
+        self.state = machine.getStartState()
+        """Current state of the run"""
+        self.debugParams = DebugParams(traceTasks, verbose, compact,
+                                       printInput, recorder)
+        if self.debugParams.doDebugging:
+            nameLock.acquire()
+            try:
+                nameAll(machine)
+                self.debugParams.resolve(machine)
+            finally:
+                nameLock.release()
+            if verbose:
+                print "Start state:", self.state
+        elif inPlace:
+            self.record = machine.stateToRecord(self.state)
+            if self.record is not None:
+                del self.state
+        self.neverDone = not self.debugParams.doDebugging and \
+                         not machine.canTerminate()
+
+    def __getattr__(self, name):
+        # As in SM, the state of an in-place run is made from its
+        # record when it is asked for
+        if name == 'state' and self.__dict__.get('record') is not None:
+            return self.machine.recordToState(self.record)
+        raise noAttribute(self, name)
+
+    def step(self, inp):
+        """
+        Like C{SM.step}:  one step of the machine, updating the state
+        of this run.
+        @return: output of the machine
+        """
+        if self.record is not None:
+            if 'state' in self.__dict__:
+                self.record = \
+                       self.machine.stateToRecord(self.__dict__.pop('state'))
+            return self.machine.stepInPlace(self.record, inp)
+        if self.debugParams.doDebugging:
+            (s, o) = debugStep(self.machine, self.state, inp,
+                               self.debugParams)
+        else:
+            (s, o) = self.machine.getNextValues(self.state, inp)
+        self.state = s
+        return o
+
+    def isDone(self):
+        return self.machine.done(self.state)
+
+    def transduce(self, inps):
+        """
+        Feed a sequence of inputs to the run, carrying on from its
+        current state, until they run out or the machine is done.
+        @param inps: list (or any iterable) of inputs
+        @return: list of outputs
+        """
+        result = []
+        inps = iter(inps)
+        while self.neverDone or not self.isDone():
+            try:
+                inp = next(inps)
+            except StopIteration:
+                break
+            result.append(self.step(inp))
+        return result
+
+    def run(self, n = 10):
+        """
+        Like C{transduce}, for a machine that doesn't consume input
+        @param n: number of steps to run
+        """
+        return self.transduce(itertools.repeat(None, n))
+
 ######################################################################
 #    Compositions
 ######################################################################
 
+def overridesDone(m, cls):
+    """
+    Does the class of C{m}, a subclass of the composition C{cls}, define
+    its own C{done}?  If so, the composition can terminate whatever its
+    sub-machines do.
+    """
+    return m.done.im_func is not cls.done.im_func
+
 class Cascade (SM):
     """
     Cascade composition of two state machines.  The output of C{sm1}
@@ -334,6 +906,8 @@ class Cascade (SM):
             raise Exception, 'Cascade takes two machine arguments and an optional name argument'
         self.name = name
         self.legalInputs = self.m1.legalInputs
+        self.dependsOnInput = allDepend([m1.dependsOnInput,
+                                         m2.dependsOnInput])
 
     def startState(self):
         return (self.m1.getStartState(), self.m2.getStartState())
@@ -344,21 +918,68 @@ class Cascade (SM):
         (newS2, o2) = self.m2.getNextValues(s2, o1)
         return ((newS1, newS2), o2)
 
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        (newS1, o1, t1) = self.m1.getNextValuesTraced(s1, inp)
+        (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, o1)
+        newState = (newS1, newS2)
+        return (newState, o2,
+                StepTrace(self, state, newState, inp, o2, [t1, t2]))
+
+    def getDelayedOutput(self, state):
+        (s1, s2) = state
+        if self.m2.dependsOnInput is False:
+            return self.m2.getDelayedOutput(s2)
+        (ignore, o2) = self.m2.getNextValues(s2,
+                                             self.m1.getDelayedOutput(s1))
+        return o2
+
+    def getStartStateBatch(self, k):
+        return (self.m1.getStartStateBatch(k), self.m2.getStartStateBatch(k))
+
+    def getNextValuesBatch(self, states, inps):
+        (s1, s2) = states
+        (newS1, o1) = self.m1.getNextValuesBatch(s1, inps)
+        (newS2, o2) = self.m2.getNextValuesBatch(s2, o1)
+        return ((newS1, newS2), o2)
+
+    def getDelayedOutputBatch(self, states):
+        (s1, s2) = states
+        if self.m2.dependsOnInput is False:
+            return self.m2.getDelayedOutputBatch(s2)
+        (ignore, o2) = self.m2.getNextValuesBatch(s2,
+                                        self.m1.getDelayedOutputBatch(s1))
+        return o2
+
     def done(self, state):
         (s1, s2) = state
         return self.m1.done(s1) or self.m2.done(s2)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            (ns1, o1) = self.m1.getNextValues(s1, inp)
-            self.m1.printDebugInfo(depth + 4, s1, ns1, inp, o1, debugParams)
-            self.m2.printDebugInfo(depth + 4, s2, ns2, o1, out, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, Cascade) or \
+               self.m1.canTerminate() or self.m2.canTerminate()
+
+    def subMachines(self):
+        return [self.m1, self.m2]
+
+    def doneBatch(self, states):
+        (s1, s2) = states
+        return orLanes(self.m1.doneBatch(s1), self.m2.doneBatch(s2))
+
+    def stateToRecord(self, state):
+        return partRecords([self.m1, self.m2], state)
+
+    def recordToState(self, record):
+        return partStates([self.m1, self.m2], record)
+
+    def stepInPlace(self, record, inp):
+        return self.m2.stepInPlace(record[1],
+                                   self.m1.stepInPlace(record[0], inp))
+
+    def getDelayedOutputInPlace(self, record):
+        if self.m2.dependsOnInput is False:
+            return self.m2.getDelayedOutputInPlace(record[1])
+        return SM.getDelayedOutputInPlace(self, record)
 
 class Parallel (SM):
     """
@@ -378,6 +999,8 @@ class Parallel (SM):
         # machine).  Check that here.
         assert set(self.m1.legalInputs) == set(self.m2.legalInputs)
         self.legalInputs = self.m1.legalInputs
+        self.dependsOnInput = anyDepends([m1.dependsOnInput,
+                                          m2.dependsOnInput])
 
     def startState(self):
         return (self.m1.getStartState(), self.m2.getStartState())
@@ -388,22 +1011,61 @@ class Parallel (SM):
         (newS2, o2) = self.m2.getNextValues(s2, inp)
         return ((newS1, newS2), (o1, o2))
 
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        (newS1, o1, t1) = self.m1.getNextValuesTraced(s1, inp)
+        (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, inp)
+        (newState, o) = ((newS1, newS2), (o1, o2))
+        return (newState, o,
+                StepTrace(self, state, newState, inp, o, [t1, t2]))
+
+    def getDelayedOutput(self, state):
+        (s1, s2) = state
+        return (self.m1.getDelayedOutput(s1), self.m2.getDelayedOutput(s2))
+
+    def getStartStateBatch(self, k):
+        return (self.m1.getStartStateBatch(k), self.m2.getStartStateBatch(k))
+
+    def getNextValuesBatch(self, states, inps):
+        (s1, s2) = states
+        (newS1, o1) = self.m1.getNextValuesBatch(s1, inps)
+        (newS2, o2) = self.m2.getNextValuesBatch(s2, inps)
+        return ((newS1, newS2), zip(toList(o1), toList(o2)))
+
+    def getDelayedOutputBatch(self, states):
+        (s1, s2) = states
+        return zip(toList(self.m1.getDelayedOutputBatch(s1)),
+                   toList(self.m2.getDelayedOutputBatch(s2)))
+
     def done(self, state):
         (s1, s2) = state
         return self.m1.done(s1) or self.m2.done(s2)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            (o1, o2) = out
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name
-            self.m1.printDebugInfo(depth + 4, s1, ns1, inp, o1, debugParams)
-            self.m2.printDebugInfo(depth + 4, s2, ns2, inp, o2, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, Parallel) or \
+               self.m1.canTerminate() or self.m2.canTerminate()
 
+    def subMachines(self):
+        return [self.m1, self.m2]
+
+    def doneBatch(self, states):
+        (s1, s2) = states
+        return orLanes(self.m1.doneBatch(s1), self.m2.doneBatch(s2))
+
+    def stateToRecord(self, state):
+        return partRecords([self.m1, self.m2], state)
+
+    def recordToState(self, record):
+        return partStates([self.m1, self.m2], record)
+
+    def stepInPlace(self, record, inp):
+        o1 = self.m1.stepInPlace(record[0], inp)
+        o2 = self.m2.stepInPlace(record[1], inp)
+        return (o1, o2)
+
+    def getDelayedOutputInPlace(self, record):
+        return (self.m1.getDelayedOutputInPlace(record[0]),
+                self.m2.getDelayedOutputInPlace(record[1]))
 
 class Feedback (SM):
     """
@@ -416,6 +1078,7 @@ class Feedback (SM):
         if not ((name is None or isinstance(name, str)) and isinstance(m, SM)):
             raise Exception, 'Feedback takes one machine argument and an optional name argument'
         self.name = name
+        self.dependsOnInput = False
 
     def startState(self):
         return self.m.getStartState()
@@ -424,6 +1087,12 @@ class Feedback (SM):
         """
         Ignores input.
         """
+        if self.m.dependsOnInput is False:
+            # The machine declares a delay, so we can get the output
+            # without an input, and only need a single real step
+            o = self.m.getDelayedOutput(state)
+            (newS, ignore) = self.m.getNextValues(state, o)
+            return (newS, o)
         # Will only compute output
         (ignore, o) = self.m.getNextValues(state, 'undefined')
         assert o != 'undefined', 'Error in feedback; machine has no delay'
@@ -431,17 +1100,72 @@ class Feedback (SM):
         (newS, ignore) = self.m.getNextValues(state, o)
         return (newS, o)
 
+    def getNextValuesTraced(self, state, inp):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutput(state)
+        else:
+            (ignore, o) = self.m.getNextValues(state, 'undefined')
+            assert o != 'undefined', 'Error in feedback; machine has no delay'
+        (newS, ignore, t) = self.m.getNextValuesTraced(state, o)
+        return (newS, o, StepTrace(self, state, newS, inp, o, [t]))
+
+    def getDelayedOutput(self, state):
+        if self.m.dependsOnInput is False:
+            return self.m.getDelayedOutput(state)
+        return SM.getDelayedOutput(self, state)
+
+    def getStartStateBatch(self, k):
+        if self.m.dependsOnInput is False:
+            return self.m.getStartStateBatch(k)
+        return SM.getStartStateBatch(self, k)
+
+    def getNextValuesBatch(self, states, inps):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutputBatch(states)
+            (newS, ignore) = self.m.getNextValuesBatch(states, o)
+            return (newS, o)
+        return SM.getNextValuesBatch(self, states, inps)
+
+    def getDelayedOutputBatch(self, states):
+        if self.m.dependsOnInput is False:
+            return self.m.getDelayedOutputBatch(states)
+        return SM.getDelayedOutputBatch(self, states)
+
     def done(self, state):
         return self.m.done(state)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        (machineState, lastOutput) = self.getNextValues(state, inp)
-        self.guaranteeName()
-        if debugParams.verbose and not debugParams.compact:
-            print ' '*depth, self.name
-        self.m.printDebugInfo(depth + 4, state, nextState,
-                              lastOutput, out, debugParams)
-        self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, Feedback) or self.m.canTerminate()
+
+    def subMachines(self):
+        return [self.m]
+
+    def doneBatch(self, states):
+        if self.m.dependsOnInput is False:
+            return self.m.doneBatch(states)
+        return SM.doneBatch(self, states)
+
+    def stateToRecord(self, state):
+        return self.m.stateToRecord(state)
+
+    def recordToState(self, record):
+        return self.m.recordToState(record)
+
+    def stepInPlace(self, record, inp):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutputInPlace(record)
+        else:
+            # Probe with a copy of the state, which is left alone
+            (ignore, o) = self.m.getNextValues(self.m.recordToState(record),
+                                               'undefined')
+            assert o != 'undefined', 'Error in feedback; machine has no delay'
+        self.m.stepInPlace(record, o)
+        return o
+
+    def getDelayedOutputInPlace(self, record):
+        if self.m.dependsOnInput is False:
+            return self.m.getDelayedOutputInPlace(record)
+        return SM.getDelayedOutputInPlace(self, record)
 
 def coupledMachine(m1, m2):
     """
@@ -460,7 +1184,16 @@ class Feedback2 (Feedback):
     second inp.  Result is a machine with a single inp and single
     output.  
     """
+    def __init__(self, m, name = None):
+        Feedback.__init__(self, m, name)
+        # The output can depend on the first input without a delay
+        self.dependsOnInput = m.dependsOnInput
+
     def getNextValues(self, state, inp):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutput(state)
+            (newS, ignore) = self.m.getNextValues(state, (inp, o))
+            return (newS, o)
         # Will only compute output
         (ignore, o) = self.m.getNextValues(state, (inp, 'undefined'))
         assert o != 'undefined', 'Error in feedback; machine has no delay'
@@ -468,15 +1201,32 @@ class Feedback2 (Feedback):
         (newS, ignore) = self.m.getNextValues(state, (inp, o))
         return (newS, o)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        (machineState, lastOutput) = self.getNextValues(state,
-                                                        (inp, 'undefined'))
-        self.guaranteeName()
-        if debugParams.verbose and not debugParams.compact:
-            print ' '*depth, self.name
-        self.m.printDebugInfo(depth + 4, state, nextState,
-                              (inp, lastOutput), out, debugParams)
-        self.doTraceTasks(inp, state, out, debugParams)
+    def getNextValuesTraced(self, state, inp):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutput(state)
+        else:
+            (ignore, o) = self.m.getNextValues(state, (inp, 'undefined'))
+            assert o != 'undefined', 'Error in feedback; machine has no delay'
+        (newS, ignore, t) = self.m.getNextValuesTraced(state, (inp, o))
+        return (newS, o, StepTrace(self, state, newS, inp, o, [t]))
+
+    def getNextValuesBatch(self, states, inps):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutputBatch(states)
+            (newS, ignore) = self.m.getNextValuesBatch(states,
+                                                zip(toList(inps), toList(o)))
+            return (newS, o)
+        return SM.getNextValuesBatch(self, states, inps)
+
+    def stepInPlace(self, record, inp):
+        if self.m.dependsOnInput is False:
+            o = self.m.getDelayedOutputInPlace(record)
+        else:
+            (ignore, o) = self.m.getNextValues(self.m.recordToState(record),
+                                               (inp, 'undefined'))
+            assert o != 'undefined', 'Error in feedback; machine has no delay'
+        self.m.stepInPlace(record, (inp, o))
+        return o
 
 class FeedbackAdd(SM):
     """
@@ -491,6 +1241,7 @@ class FeedbackAdd(SM):
         if not ((name is None or isinstance(name, str)) and isinstance(m1, SM) and isinstance(m2, SM)):
             raise Exception, 'FeedbackAdd takes two machine arguments and an optional name argument'
         self.name = name
+        self.dependsOnInput = m1.dependsOnInput
 
     def startState(self):
         # Start state is product of start states of the two machines
@@ -498,6 +1249,19 @@ class FeedbackAdd(SM):
         
     def getNextValues(self, state, inp):
         (s1, s2) = state
+        # If one of the machines declares a delay, we can get its
+        # output without knowing its input, and go around the loop once
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutput(s2)
+            (newS1, output) = self.m1.getNextValues(s1, safeAdd(inp, o2))
+            (newS2, ignore) = self.m2.getNextValues(s2, output)
+            return ((newS1, newS2), output)
+        if self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutput(s1)
+            (newS2, o2) = self.m2.getNextValues(s2, o1)
+            (newS1, output) = self.m1.getNextValues(s1, safeAdd(inp, o2))
+            return ((newS1, newS2), output)
+
         # All this craziness is to deal with the fact that either m1
         # or m2 might have immediate dependence on the input.  If both
         # do, then it's an error.
@@ -511,25 +1275,103 @@ class FeedbackAdd(SM):
         (newS2, o2) = self.m2.getNextValues(s2, output)
         return ((newS1, newS2), output)
 
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutput(s2)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, safeAdd(inp, o2))
+            (newS2, ignore, t2) = self.m2.getNextValuesTraced(s2, output)
+        elif self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutput(s1)
+            (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, o1)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, safeAdd(inp, o2))
+        else:
+            # Probe, as in getNextValues, then trace the real steps
+            (ignore, o1) = self.m1.getNextValues(s1, 99999999)
+            (ignore, o2) = self.m2.getNextValues(s2, o1)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, safeAdd(inp, o2))
+            (newS2, ignore, t2) = self.m2.getNextValuesTraced(s2, output)
+        newState = (newS1, newS2)
+        return (newState, output,
+                StepTrace(self, state, newState, inp, output, [t1, t2]))
+
+    def getDelayedOutput(self, state):
+        (s1, s2) = state
+        return self.m1.getDelayedOutput(s1)
+
+    def getStartStateBatch(self, k):
+        if self.m1.dependsOnInput is False or \
+               self.m2.dependsOnInput is False:
+            return (self.m1.getStartStateBatch(k),
+                    self.m2.getStartStateBatch(k))
+        return SM.getStartStateBatch(self, k)
+
+    def getNextValuesBatch(self, states, inps):
+        if self.m2.dependsOnInput is False:
+            (s1, s2) = states
+            o2 = self.m2.getDelayedOutputBatch(s2)
+            (newS1, output) = self.m1.getNextValuesBatch(s1,
+                                            combineLanes(safeAdd, inps, o2))
+            (newS2, ignore) = self.m2.getNextValuesBatch(s2, output)
+            return ((newS1, newS2), output)
+        if self.m1.dependsOnInput is False:
+            (s1, s2) = states
+            o1 = self.m1.getDelayedOutputBatch(s1)
+            (newS2, o2) = self.m2.getNextValuesBatch(s2, o1)
+            (newS1, output) = self.m1.getNextValuesBatch(s1,
+                                            combineLanes(safeAdd, inps, o2))
+            return ((newS1, newS2), output)
+        return SM.getNextValuesBatch(self, states, inps)
+
+    def getDelayedOutputBatch(self, states):
+        (s1, s2) = states
+        return self.m1.getDelayedOutputBatch(s1)
+
     def done(self, state):
         (s1, s2) = state
         return self.m1.done(s1) or self.m2.done(s2)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name
-            # Only way to do this right is to call machines again
-            (ignore, o1) = self.m1.getNextValues(s1, inp)
-            (ignore, o2) = self.m2.getNextValues(s2, o1)
-            (ignore, o1) = self.m1.getNextValues(s1, inp+o2)
-            self.m1.printDebugInfo(depth + 4, s1, ns1, inp+o2, o1, debugParams)
-            self.m2.printDebugInfo(depth + 4, s2, ns2, o1, o2, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
-
+    def canTerminate(self):
+        return overridesDone(self, FeedbackAdd) or \
+               self.m1.canTerminate() or self.m2.canTerminate()
+
+    def subMachines(self):
+        return [self.m1, self.m2]
+
+    def doneBatch(self, states):
+        if self.m1.dependsOnInput is False or \
+               self.m2.dependsOnInput is False:
+            (s1, s2) = states
+            return orLanes(self.m1.doneBatch(s1), self.m2.doneBatch(s2))
+        return SM.doneBatch(self, states)
+
+    def stateToRecord(self, state):
+        return partRecords([self.m1, self.m2], state)
+
+    def recordToState(self, record):
+        return partStates([self.m1, self.m2], record)
+
+    def stepInPlace(self, record, inp):
+        (r1, r2) = record
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutputInPlace(r2)
+            output = self.m1.stepInPlace(r1, safeAdd(inp, o2))
+            self.m2.stepInPlace(r2, output)
+            return output
+        if self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutputInPlace(r1)
+            o2 = self.m2.stepInPlace(r2, o1)
+            return self.m1.stepInPlace(r1, safeAdd(inp, o2))
+        # Probe with copies of the states, as in getNextValues
+        (ignore, o1) = self.m1.getNextValues(self.m1.recordToState(r1),
+                                             99999999)
+        (ignore, o2) = self.m2.getNextValues(self.m2.recordToState(r2), o1)
+        output = self.m1.stepInPlace(r1, safeAdd(inp, o2))
+        self.m2.stepInPlace(r2, output)
+        return output
+
+    def getDelayedOutputInPlace(self, record):
+        return self.m1.getDelayedOutputInPlace(record[0])
 
 class FeedbackSubtract(SM):
     """
@@ -545,6 +1387,7 @@ class FeedbackSubtract(SM):
         if not ((name is None or isinstance(name, str)) and isinstance(m1, SM) and isinstance(m2, SM)):
             raise Exception, 'FeedbackSubtract takes two machine arguments and an optional name argument'
         self.name = name
+        self.dependsOnInput = m1.dependsOnInput
 
     def startState(self):
         # Start state is product of start states of the two machines
@@ -552,6 +1395,19 @@ class FeedbackSubtract(SM):
         
     def getNextValues(self, state, inp):
         (s1, s2) = state
+        # If one of the machines declares a delay, we can get its
+        # output without knowing its input, and go around the loop once
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutput(s2)
+            (newS1, output) = self.m1.getNextValues(s1, inp - o2)
+            (newS2, ignore) = self.m2.getNextValues(s2, output)
+            return ((newS1, newS2), output)
+        if self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutput(s1)
+            (newS2, o2) = self.m2.getNextValues(s2, o1)
+            (newS1, output) = self.m1.getNextValues(s1, inp - o2)
+            return ((newS1, newS2), output)
+
         # All this craziness is to deal with the fact that either m1
         # or m2 might have immediate dependence on the input.  If both
         # do, then it's an error.
@@ -565,26 +1421,103 @@ class FeedbackSubtract(SM):
         (newS2, o2) = self.m2.getNextValues(s2, output)
         return ((newS1, newS2), output)
 
-    def done(self, state):
+    def getNextValuesTraced(self, state, inp):
         (s1, s2) = state
-        return self.m1.done(s1) or self.m2.done(s2)
-
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name
-            # Only way to do this right is to call machines again
-            (ignore, o1) = self.m1.getNextValues(s1, inp)
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutput(s2)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, inp - o2)
+            (newS2, ignore, t2) = self.m2.getNextValuesTraced(s2, output)
+        elif self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutput(s1)
+            (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, o1)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, inp - o2)
+        else:
+            # Probe, as in getNextValues, then trace the real steps
+            (ignore, o1) = self.m1.getNextValues(s1, 99999999)
             (ignore, o2) = self.m2.getNextValues(s2, o1)
-            (ignore, o1) = self.m1.getNextValues(s1, inp - o2)
-            self.m1.printDebugInfo(depth + 4, s1, ns1, inp-o2, o1, debugParams)
-            self.m2.printDebugInfo(depth + 4, s2, ns2, o1, o2, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+            (newS1, output, t1) = self.m1.getNextValuesTraced(s1, inp - o2)
+            (newS2, ignore, t2) = self.m2.getNextValuesTraced(s2, output)
+        newState = (newS1, newS2)
+        return (newState, output,
+                StepTrace(self, state, newState, inp, output, [t1, t2]))
 
+    def getDelayedOutput(self, state):
+        (s1, s2) = state
+        return self.m1.getDelayedOutput(s1)
+
+    def getStartStateBatch(self, k):
+        if self.m1.dependsOnInput is False or \
+               self.m2.dependsOnInput is False:
+            return (self.m1.getStartStateBatch(k),
+                    self.m2.getStartStateBatch(k))
+        return SM.getStartStateBatch(self, k)
+
+    def getNextValuesBatch(self, states, inps):
+        if self.m2.dependsOnInput is False:
+            (s1, s2) = states
+            o2 = self.m2.getDelayedOutputBatch(s2)
+            (newS1, output) = self.m1.getNextValuesBatch(s1,
+                                            combineLanes(operator.sub, inps, o2))
+            (newS2, ignore) = self.m2.getNextValuesBatch(s2, output)
+            return ((newS1, newS2), output)
+        if self.m1.dependsOnInput is False:
+            (s1, s2) = states
+            o1 = self.m1.getDelayedOutputBatch(s1)
+            (newS2, o2) = self.m2.getNextValuesBatch(s2, o1)
+            (newS1, output) = self.m1.getNextValuesBatch(s1,
+                                            combineLanes(operator.sub, inps, o2))
+            return ((newS1, newS2), output)
+        return SM.getNextValuesBatch(self, states, inps)
+
+    def getDelayedOutputBatch(self, states):
+        (s1, s2) = states
+        return self.m1.getDelayedOutputBatch(s1)
+
+    def done(self, state):
+        (s1, s2) = state
+        return self.m1.done(s1) or self.m2.done(s2)
 
+    def canTerminate(self):
+        return overridesDone(self, FeedbackSubtract) or \
+               self.m1.canTerminate() or self.m2.canTerminate()
+
+    def subMachines(self):
+        return [self.m1, self.m2]
+
+    def doneBatch(self, states):
+        if self.m1.dependsOnInput is False or \
+               self.m2.dependsOnInput is False:
+            (s1, s2) = states
+            return orLanes(self.m1.doneBatch(s1), self.m2.doneBatch(s2))
+        return SM.doneBatch(self, states)
+
+    def stateToRecord(self, state):
+        return partRecords([self.m1, self.m2], state)
+
+    def recordToState(self, record):
+        return partStates([self.m1, self.m2], record)
+
+    def stepInPlace(self, record, inp):
+        (r1, r2) = record
+        if self.m2.dependsOnInput is False:
+            o2 = self.m2.getDelayedOutputInPlace(r2)
+            output = self.m1.stepInPlace(r1, inp - o2)
+            self.m2.stepInPlace(r2, output)
+            return output
+        if self.m1.dependsOnInput is False:
+            o1 = self.m1.getDelayedOutputInPlace(r1)
+            o2 = self.m2.stepInPlace(r2, o1)
+            return self.m1.stepInPlace(r1, inp - o2)
+        # Probe with copies of the states, as in getNextValues
+        (ignore, o1) = self.m1.getNextValues(self.m1.recordToState(r1),
+                                             99999999)
+        (ignore, o2) = self.m2.getNextValues(self.m2.recordToState(r2), o1)
+        output = self.m1.stepInPlace(r1, inp - o2)
+        self.m2.stepInPlace(r2, output)
+        return output
+
+    def getDelayedOutputInPlace(self, record):
+        return self.m1.getDelayedOutputInPlace(record[0])
 
 class Parallel2 (Parallel):
     """
@@ -606,19 +1539,29 @@ class Parallel2 (Parallel):
         (newS2, o2) = self.m2.getNextValues(s2, i2)
         return ((newS1, newS2), (o1, o2))
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            (i1, i2) = splitValue(inp)
-            (o1, o2) = out
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name
-            self.m1.printDebugInfo(depth + 4, s1, ns1, i1, o1, debugParams)
-            self.m2.printDebugInfo(depth + 4, s2, ns2, i2, o2, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
-
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        (i1, i2) = splitValue(inp)
+        (newS1, o1, t1) = self.m1.getNextValuesTraced(s1, i1)
+        (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, i2)
+        (newState, o) = ((newS1, newS2), (o1, o2))
+        return (newState, o,
+                StepTrace(self, state, newState, inp, o, [t1, t2]))
+
+    def getNextValuesBatch(self, states, inps):
+        (s1, s2) = states
+        pairs = [splitValue(v) for v in toList(inps)]
+        (newS1, o1) = self.m1.getNextValuesBatch(s1,
+                                        asLanes([p[0] for p in pairs]))
+        (newS2, o2) = self.m2.getNextValuesBatch(s2,
+                                        asLanes([p[1] for p in pairs]))
+        return ((newS1, newS2), zip(toList(o1), toList(o2)))
+
+    def stepInPlace(self, record, inp):
+        (i1, i2) = splitValue(inp)
+        o1 = self.m1.stepInPlace(record[0], i1)
+        o2 = self.m2.stepInPlace(record[1], i2)
+        return (o1, o2)
 
 class ParallelAdd (Parallel):
     """
@@ -631,77 +1574,360 @@ class ParallelAdd (Parallel):
         (newS2, o2) = self.m2.getNextValues(s2, inp)
         return ((newS1, newS2), o1 + o2)
 
-class If (SM):
-    """
-    Given a condition (function from inps to boolean) and two state
-    machines, make a new machine.  The condition is evaluated at start
-    time, and one machine is selected, permanently, for execution.
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        (newS1, o1, t1) = self.m1.getNextValuesTraced(s1, inp)
+        (newS2, o2, t2) = self.m2.getNextValuesTraced(s2, inp)
+        (newState, o) = ((newS1, newS2), o1 + o2)
+        return (newState, o,
+                StepTrace(self, state, newState, inp, o, [t1, t2]))
 
-    Rarely useful.
+    def getDelayedOutput(self, state):
+        (s1, s2) = state
+        return self.m1.getDelayedOutput(s1) + self.m2.getDelayedOutput(s2)
+
+    def getNextValuesBatch(self, states, inps):
+        (s1, s2) = states
+        (newS1, o1) = self.m1.getNextValuesBatch(s1, inps)
+        (newS2, o2) = self.m2.getNextValuesBatch(s2, inps)
+        return ((newS1, newS2), combineLanes(operator.add, o1, o2))
+
+    def getDelayedOutputBatch(self, states):
+        (s1, s2) = states
+        return combineLanes(operator.add,
+                            self.m1.getDelayedOutputBatch(s1),
+                            self.m2.getDelayedOutputBatch(s2))
+
+    def stepInPlace(self, record, inp):
+        o1 = self.m1.stepInPlace(record[0], inp)
+        o2 = self.m2.stepInPlace(record[1], inp)
+        return o1 + o2
+
+    def getDelayedOutputInPlace(self, record):
+        return self.m1.getDelayedOutputInPlace(record[0]) + \
+               self.m2.getDelayedOutputInPlace(record[1])
+
+class CascadeN (SM):
     """
-    startState = ('start', None)
-    
-    def __init__(self, condition, sm1, sm2, name = None):
+    Cascade composition of a list of state machines:  the output of
+    each is the input to the next.  Behaves like nested C{Cascade}s,
+    but its state is a flat tuple with one entry per machine, and a
+    step goes through the machines in a loop, so that long pipelines
+    don't build nested tuples or recurse once per stage.
+    """
+    def __init__(self, smList, name = None):
         """
-        @param condition: C{Procedure} mapping C{inp} -> C{Boolean}
-        @param sm1: C{SM}
-        @param sm2: C{SM}
+        @param smList: non-empty C{List} of C{SM}
         """
-        self.sm1 = sm1
-        self.sm2 = sm2
-        self.condition = condition
-        if not ((name is None or isinstance(name, str)) and isinstance(sm1, SM) and isinstance(sm2, SM)):
-            raise Exception, 'If takes a condition, two machine arguments and an optional name argument'
+        if not (name is None or isinstance(name, str)) or \
+               not isinstance(smList, (tuple, list)) or not smList or \
+               not all([isinstance(m, SM) for m in smList]):
+            raise Exception, 'CascadeN takes a list of machines and an optional name argument'
+        self.smList = list(smList)
         self.name = name
-        self.legalInputs = self.sm1.legalInputs
+        self.legalInputs = self.smList[0].legalInputs
+        self.dependsOnInput = allDepend([m.dependsOnInput for m in smList])
 
-    def getFirstRealState(self, inp):
-        # State is boolean indicating which machine is running, and its state
-        if self.condition(inp):
-            return ('runningM1', self.sm1.getStartState())
-        else:
-            return ('runningM2', self.sm2.getStartState())
+    def startState(self):
+        return tuple([m.getStartState() for m in self.smList])
 
     def getNextValues(self, state, inp):
-        (ifState, smState) = state
-        if ifState == 'start':
-            (ifState, smState) = self.getFirstRealState(inp)
-        
-        if ifState == 'runningM1':
-            (newS, o) = self.sm1.getNextValues(smState, inp)
-            return (('runningM1', newS), o)
-        else:
-            (newS, o) = self.sm2.getNextValues(smState, inp)
-            return (('runningM2', newS), o)
+        newState = []
+        o = inp
+        for (m, s) in zip(self.smList, state):
+            (newS, o) = m.getNextValues(s, o)
+            newState.append(newS)
+        return (tuple(newState), o)
+
+    def getNextValuesTraced(self, state, inp):
+        newState = []
+        traces = []
+        o = inp
+        for (m, s) in zip(self.smList, state):
+            (newS, o, t) = m.getNextValuesTraced(s, o)
+            newState.append(newS)
+            traces.append(t)
+        newState = tuple(newState)
+        return (newState, o, StepTrace(self, state, newState, inp, o, traces))
+
+    def lastDelay(self):
+        """
+        Internal use only.  Index of the last machine whose output
+        doesn't depend on its input without a delay, or 0 if there is
+        none;  the output of the cascade is found from that machine on.
+        """
+        for i in range(len(self.smList) - 1, -1, -1):
+            if self.smList[i].dependsOnInput is False:
+                return i
+        return 0
+
+    def getDelayedOutput(self, state):
+        i = self.lastDelay()
+        o = self.smList[i].getDelayedOutput(state[i])
+        for j in range(i + 1, len(self.smList)):
+            (ignore, o) = self.smList[j].getNextValues(state[j], o)
+        return o
+
+    def getStartStateBatch(self, k):
+        return tuple([m.getStartStateBatch(k) for m in self.smList])
+
+    def getNextValuesBatch(self, states, inps):
+        newStates = []
+        o = inps
+        for (m, s) in zip(self.smList, states):
+            (newS, o) = m.getNextValuesBatch(s, o)
+            newStates.append(newS)
+        return (tuple(newStates), o)
+
+    def getDelayedOutputBatch(self, states):
+        i = self.lastDelay()
+        o = self.smList[i].getDelayedOutputBatch(states[i])
+        for j in range(i + 1, len(self.smList)):
+            (ignore, o) = self.smList[j].getNextValuesBatch(states[j], o)
+        return o
 
     def done(self, state):
-        (ifState, smState) = state
-        if ifState == 'start':
-            return False
-        elif ifState == 'runningM1':
-            return self.sm1.done(smState)
-        else:
-            return self.sm2.done(smState)
+        for (m, s) in zip(self.smList, state):
+            if m.done(s):
+                return True
+        return False
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (ifState, smState) = state
-            (nifState, nsmState) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name, ifState
-            if ifState == 'runningM1':
-                self.sm1.printDebugInfo(depth + 4, smState, nsmState,
-                                        inp, out, debugParams)
-            elif ifState == 'runningM2':
-                self.sm2.printDebugInfo(depth + 4, smState, nsmState,
-                                        inp, out, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, CascadeN) or \
+               any([m.canTerminate() for m in self.smList])
 
-class Switch (SM):
-    """
-    Given a condition (function from inps to boolean) and two state
-    machines, make a new machine.  The condition is evaluated on every
+    def subMachines(self):
+        return list(self.smList)
+
+    def doneBatch(self, states):
+        result = None
+        for (m, s) in zip(self.smList, states):
+            result = orLanes(result, m.doneBatch(s))
+        return result
+
+    def stateToRecord(self, state):
+        return partRecords(self.smList, state)
+
+    def recordToState(self, record):
+        return partStates(self.smList, record)
+
+    def stepInPlace(self, record, inp):
+        o = inp
+        for (m, r) in zip(self.smList, record):
+            o = m.stepInPlace(r, o)
+        return o
+
+    def getDelayedOutputInPlace(self, record):
+        if self.lastDelay() == len(self.smList) - 1:
+            return self.smList[-1].getDelayedOutputInPlace(record[-1])
+        return SM.getDelayedOutputInPlace(self, record)
+
+class ParallelN (SM):
+    """
+    Takes a single inp and feeds it to a list of machines in parallel.
+    Output of the composite machine is the tuple of the outputs of the
+    individual machines.  Its state is a flat tuple with one entry per
+    machine, like that of C{CascadeN}.
+    """
+    def __init__(self, smList, name = None):
+        """
+        @param smList: non-empty C{List} of C{SM}
+        """
+        if not (name is None or isinstance(name, str)) or \
+               not isinstance(smList, (tuple, list)) or not smList or \
+               not all([isinstance(m, SM) for m in smList]):
+            raise Exception, self.__class__.__name__ + ' takes a list of machines and an optional name argument'
+        self.smList = list(smList)
+        self.name = name
+        # As for Parallel, the legal inputs of all the machines had
+        # better be the same
+        for m in self.smList[1:]:
+            assert set(m.legalInputs) == set(self.smList[0].legalInputs)
+        self.legalInputs = self.smList[0].legalInputs
+        self.dependsOnInput = anyDepends([m.dependsOnInput for m in smList])
+
+    def startState(self):
+        return tuple([m.getStartState() for m in self.smList])
+
+    def combine(self, outputs):
+        """
+        Output of the composite machine, given the list of the outputs
+        of the individual machines
+        """
+        return tuple(outputs)
+
+    def combineBatch(self, outputs):
+        """
+        Like C{combine}, for batches of outputs
+        """
+        return zip(*[toList(o) for o in outputs])
+
+    def getNextValues(self, state, inp):
+        newState = []
+        outputs = []
+        for (m, s) in zip(self.smList, state):
+            (newS, o) = m.getNextValues(s, inp)
+            newState.append(newS)
+            outputs.append(o)
+        return (tuple(newState), self.combine(outputs))
+
+    def getNextValuesTraced(self, state, inp):
+        newState = []
+        outputs = []
+        traces = []
+        for (m, s) in zip(self.smList, state):
+            (newS, o, t) = m.getNextValuesTraced(s, inp)
+            newState.append(newS)
+            outputs.append(o)
+            traces.append(t)
+        (newState, o) = (tuple(newState), self.combine(outputs))
+        return (newState, o, StepTrace(self, state, newState, inp, o, traces))
+
+    def getDelayedOutput(self, state):
+        return self.combine([m.getDelayedOutput(s) \
+                             for (m, s) in zip(self.smList, state)])
+
+    def getStartStateBatch(self, k):
+        return tuple([m.getStartStateBatch(k) for m in self.smList])
+
+    def getNextValuesBatch(self, states, inps):
+        newStates = []
+        outputs = []
+        for (m, s) in zip(self.smList, states):
+            (newS, o) = m.getNextValuesBatch(s, inps)
+            newStates.append(newS)
+            outputs.append(o)
+        return (tuple(newStates), self.combineBatch(outputs))
+
+    def getDelayedOutputBatch(self, states):
+        return self.combineBatch([m.getDelayedOutputBatch(s) \
+                                  for (m, s) in zip(self.smList, states)])
+
+    def done(self, state):
+        for (m, s) in zip(self.smList, state):
+            if m.done(s):
+                return True
+        return False
+
+    def canTerminate(self):
+        return overridesDone(self, ParallelN) or \
+               any([m.canTerminate() for m in self.smList])
+
+    def subMachines(self):
+        return list(self.smList)
+
+    def doneBatch(self, states):
+        result = None
+        for (m, s) in zip(self.smList, states):
+            result = orLanes(result, m.doneBatch(s))
+        return result
+
+    def stateToRecord(self, state):
+        return partRecords(self.smList, state)
+
+    def recordToState(self, record):
+        return partStates(self.smList, record)
+
+    def stepInPlace(self, record, inp):
+        return self.combine([m.stepInPlace(r, inp) \
+                             for (m, r) in zip(self.smList, record)])
+
+    def getDelayedOutputInPlace(self, record):
+        return self.combine([m.getDelayedOutputInPlace(r) \
+                             for (m, r) in zip(self.smList, record)])
+
+class ParallelAddN (ParallelN):
+    """
+    Like C{ParallelN}, but output is the sum of the outputs of the
+    machines.
+    """
+    def combine(self, outputs):
+        total = outputs[0]
+        for o in outputs[1:]:
+            total = total + o
+        return total
+
+    def combineBatch(self, outputs):
+        total = outputs[0]
+        for o in outputs[1:]:
+            total = combineLanes(operator.add, total, o)
+        return total
+
+class If (SM):
+    """
+    Given a condition (function from inps to boolean) and two state
+    machines, make a new machine.  The condition is evaluated at start
+    time, and one machine is selected, permanently, for execution.
+
+    Rarely useful.
+    """
+    startState = ('start', None)
+    
+    def __init__(self, condition, sm1, sm2, name = None):
+        """
+        @param condition: C{Procedure} mapping C{inp} -> C{Boolean}
+        @param sm1: C{SM}
+        @param sm2: C{SM}
+        """
+        self.sm1 = sm1
+        self.sm2 = sm2
+        self.condition = condition
+        if not ((name is None or isinstance(name, str)) and isinstance(sm1, SM) and isinstance(sm2, SM)):
+            raise Exception, 'If takes a condition, two machine arguments and an optional name argument'
+        self.name = name
+        self.legalInputs = self.sm1.legalInputs
+
+    def getFirstRealState(self, inp):
+        # State is boolean indicating which machine is running, and its state
+        if self.condition(inp):
+            return ('runningM1', self.sm1.getStartState())
+        else:
+            return ('runningM2', self.sm2.getStartState())
+
+    def getNextValues(self, state, inp):
+        (ifState, smState) = state
+        if ifState == 'start':
+            (ifState, smState) = self.getFirstRealState(inp)
+        
+        if ifState == 'runningM1':
+            (newS, o) = self.sm1.getNextValues(smState, inp)
+            return (('runningM1', newS), o)
+        else:
+            (newS, o) = self.sm2.getNextValues(smState, inp)
+            return (('runningM2', newS), o)
+
+    def getNextValuesTraced(self, state, inp):
+        (ifState, smState) = state
+        if ifState == 'start':
+            (ifState, smState) = self.getFirstRealState(inp)
+        if ifState == 'runningM1':
+            (newS, o, t) = self.sm1.getNextValuesTraced(smState, inp)
+        else:
+            (newS, o, t) = self.sm2.getNextValuesTraced(smState, inp)
+        newState = (ifState, newS)
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       (state[0],)))
+
+    def done(self, state):
+        (ifState, smState) = state
+        if ifState == 'start':
+            return False
+        elif ifState == 'runningM1':
+            return self.sm1.done(smState)
+        else:
+            return self.sm2.done(smState)
+
+    def canTerminate(self):
+        return overridesDone(self, If) or \
+               self.sm1.canTerminate() or self.sm2.canTerminate()
+
+    def subMachines(self):
+        return [self.sm1, self.sm2]
+
+class Switch (SM):
+    """
+    Given a condition (function from inps to boolean) and two state
+    machines, make a new machine.  The condition is evaluated on every
     step, and the selected machine is used to generate output and has
     its state updated.  If the condition is true, C{sm1} is used, and
     if it is false, C{sm2} is used.
@@ -732,26 +1958,27 @@ class Switch (SM):
             (ns2, o) = self.m2.getNextValues(s2, inp)
             return ((s1, ns2), o)
 
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        if self.condition(inp):
+            (ns1, o, t) = self.m1.getNextValuesTraced(s1, inp)
+            (newState, running) = ((ns1, s2), 'M1')
+        else:
+            (ns2, o, t) = self.m2.getNextValuesTraced(s2, inp)
+            (newState, running) = ((s1, ns2), 'M2')
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       ('Running', running)))
+
     def done(self, state):
         (s1, s2) = state
         return self.m1.done(s1) or self.m2.done(s2)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (s1, s2) = state
-            (ns1, ns2) = nextState
-            if self.condition(inp):
-                machineRunning = 'M1'
-            else:
-                machineRunning = 'M2'
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name, 'Running', machineRunning
-            if machineRunning == 'M1':
-                self.m1.printDebugInfo(depth + 4, s1, ns1, inp, out,debugParams)
-            else:
-                self.m2.printDebugInfo(depth + 4, s2, ns2, inp, out,debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, Switch) or \
+               self.m1.canTerminate() or self.m2.canTerminate()
+
+    def subMachines(self):
+        return [self.m1, self.m2]
 
 class Mux (Switch):
     """
@@ -769,6 +1996,18 @@ class Mux (Switch):
         else:
             return ((ns1, ns2), o2)
 
+    def getNextValuesTraced(self, state, inp):
+        (s1, s2) = state
+        (ns1, o1, t1) = self.m1.getNextValuesTraced(s1, inp)
+        (ns2, o2, t2) = self.m2.getNextValuesTraced(s2, inp)
+        if self.condition(inp):
+            (o, running) = (o1, 'M1')
+        else:
+            (o, running) = (o2, 'M2')
+        newState = (ns1, ns2)
+        return (newState, o, StepTrace(self, state, newState, inp, o,
+                                       [t1, t2], ('Running', running)))
+
 ######################################################################
 #    
 #    Terminating State Machines
@@ -791,6 +2030,7 @@ class Sequence (SM):
         self.n = len(smList)
         self.name = name
         self.legalInputs = self.smList[0].legalInputs
+        self.dependsOnInput = anyDepends([m.dependsOnInput for m in smList])
 
     def startState(self):
         return self.advanceIfDone(0, self.smList[0].getStartState())
@@ -815,23 +2055,33 @@ class Sequence (SM):
         (counter, smState) = self.advanceIfDone(counter, smState)
         return ((counter, smState), o)
 
+    def getNextValuesTraced(self, state, inp):
+        (counter, smState) = state
+        (smState, o, t) = self.smList[counter].getNextValuesTraced(smState,
+                                                                   inp)
+        newState = self.advanceIfDone(counter, smState)
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       ('Counter =', counter)))
+
+    def getDelayedOutput(self, state):
+        (counter, smState) = state
+        return self.smList[counter].getDelayedOutput(smState)
+
     def done(self, state):
         # This machine is done if its current machine is done
         (counter, smState) = state
         return self.smList[counter].done(smState)
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        # This condition is trying to guarantee that nextState has the
-        # right structure to be passed down recursively
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (counter, smState) = state
-            (ncounter, nsmState) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name, 'Counter =', counter
-            self.smList[counter].printDebugInfo(depth + 4, smState, nsmState,
-                                                inp, out, debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        if overridesDone(self, Sequence):
+            return True
+        for m in self.smList:
+            if m.canTerminate():
+                return True
+        return False
+
+    def subMachines(self):
+        return list(self.smList)
 
 class Repeat (SM):
     """
@@ -849,6 +2099,7 @@ class Repeat (SM):
             raise Exception, 'Repeast takes one machine argument, an integer, and an optional name argument'
         self.name = name
         self.legalInputs = self.sm.legalInputs
+        self.dependsOnInput = sm.dependsOnInput
 
     def startState(self):
         return self.advanceIfDone(0, self.sm.getStartState())
@@ -866,21 +2117,27 @@ class Repeat (SM):
         (counter, smState) = self.advanceIfDone(counter, smState)
         return ((counter, smState), o)
 
+    def getNextValuesTraced(self, state, inp):
+        (counter, smState) = state
+        (smState, o, t) = self.sm.getNextValuesTraced(smState, inp)
+        newState = self.advanceIfDone(counter, smState)
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       ('Counter =', counter)))
+
+    def getDelayedOutput(self, state):
+        (counter, smState) = state
+        return self.sm.getDelayedOutput(smState)
+
     # We're done if the termination condition is defined and met
     def done(self, state):
         (counter, smState) = state
         return not self.n == None and counter == self.n
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (counter, smState) = state
-            (ncounter, nsmState) = nextState
-            if debugParams.verbose and not debugParams.compact:        
-                print ' '*depth, self.name, 'Counter =', counter
-            self.sm.printDebugInfo(depth + 4, smState, nsmState, inp, out,
-                                   debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
+    def canTerminate(self):
+        return overridesDone(self, Repeat) or (not self.n == None)
+
+    def subMachines(self):
+        return [self.sm]
 
 class RepeatUntil (SM):
     """
@@ -900,6 +2157,7 @@ class RepeatUntil (SM):
             raise Exception, 'RepeatUntil takes a condition, a machine argument and an optional name argument'
         self.name = name
         self.legalInputs = self.sm.legalInputs
+        self.dependsOnInput = sm.dependsOnInput
 
     def startState(self):
         return (False, self.sm.getStartState())
@@ -916,23 +2174,32 @@ class RepeatUntil (SM):
             smState = self.sm.getStartState()
         return ((condTrue, smState), o)
 
+    def getNextValuesTraced(self, state, inp):
+        (condTrue, smState) = state
+        (smState, o, t) = self.sm.getNextValuesTraced(smState, inp)
+        newCondTrue = self.condition(inp)
+        if self.sm.done(smState) and not newCondTrue:
+            smState = self.sm.getStartState()
+        newState = (newCondTrue, smState)
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       ('Condition =', condTrue)))
+
+    def getDelayedOutput(self, state):
+        (condTrue, smState) = state
+        return self.sm.getDelayedOutput(smState)
+
     def done(self, state):
         # We're done if component machine is done and the termination
         # condition is true
         (condTrue, smState) = state
         return self.sm.done(smState) and condTrue
-    
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (condTrue, smState) = state
-            (ncondTrue, nsmState) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name, 'Condition =', condTrue
-            self.sm.printDebugInfo(depth + 4, smState, nsmState, inp, out,
-                                   debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
 
+    def canTerminate(self):
+        return overridesDone(self, RepeatUntil) or self.sm.canTerminate()
+
+    def subMachines(self):
+        return [self.sm]
+    
 class Until (SM):
     """
     Execute SM until it terminates or the condition becomes true.
@@ -949,6 +2216,7 @@ class Until (SM):
             raise Exception, 'Until takes a condition, a machine arguments and an optional name argument'
         self.name = name
         self.legalInputs = self.sm.legalInputs
+        self.dependsOnInput = sm.dependsOnInput
 
     def startState(self):
         return (False, self.sm.getStartState())
@@ -957,22 +2225,24 @@ class Until (SM):
         (condTrue, smState) = state
         (smState, o) = self.sm.getNextValues(smState, inp)
         return ((self.condition(inp), smState), o)
+
+    def getNextValuesTraced(self, state, inp):
+        (condTrue, smState) = state
+        (smState, o, t) = self.sm.getNextValuesTraced(smState, inp)
+        newState = (self.condition(inp), smState)
+        return (newState, o, StepTrace(self, state, newState, inp, o, [t],
+                                       ('Condition =', condTrue)))
+
+    def getDelayedOutput(self, state):
+        (condTrue, smState) = state
+        return self.sm.getDelayedOutput(smState)
     
     def done(self, state):
         (condTrue, smState) = state
         return self.sm.done(smState) or condTrue
 
-    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
-        if nextState and len(nextState) == 2:
-            self.guaranteeName()
-            (condTrue, smState) = state
-            (ncondTrue, nsmState) = nextState
-            if debugParams.verbose and not debugParams.compact:
-                print ' '*depth, self.name,'Condition =', condTrue
-            self.sm.printDebugInfo(depth + 4, smState, nsmState, inp, out,
-                                   debugParams)
-            self.doTraceTasks(inp, state, out, debugParams)
-        
+    def subMachines(self):
+        return [self.sm]
 
 #############################################################################
 ##   Utility stuff
@@ -990,17 +2260,578 @@ def splitValue(v, n = 2):
         assert len(v) == n, "Value wrong length"
         return v
 
+def allDepend(dependencies):
+    """
+    Combine the C{dependsOnInput} values of machines connected in
+    series:  the output depends on the input only if every machine
+    passes it through without a delay.
+    """
+    if False in dependencies:
+        return False
+    elif None in dependencies:
+        return None
+    else:
+        return True
+
+def anyDepends(dependencies):
+    """
+    Combine the C{dependsOnInput} values of machines that all see the
+    same input:  the output depends on the input if any of them does.
+    """
+    if True in dependencies:
+        return True
+    elif None in dependencies:
+        return None
+    else:
+        return False
+
+def isNumber(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+def isArray(v):
+    return numpy is not None and isinstance(v, numpy.ndarray)
+
+def asLanes(values):
+    """
+    Make a batch out of a list of values, one for each lane of
+    C{transduceBatch}:  a NumPy array if they are all floating point
+    numbers and NumPy is available, otherwise the list itself.
+    """
+    if numpy is not None and values:
+        try:
+            a = numpy.asarray(values)
+        except ValueError:
+            return values
+        if a.ndim == 1 and a.dtype.kind == 'f':
+            return a
+    return values
+
+def toList(batch):
+    """
+    List of the values in a batch of values
+    """
+    if isArray(batch):
+        return batch.tolist()
+    return batch
+
+def takeLanes(batch, keep):
+    """
+    Keep only some of the lanes of a batch of values or states.
+    @param keep: list of indices of the lanes to keep
+    """
+    if batch is None:
+        return None
+    elif isinstance(batch, tuple):
+        return tuple([takeLanes(b, keep) for b in batch])
+    elif isArray(batch):
+        return batch[keep]
+    else:
+        return [batch[j] for j in keep]
+
+def combineLanes(f, a, b):
+    """
+    Apply the binary function C{f} lane by lane to two batches
+    """
+    if isArray(a) and isArray(b):
+        # Arrays of numbers never hold 'undefined'
+        return unsafe.get(f, f)(a, b)
+    return asLanes(map(f, toList(a), toList(b)))
+
+def orLanes(done1, done2):
+    """
+    Combine two results of C{doneBatch}
+    """
+    if done1 is None:
+        return done2
+    elif done2 is None:
+        return done1
+    return [d1 or d2 for (d1, d2) in zip(done1, done2)]
+
+def findCycle(m, n):
+    """
+    Used by C{SM.runPeriodic}.  Brent's algorithm, on the sequence of
+    states of C{m} with input C{None}:  the hare takes steps, recording
+    the outputs, and the tortoise jumps to the hare after 1, 2, 4, ...
+    steps, until the hare meets it.  The distance between them is then
+    the period C{lam};  the length C{mu} of the part before the cycle
+    is found by running two states C{lam} steps apart from the start
+    until they meet, without recording anything.
+    @return: pair of the outputs before the cycle and the outputs of one
+          period, or the outputs of the whole run (at most C{n} steps)
+          and C{[]} if no state repeats before it ends
+    """
+    f = m.getNextValues
+    outs = []
+    start = m.getStartState()
+    tortoise = start
+    hare = start
+    power = lam = 1
+    while True:
+        if (n is not None and len(outs) == n) or m.done(hare):
+            return (outs, [])
+        (hare, o) = f(hare, None)
+        outs.append(o)
+        if tortoise == hare:
+            break
+        if power == lam:
+            tortoise = hare
+            power *= 2
+            lam = 0
+        lam += 1
+    # The cycle starts at the first mu such that state mu equals state
+    # mu + lam;  the recorded outputs cover both
+    tortoise = start
+    hare = start
+    for i in range(lam):
+        (hare, o) = f(hare, None)
+    mu = 0
+    while tortoise != hare:
+        (tortoise, o) = f(tortoise, None)
+        (hare, o) = f(hare, None)
+        mu += 1
+    return (outs[:mu], outs[mu:mu + lam])
+
+class PeriodicSequence:
+    """
+    Sequence made of a list of outputs followed by a cycle of outputs
+    repeated forever, or up to a total length.  Its elements are
+    computed when they are asked for.
+    """
+    def __init__(self, prefix, cycle, length = None):
+        """
+        @param prefix: list of the first elements
+        @param cycle: list of the elements that repeat after C{prefix};
+              if empty, C{length} must be C{len(prefix)}
+        @param length: total number of elements;  C{None} for an
+              infinite sequence
+        """
+        self.prefix = prefix
+        self.cycle = cycle
+        self.length = length
+
+    def __len__(self):
+        if self.length is None:
+            raise Exception, 'Infinite sequence has no length'
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if self.length is None and (i.stop is None or i.stop < 0):
+                raise Exception, 'Slice of an infinite sequence must end'
+            if self.length is not None:
+                (start, stop, stride) = i.indices(self.length)
+            else:
+                (start, stop, stride) = (i.start or 0, i.stop, i.step or 1)
+            return [self[k] for k in xrange(start, stop, stride)]
+        if i < 0 and self.length is not None:
+            i += self.length
+        if i < 0 or (self.length is not None and i >= self.length):
+            raise IndexError, 'PeriodicSequence index out of range'
+        if i < len(self.prefix):
+            return self.prefix[i]
+        return self.cycle[(i - len(self.prefix)) % len(self.cycle)]
+
+    def __iter__(self):
+        elements = itertools.chain(self.prefix,
+                                   itertools.cycle(self.cycle))
+        if self.length is None:
+            return elements
+        return itertools.islice(elements, self.length)
+
+    def __repr__(self):
+        return 'PeriodicSequence(%s, %s, %s)' % \
+               (self.prefix, self.cycle, self.length)
+
+    def tolist(self):
+        return list(self)
+
+class SteadyStateSequence(PeriodicSequence):
+    """
+    Outputs of C{SM.runSteady}:  the outputs up to the step where the
+    machine settled, followed by the last of them, repeated
+    """
+    def __init__(self, prefix, cycle, length, convergedAt):
+        PeriodicSequence.__init__(self, prefix, cycle, length)
+        self.convergedAt = convergedAt
+        """Number of steps taken before the machine settled, or C{None}"""
+
+def change(a, b):
+    """
+    Largest difference between the numbers in C{a} and C{b}, which may
+    be tuples or lists of numbers;  infinite if C{a} and C{b} differ in
+    any other way
+    """
+    if isNumber(a) and isNumber(b):
+        return abs(a - b)
+    elif isinstance(a, (tuple, list)) and isinstance(b, (tuple, list)) \
+             and len(a) == len(b):
+        return max([change(x, y) for (x, y) in zip(a, b)] or [0])
+    elif a == b:
+        return 0
+    else:
+        return float('inf')
+
+class StepTrace:
+    """
+    Record of one step of a machine, made by C{getNextValuesTraced}
+    while the step is computed:  the state, next state, input and
+    output of the machine, and the records of the steps of its
+    sub-machines.
+    """
+    def __init__(self, machine, state, nextState, inp, out, parts = None,
+                 label = ()):
+        """
+        @param parts: list of C{StepTrace} for the sub-machines, or
+              C{None} for a machine that is printed as a primitive
+        @param label: extra values to print after the name of a
+              composite machine
+        """
+        self.machine = machine
+        self.state = state
+        self.nextState = nextState
+        self.inp = inp
+        self.out = out
+        self.parts = parts
+        self.label = label
+
+    def printDebugInfo(self, depth, debugParams):
+        """
+        Print the recorded step, and do the trace tasks, for this
+        machine and all of its sub-machines.  Machines with no traced
+        machine inside them are skipped when nothing is being printed.
+        """
+        m = self.machine
+        if id(m) in debugParams.quiet:
+            return
+        if self.parts is None:
+            m.printDebugInfo(depth, self.state, self.nextState, self.inp,
+                             self.out, debugParams)
+            return
+        m.guaranteeName()
+        if debugParams.verbose and not debugParams.compact:
+            print ' '.join([' '*depth, str(m.name)] + \
+                           [str(x) for x in self.label])
+        for part in self.parts:
+            part.printDebugInfo(depth + 4, debugParams)
+        m.doTraceTasks(self.inp, self.state, self.out, debugParams)
+
 class DebugParams:
     """
     Housekeeping stuff
     """
-    def __init__(self, traceTasks, verbose, compact, printInput):
+    def __init__(self, traceTasks, verbose, compact, printInput,
+                 recorder = None):
         self.traceTasks = traceTasks
         self.verbose = verbose
         self.compact = compact
         self.printInput = printInput
-        self.doDebugging = verbose or len(traceTasks) > 0
+        self.recorder = recorder
+        self.doDebugging = verbose or len(traceTasks) > 0 or \
+                           recorder is not None
         self.k = 0
+        self.tasks = {}
+        """Trace tasks for each machine name:  lists of C{(mode, fun)}"""
+        self.quiet = set()
+        """C{id}s of the machines whose steps don't need to be visited"""
+
+    def resolve(self, machine):
+        """
+        Called by C{start}.  Makes the table of trace tasks for each
+        machine name.  Unless every machine has to be visited, for
+        printing or for a recorder of all machines, also names all of
+        the machines in C{machine} and finds the ones that have no
+        traced machine inside them.
+        """
+        self.tasks = {}
+        for (name, mode, fun) in self.traceTasks:
+            self.tasks.setdefault(name, []).append((mode, fun))
+        self.quiet = set()
+        if not (self.verbose or (self.recorder is not None and \
+                                 self.recorder.names is None)):
+            traced = set(self.tasks)
+            if self.recorder is not None:
+                traced.update(self.recorder.names)
+            self.findQuiet(machine, traced)
+
+    def findQuiet(self, m, traced):
+        """
+        Internal use only.  Names C{m} and the machines inside it, and
+        adds the ones with no name in C{traced} to C{self.quiet}.  A
+        machine that may visit machines it doesn't list in
+        C{subMachines} is never quiet (see C{isOpaque}).
+        @return: whether C{m} is quiet
+        """
+        m.guaranteeName()
+        quiet = m.name not in traced
+        subs = m.subMachines()
+        if isOpaque(m, subs):
+            quiet = False
+        for sub in subs:
+            quiet = self.findQuiet(sub, traced) and quiet
+        if quiet:
+            self.quiet.add(id(m))
+        return quiet
+
+def isOpaque(m, subs):
+    """
+    Might C{m} print or trace machines that are not among C{subs}, the
+    machines it lists in C{subMachines}?  Yes if its class defines its
+    own C{printDebugInfo}, or its own C{getNextValuesTraced} without
+    listing any sub-machines, or if it keeps a machine that it doesn't
+    list in one of its attributes.
+    """
+    c = m.__class__
+    if c.printDebugInfo.im_func is not SM.printDebugInfo.im_func:
+        return True
+    if not subs and hasOwnTrace(m):
+        return True
+    listed = set([id(sub) for sub in subs])
+    for x in heldMachines(m):
+        if id(x) not in listed:
+            return True
+    return False
+
+def heldMachines(m):
+    """
+    List of the machines kept in the attributes of C{m}, on their own
+    or in a list or tuple
+    """
+    result = []
+    for v in m.__dict__.values():
+        if not isinstance(v, (list, tuple)):
+            v = [v]
+        for x in v:
+            if isinstance(x, SM):
+                result.append(x)
+    return result
+
+def nameAll(m, seen = None):
+    """
+    Call C{guaranteeName} on C{m} and on all the machines inside it,
+    including ones it keeps without listing them in C{subMachines}
+    """
+    if seen is None:
+        seen = set()
+    if id(m) in seen:
+        return
+    seen.add(id(m))
+    m.guaranteeName()
+    for sub in list(m.subMachines()) + heldMachines(m):
+        nameAll(sub, seen)
+
+def hasOwnTrace(m):
+    """
+    Does the class of C{m} define its own C{getNextValuesTraced}?
+    """
+    return m.__class__.getNextValuesTraced.im_func is not \
+           SM.getNextValuesTraced.im_func
+
+timer = timeit.default_timer
+
+class ProfileEntry:
+    """
+    Statistics collected by a C{Profiler} for one machine, reached by
+    the C{path} of machine names from the top-level machine
+    """
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+        self.cumulative = 0.0
+        """Time spent in the machine, including its sub-machines"""
+        self.childTime = 0.0
+        """Time spent in its sub-machines"""
+        self.state = None
+        """Most recent next state"""
+
+    def selfTime(self):
+        """
+        Time spent in the machine itself, not counting its sub-machines
+        """
+        return self.cumulative - self.childTime
+
+    def stateSize(self):
+        """
+        Number of bytes taken up by the most recent state
+        """
+        return deepSize(self.state, set())
+
+class Profiler:
+    """
+    Times the steps of a machine and of every machine inside it.  Pass
+    it to C{start}, C{transduce}, C{run} or C{transduceF} as the
+    C{profiler} argument, then call C{report} or C{writeFolded}.
+    While it is running, the C{getNextValues} method of each machine
+    is replaced by one that does the timing;  when no profiler is
+    given, the machines run exactly as they would otherwise.
+
+    Time spent in a machine is kept separately for each path through
+    which it is reached, so a machine that is called from two places
+    gets two entries.
+    """
+    sortKeys = {'self': lambda e: e.selfTime(),
+                'cumulative': lambda e: e.cumulative,
+                'calls': lambda e: e.calls,
+                'state': lambda e: e.stateSize()}
+
+    def __init__(self):
+        self.entries = {}
+        """C{ProfileEntry} for each path"""
+        self.active = []
+        """Entries of the machines whose steps are being computed"""
+        self.wrapped = []
+        """C{(machine, methodName, saved instance attribute)} to undo"""
+        self.machines = set()
+
+    def install(self, m):
+        """
+        Called by C{start}.  Puts timing wrappers on C{m} and all of
+        the machines inside it.
+        """
+        m.guaranteeName()
+        if id(m) not in self.machines:
+            self.machines.add(id(m))
+            self.wrap(m, 'getNextValues')
+            # Compositions that record the steps of their sub-machines
+            # don't go through their own getNextValues when debugging
+            if m.subMachines() and hasOwnTrace(m):
+                self.wrap(m, 'getNextValuesTraced')
+        for sub in m.subMachines():
+            self.install(sub)
+
+    def wrap(self, m, methodName):
+        """
+        Internal use only.  Replace method C{methodName} of C{m} with a
+        version that does the timing.
+        """
+        original = getattr(m, methodName)
+        name = m.name
+        entries = self.entries
+        active = self.active
+        def profiled(state, inp):
+            if active:
+                path = active[-1].path + (name,)
+            else:
+                path = (name,)
+            entry = entries.get(path)
+            if entry is None:
+                entry = entries[path] = ProfileEntry(path)
+            active.append(entry)
+            start = timer()
+            try:
+                result = original(state, inp)
+            finally:
+                elapsed = timer() - start
+                active.pop()
+            entry.calls += 1
+            entry.cumulative += elapsed
+            entry.state = result[0]
+            if active:
+                active[-1].childTime += elapsed
+            return result
+        self.wrapped.append((m, methodName, m.__dict__.get(methodName)))
+        setattr(m, methodName, profiled)
+
+    def stop(self):
+        """
+        Take the timing wrappers off the machines.  The statistics
+        collected so far are kept.
+        """
+        for (m, methodName, saved) in self.wrapped:
+            if saved is None:
+                del m.__dict__[methodName]
+            else:
+                setattr(m, methodName, saved)
+        self.wrapped = []
+        self.machines = set()
+        self.active = []
+
+    def report(self, sortBy = 'self', limit = None):
+        """
+        Print a table with a line for each machine:  the number of
+        calls, the cumulative time, the time spent in the machine
+        itself, the cumulative time per call (all in seconds), and the
+        number of bytes taken up by its state.
+        @param sortBy: one of C{'self'}, C{'cumulative'}, C{'calls'}
+              or C{'state'};  the largest come first
+        @param limit: maximum number of lines to print
+        """
+        if sortBy not in self.sortKeys:
+            raise Exception, \
+                  'Profiles can be sorted by self, cumulative, calls or state'
+        entries = sorted(self.entries.values(), key = self.sortKeys[sortBy],
+                         reverse = True)
+        print '%9s %11s %11s %11s %8s  %s' % \
+              ('calls', 'cumulative', 'self', 'per call', 'state', 'machine')
+        for e in entries[:limit]:
+            print '%9d %11.6f %11.6f %11.8f %8d  %s' % \
+                  (e.calls, e.cumulative, e.selfTime(),
+                   e.cumulative / max(e.calls, 1), e.stateSize(),
+                   '/'.join(e.path))
+
+    def writeFolded(self, filename):
+        """
+        Write the profile in the folded format read by flame graph
+        tools:  one line for each machine, with the path of machine
+        names separated by semicolons, and the time spent in the
+        machine itself, in microseconds.
+        """
+        f = open(filename, 'w')
+        try:
+            for e in sorted(self.entries.values(), key = lambda e: e.path):
+                f.write('%s %d\n' % (';'.join(e.path),
+                                     int(round(e.selfTime() * 1e6))))
+        finally:
+            f.close()
+
+def deepSize(v, seen):
+    """
+    Number of bytes taken up by C{v}, including the tuples, lists and
+    dictionaries inside it
+    """
+    if id(v) in seen:
+        return 0
+    seen.add(id(v))
+    size = sys.getsizeof(v)
+    if isinstance(v, (tuple, list)):
+        for x in v:
+            size += deepSize(x, seen)
+    elif isinstance(v, dict):
+        for (k, x) in v.items():
+            size += deepSize(k, seen) + deepSize(x, seen)
+    return size
+
+def partRecords(machines, states):
+    """
+    Internal use only.  C{stateToRecord} for a composition whose state
+    is the tuple of the states of C{machines}:  the list of their
+    records, or C{None} if one of them has none.
+    """
+    record = []
+    for (m, s) in zip(machines, states):
+        r = m.stateToRecord(s)
+        if r is None:
+            return None
+        record.append(r)
+    return record
+
+def partStates(machines, record):
+    """
+    Internal use only.  Inverse of C{partRecords}
+    """
+    return tuple([m.recordToState(r) for (m, r) in zip(machines, record)])
+
+def valueRecord(self, state):
+    """
+    Internal use only.  C{stateToRecord} for primitive machines, whose
+    record is a list holding their state
+    """
+    return [state]
+
+def recordValue(self, record):
+    """
+    Internal use only.  C{recordToState} for primitive machines
+    """
+    return record[0]
 
 #############################################################################
 ##   Some very simple machines that are broadly useful
@@ -1010,6 +2841,7 @@ class Wire(SM):
     """
     Machine whose output is its input, with no delay
     """
+    dependsOnInput = True
     def getNextState(self, state, inp):
         return inp
 
@@ -1017,6 +2849,7 @@ class Constant(SM):
     """
     Machine whose output is a constant, independent of the input
     """
+    dependsOnInput = False
     def __init__(self, c):
         """
         @param c: constant value
@@ -1024,12 +2857,24 @@ class Constant(SM):
         self.c = c
     def getNextState(self, state, inp):
         return self.c
+    def getDelayedOutput(self, state):
+        return self.c
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        record[0] = self.c
+        return self.c
+    def getNextValuesBatch(self, states, inps):
+        return (states, asLanes([self.c] * len(inps)))
+    def getDelayedOutputBatch(self, states):
+        return asLanes([self.c] * len(states))
 
 class R(SM):
     """
     Machine whose output is the input, but delayed by one time step.
     Specify initial output in initializer.
     """
+    dependsOnInput = False
     def __init__(self, v0 = 0):
         """
         @param v0: initial output value
@@ -1039,6 +2884,22 @@ class R(SM):
     def getNextValues(self, state, inp):
         # new state is inp, current output is old state
         return (inp, state)
+    def getDelayedOutput(self, state):
+        return state
+    def getStartStateBatch(self, k):
+        return asLanes([self.getStartState()] * k)
+    def getNextValuesBatch(self, states, inps):
+        return (inps, states)
+    def getDelayedOutputBatch(self, states):
+        return states
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        o = record[0]
+        record[0] = inp
+        return o
+    def getDelayedOutputInPlace(self, record):
+        return record[0]
 
 Delay = R
 """Delay is another name for the class R, for backward compatibility"""
@@ -1048,6 +2909,7 @@ class Gain(SM):
     Machine whose output is the input, but multiplied by k.
     Specify k in initializer.
     """
+    dependsOnInput = True
     def __init__(self, k):
         """
         @param k: gain
@@ -1056,17 +2918,37 @@ class Gain(SM):
     def getNextValues(self, state, inp):
         # new state is inp, current output is old state
         return (state, safeMul(self.k, inp))
+    def getStartStateBatch(self, k):
+        return None
+    def getNextValuesBatch(self, states, inps):
+        if isArray(inps) and isNumber(self.k):
+            return (states, self.k * inps)
+        return (states, asLanes([safeMul(self.k, i) for i in inps]))
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        return safeMul(self.k, inp)
 
 class Wire(SM):
     """Machine whose output is the input"""
+    dependsOnInput = True
     def getNextValues(self, state, inp):
         return (state, inp)
+    def getStartStateBatch(self, k):
+        return None
+    def getNextValuesBatch(self, states, inps):
+        return (states, inps)
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        return inp
 
 class Select (SM):
     """
     Machine whose input is a structure list and whose output is the
     C{k}th element of that list.
     """
+    dependsOnInput = True
     def __init__(self, k):
         """
         @param k: positive integer describing which element of input
@@ -1075,12 +2957,22 @@ class Select (SM):
         self.k = k
     def getNextState(self, state, inp):
         return inp[self.k]
+    def getStartStateBatch(self, k):
+        return None
+    def getNextValuesBatch(self, states, inps):
+        return (states, asLanes([i[self.k] for i in toList(inps)]))
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        record[0] = inp[self.k]
+        return record[0]
 
 class PureFunction(SM):
     """
     Machine whose output is produced by applying a specified Python
     function to its input.
     """
+    dependsOnInput = True
     def __init__(self, f):
         """
         @param f: a function of one argument
@@ -1088,6 +2980,15 @@ class PureFunction(SM):
         self.f = f
     def getNextValues(self, state, inp):
         return (None, self.f(inp))
+    def getStartStateBatch(self, k):
+        return None
+    def getNextValuesBatch(self, states, inps):
+        return (states, asLanes(map(self.f, toList(inps))))
+    stateToRecord = valueRecord
+    recordToState = recordValue
+    def stepInPlace(self, record, inp):
+        record[0] = None
+        return self.f(inp)
 
 import operator
 
@@ -1102,7 +3003,7 @@ def allDefined(struct):
     if struct == 'undefined':
         return False
     elif isinstance(struct, list) or isinstance(struct, tuple):
-        return reduce(operator.and_, [allDefined(x) for x in struct])
+        return reduce(operator.and_, [allDefined(x) for x in struct], True)
     else:
         return True
 
@@ -1118,4 +3019,869 @@ def safe(f):
 safeAdd = safe(operator.add)
 safeMul = safe(operator.mul)
 safeSub = safe(operator.sub)
+unsafe = {safeAdd: operator.add, safeMul: operator.mul,
+          safeSub: operator.sub}
     
+######################################################################
+##
+##  Running one machine on many input streams at once
+
+def transduceBatch(m, inputs):
+    """
+    Run C{m} on many independent input streams (lanes) at once.  The
+    result is the same as C{[m.transduce(inps) for inps in inputs]},
+    but the lanes advance in lockstep and their states are kept in
+    batches (lists or NumPy arrays), so a machine with a batched
+    C{getNextValuesBatch} pays the Python overhead of a step once for
+    all the lanes instead of once per lane.  A lane stops when its
+    inputs run out or its machine is done;  after that it takes no
+    part in the computation.  C{m} itself is not started or changed.
+    @param m: C{SM}
+    @param inputs: list of input sequences, one per lane (they may be
+          of different lengths), or a 2-dimensional NumPy array with a
+          row per lane
+    @return: list with the list of outputs of each lane
+    """
+    k = len(inputs)
+    results = [[] for i in range(k)]
+    if k == 0:
+        return results
+    lengths = [len(lane) for lane in inputs]
+    if isArray(inputs) and inputs.ndim == 2 and inputs.dtype.kind == 'f':
+        columns = inputs.T
+    else:
+        columns = [asLanes(list(c)) for c in itertools.izip_longest(*inputs)]
+    states = m.getStartStateBatch(k)
+    active = range(k)
+    end = min(lengths)
+    # Runs of consecutive steps with the same active lanes, with the
+    # batch of outputs of each step
+    runs = []
+    t = 0
+    while True:
+        finished = m.doneBatch(states)
+        if t == end or (finished and True in finished):
+            keep = [j for (j, lane) in enumerate(active) \
+                    if t < lengths[lane] and not (finished and finished[j])]
+            if not keep:
+                break
+            states = takeLanes(states, keep)
+            active = [active[j] for j in keep]
+            end = min([lengths[lane] for lane in active])
+        inps = columns[t]
+        if len(active) < k:
+            inps = takeLanes(inps, active)
+        (states, outs) = m.getNextValuesBatch(states, inps)
+        if runs and runs[-1][0] is active:
+            runs[-1][1].append(outs)
+        else:
+            runs.append((active, [outs]))
+        t = t + 1
+    for (lanes, outs) in runs:
+        if numpy is not None and all([isArray(o) for o in outs]):
+            outputs = numpy.array(outs).T.tolist()
+        else:
+            outputs = zip(*[toList(o) for o in outs])
+        for (lane, laneOutputs) in zip(lanes, outputs):
+            results[lane].extend(laneOutputs)
+    return results
+
+######################################################################
+##
+##  Running many machines on the same inputs in worker processes
+
+def sweep(factory, paramGrid, inputs, workers = None):
+    """
+    Make a machine for each setting of some parameters, and transduce
+    C{inputs} with it, in a pool of worker processes.  The inputs are
+    handed to each worker once, when it starts, rather than with every
+    machine;  a list of floating point numbers is put in shared memory,
+    so that all the workers read the same copy.
+    @param factory: procedure that makes a C{SM} from a setting of the
+          parameters.  On systems that can't fork processes, it must be
+          defined at the top level of a module, so it can be pickled.
+    @param paramGrid: dictionary mapping keyword arguments of
+          C{factory} to lists of values, to try every combination;  or
+          a list of settings, each of which is a dictionary of keyword
+          arguments, a tuple of arguments, or a single argument
+    @param inputs: list of inputs, the same for every machine
+    @param workers: number of worker processes;  by default, one for
+          each processor.  With 1, the machines are run in this process.
+    @return: generator of pairs of a setting and the list of outputs of
+          its machine, in the order in which the runs finish
+    """
+    settings = gridSettings(paramGrid)
+    if workers == 1:
+        for setting in settings:
+            yield (setting, makeMachine(factory, setting).transduce(inputs))
+        return
+    pool = multiprocessing.Pool(workers, initWorker,
+                                ({'factory': factory,
+                                  'inputs': shareInputs(inputs)},))
+    try:
+        for result in pool.imap_unordered(sweepRun, settings):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def gridSettings(paramGrid):
+    """
+    List of the settings described by C{paramGrid};  see C{sweep}
+    """
+    if isinstance(paramGrid, dict):
+        names = sorted(paramGrid.keys())
+        return [dict(zip(names, values)) for values in \
+                itertools.product(*[paramGrid[n] for n in names])]
+    return list(paramGrid)
+
+def makeMachine(factory, setting):
+    if isinstance(setting, dict):
+        return factory(**setting)
+    elif isinstance(setting, tuple):
+        return factory(*setting)
+    else:
+        return factory(setting)
+
+def shareInputs(inputs):
+    """
+    Internal use only.  Put a list of floating point numbers into
+    shared memory.  The shared array can be used as a list of inputs,
+    and NumPy (used by C{lti}) reads it without copying.
+    """
+    inputs = list(inputs)
+    if inputs and all([type(x) is float for x in inputs]):
+        return multiprocessing.sharedctypes.RawArray('d', inputs)
+    return inputs
+
+workerContext = {}
+"""
+Internal use only.  What a worker process of C{sweep} or C{ensemble}
+needs for every run, set once when the worker starts
+"""
+
+def initWorker(context):
+    workerContext.update(context)
+
+def sweepRun(setting):
+    m = makeMachine(workerContext['factory'], setting)
+    return (setting, m.transduce(workerContext['inputs']))
+
+def ensemble(m, runs, inputs, seed = 0, workers = None,
+             quantiles = (0.05, 0.5, 0.95)):
+    """
+    Transduce C{inputs} with many runs of a stochastic machine (one
+    whose C{startState} or C{getNextValues} uses the C{random} module,
+    or C{numpy.random}), in a pool of worker processes, and collect
+    statistics of the outputs at each step.  The outputs of each run
+    are added to the statistics as they come in, and then thrown away.
+
+    Before run C{i}, the random number generators are seeded with a
+    number made from C{seed} and C{i}, so each run has its own stream
+    of random numbers, and the result doesn't depend on the number of
+    workers or on which worker does which run.
+    @param m: C{SM} whose outputs are numbers
+    @param runs: number of runs
+    @param inputs: list of inputs, the same for every run;  use
+          C{[None] * n} for a machine that doesn't consume input
+    @param seed: seed for the whole ensemble
+    @param workers: number of worker processes;  by default, one for
+          each processor.  With 1, the runs are done in this process,
+          and the state of its random number generators is restored
+          afterwards.
+    @param quantiles: the quantiles to estimate at each step
+    @return: C{EnsembleStats}
+    """
+    stats = EnsembleStats(quantiles)
+    if workers == 1:
+        # The runs reseed the generators, which belong to the caller
+        saved = random.getstate()
+        if numpy is not None:
+            savedNumpy = numpy.random.get_state()
+        try:
+            for i in xrange(runs):
+                seedRun(seed, i)
+                stats.add(m.transduce(inputs))
+        finally:
+            random.setstate(saved)
+            if numpy is not None:
+                numpy.random.set_state(savedNumpy)
+        return stats
+    pool = multiprocessing.Pool(workers, initWorker,
+                                ({'machine': m, 'seed': seed,
+                                  'inputs': shareInputs(inputs)},))
+    try:
+        chunk = max(1, runs // (4 * (workers or
+                                     multiprocessing.cpu_count())))
+        # Results come back in order, so that the statistics are added up
+        # in the same order every time
+        for outputs in pool.imap(ensembleRun, xrange(runs), chunk):
+            stats.add(outputs)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return stats
+
+def runSeed(seed, i):
+    """
+    Seed for run C{i} of an ensemble:  the first 32 bits of a hash of
+    C{seed} and C{i}, so that nearby runs get unrelated streams
+    """
+    return int(hashlib.sha1('%r:%d' % (seed, i)).hexdigest()[:8], 16)
+
+def seedRun(seed, i):
+    s = runSeed(seed, i)
+    random.seed(s)
+    if numpy is not None:
+        numpy.random.seed(s)
+
+def ensembleRun(i):
+    seedRun(workerContext['seed'], i)
+    return workerContext['machine'].transduce(workerContext['inputs'])
+
+class EnsembleStats:
+    """
+    Statistics of the outputs of the runs of an ensemble at each step,
+    kept up to date as runs are added, without storing the runs:  the
+    mean and variance (by Welford's method) and estimates of some
+    quantiles (by the P-squared method).  Runs may be of different
+    lengths;  each step only counts the runs that got that far.
+    """
+    def __init__(self, quantiles = (0.05, 0.5, 0.95)):
+        self.quantiles = tuple(quantiles)
+        self.count = []
+        """Number of runs that reached each step"""
+        self.means = []
+        self.squares = []
+        """Sum of squared differences from the mean, at each step"""
+        self.estimators = []
+        """C{QuantileEstimator} for each quantile, at each step"""
+
+    def add(self, outputs):
+        """
+        Add the list of outputs of one run
+        """
+        for (t, y) in enumerate(outputs):
+            y = float(y)
+            if t == len(self.count):
+                self.count.append(0)
+                self.means.append(0.0)
+                self.squares.append(0.0)
+                self.estimators.append([QuantileEstimator(p) \
+                                        for p in self.quantiles])
+            n = self.count[t] + 1
+            delta = y - self.means[t]
+            self.count[t] = n
+            self.means[t] += delta / n
+            self.squares[t] += delta * (y - self.means[t])
+            for e in self.estimators[t]:
+                e.add(y)
+
+    def mean(self):
+        """
+        @return: list of the mean output at each step
+        """
+        return list(self.means)
+
+    def variance(self):
+        """
+        @return: list of the (sample) variance of the output at each step
+        """
+        return [s / (n - 1) if n > 1 else 0.0 \
+                for (s, n) in zip(self.squares, self.count)]
+
+    def quantile(self, p):
+        """
+        @param p: one of the quantiles given when the statistics were
+              made
+        @return: list of the estimated C{p}-quantile of the output at
+              each step
+        """
+        if p not in self.quantiles:
+            raise Exception, 'Quantile ' + str(p) + ' was not estimated'
+        i = self.quantiles.index(p)
+        return [es[i].value() for es in self.estimators]
+
+class QuantileEstimator:
+    """
+    Estimate of the C{p}-quantile of a stream of numbers, kept in
+    constant memory by the P-squared method of Jain and Chlamtac:  five
+    markers track the minimum, the maximum, the estimate and points
+    half way to it, and are moved by piecewise-parabolic interpolation
+    as numbers arrive.
+    """
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1.0, 2.0, 3.0, 4.0, 5.0]
+        self.desired = [1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0]
+        self.increments = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x):
+        q = self.heights
+        n = self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k = k + 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+                   (d <= -1 and n[i - 1] - n[i] < -1):
+                if d > 0:
+                    d = 1
+                else:
+                    d = -1
+                h = self.parabolic(i, d)
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        right = (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+        left = (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        return q[i] + d / (n[i + 1] - n[i - 1]) * \
+               ((n[i] - n[i - 1] + d) * right + (n[i + 1] - n[i] - d) * left)
+
+    def value(self):
+        """
+        @return: the current estimate;  exact for fewer than five
+              numbers, and C{None} if there are none
+        """
+        q = self.heights
+        if not q:
+            return None
+        if len(q) < 5:
+            return q[int(round(self.p * (len(q) - 1)))]
+        return q[2]
+
+######################################################################
+##
+##  Simplifying composition trees
+
+def simplify(m, verbose = False):
+    """
+    Make a smaller machine with the same outputs as C{m}, by rewriting
+    its composition tree from the bottom up:
+      - C{Wire}s and C{Gain(1)}s in a C{Cascade} or C{CascadeN} are
+        removed
+      - a C{Cascade} of two numeric C{Gain}s, or a C{ParallelAdd} of
+        numeric C{Gain}s and C{Wire}s, becomes a single C{Gain}
+      - a C{Constant} cascaded into a C{PureFunction} or a C{Gain}
+        becomes a C{Constant} of the result (the function is called
+        once, so it must really be pure)
+      - a C{Parallel} cascaded into a C{Select} becomes the selected
+        branch, if the other branch can't terminate (otherwise it
+        could end the run)
+    C{m} is not changed;  the compositions that are kept are copied.
+    The states of the new machine are those of the machines that are
+    left.  Fusing gains changes the order of the multiplications, so
+    floating point outputs may differ in their last bits.
+    @param verbose: if C{True}, print a line for each rewrite
+    @return: C{SM}
+    """
+    return Simplifier(verbose).simplify(m)
+
+class Simplifier:
+    """
+    Internal use only.  Does the work of C{simplify}.
+    """
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    def note(self, message):
+        if self.verbose:
+            print message
+
+    def simplify(self, m):
+        if isinstance(m, (Sequence, CascadeN, ParallelN)):
+            m = copy.copy(m)
+            m.smList = [self.simplify(x) for x in m.smList]
+            if m.__class__ is CascadeN:
+                return self.cascadeN(m)
+            return m
+        names = partNames(m)
+        if names is None:
+            return m
+        m = copy.copy(m)
+        for name in names:
+            setattr(m, name, self.simplify(getattr(m, name)))
+        c = m.__class__
+        if c is Cascade:
+            return self.cascade(m)
+        elif c is ParallelAdd:
+            return self.parallelAdd(m)
+        return m
+
+    def cascade(self, m):
+        (m1, m2) = (m.m1, m.m2)
+        if isIdentity(m1) or isIdentity(m2):
+            if isIdentity(m1):
+                (keep, drop) = (m2, m1)
+            else:
+                (keep, drop) = (m1, m2)
+            self.note('Removed ' + describe(drop) + ' from ' + describe(m))
+            return keep
+        if isNumericGain(m1) and isNumericGain(m2):
+            g = Gain(m2.k * m1.k)
+            self.note('Fused ' + describe(m1) + ' and ' + describe(m2) + \
+                      ' into Gain(' + str(g.k) + ')')
+            return g
+        if m1.__class__ is Constant and m2.__class__ in (PureFunction, Gain):
+            if m2.__class__ is Gain:
+                c = Constant(safeMul(m2.k, m1.c))
+            else:
+                c = Constant(m2.f(m1.c))
+            self.note('Folded ' + describe(m1) + ' and ' + describe(m2) + \
+                      ' into Constant(' + str(c.c) + ')')
+            return c
+        if m1.__class__ is Parallel and m2.__class__ is Select and \
+               m2.k in (0, 1):
+            (keep, drop) = [(m1.m1, m1.m2), (m1.m2, m1.m1)][m2.k]
+            if not drop.canTerminate():
+                self.note('Dropped ' + describe(drop) + ' from ' + \
+                          describe(m1) + ' and ' + describe(m2))
+                return keep
+        # Machines next to each other in nested cascades may combine
+        if m2.__class__ is Cascade:
+            pair = Cascade(m1, m2.m1)
+            inner = self.cascade(pair)
+            if inner is not pair:
+                return self.cascade(Cascade(inner, m2.m2, name = m.name))
+        if m1.__class__ is Cascade:
+            pair = Cascade(m1.m2, m2)
+            inner = self.cascade(pair)
+            if inner is not pair:
+                return self.cascade(Cascade(m1.m1, inner, name = m.name))
+        return m
+
+    def cascadeN(self, m):
+        keep = [x for x in m.smList if not isIdentity(x)]
+        if len(keep) == len(m.smList):
+            return m
+        for x in m.smList:
+            if isIdentity(x):
+                self.note('Removed ' + describe(x) + ' from ' + describe(m))
+        if not keep:
+            return m.smList[0]
+        elif len(keep) == 1:
+            return keep[0]
+        m.smList = keep
+        return m
+
+    def parallelAdd(self, m):
+        (m1, m2) = (m.m1, m.m2)
+        if (isNumericGain(m1) or m1.__class__ is Wire) and \
+               (isNumericGain(m2) or m2.__class__ is Wire):
+            g = Gain(gainOf(m1) + gainOf(m2))
+            self.note('Fused ' + describe(m1) + ' and ' + describe(m2) + \
+                      ' in ' + describe(m) + ' into Gain(' + str(g.k) + ')')
+            return g
+        return m
+
+def partNames(m):
+    """
+    Names of the attributes of a composition that hold its parts, or
+    C{None} for machines that C{simplify} doesn't look inside
+    """
+    if isinstance(m, Feedback):
+        return ('m',)
+    elif isinstance(m, If):
+        return ('sm1', 'sm2')
+    elif isinstance(m, (Repeat, RepeatUntil, Until)):
+        return ('sm',)
+    elif isinstance(m, (Cascade, Parallel, FeedbackAdd, FeedbackSubtract,
+                        Switch)):
+        return ('m1', 'm2')
+    return None
+
+def isNumericGain(m):
+    return m.__class__ is Gain and isNumber(m.k)
+
+def isIdentity(m):
+    return m.__class__ is Wire or (isNumericGain(m) and m.k == 1)
+
+def gainOf(m):
+    if m.__class__ is Wire:
+        return 1
+    return m.k
+
+def describe(m):
+    if m.name:
+        return m.name
+    return m.__class__.__name__
+
+######################################################################
+##
+##  Compiling a composition tree into a single step function
+
+class CompiledSM(SM):
+    """
+    Machine that behaves like a composite machine, but whose
+    C{getNextValues} is a single generated Python function.  Its state
+    is a flat tuple, with one entry for each delay and for each
+    sub-machine that could not be inlined (only one for a machine that
+    is shared, see C{StepCompiler.emit}).  Don't instantiate this
+    directly:  use C{compile}.
+    """
+    def __init__(self, machine, source, stepFn, leaves, probeFn):
+        """
+        @param machine: the C{SM} that was compiled
+        @param source: text of the generated step function
+        @param stepFn: the generated step function
+        @param leaves: list of the machines whose states make up the
+              flat state, in order
+        @param probeFn: generated step function that can take
+              C{'undefined'} inputs
+        """
+        self.machine = machine
+        self.source = source
+        self.probe = probeFn
+        self.leaves = leaves
+        self.terminating = [i for (i, m) in enumerate(leaves) \
+                            if m.canTerminate()]
+        # The generated function is stored on the instance, so that
+        # step and transduce call it without another level of method
+        # dispatch.
+        self.getNextValues = stepFn
+        self.name = machine.name
+        self.legalInputs = machine.legalInputs
+        self.dependsOnInput = machine.dependsOnInput
+
+    def startState(self):
+        return tuple([m.getStartState() for m in self.leaves])
+
+    def getDelayedOutput(self, state):
+        # The probe function does the safe arithmetic, so this works
+        # for any machine whose output doesn't depend on its input
+        (ignore, o) = self.probe(state, 'undefined')
+        return o
+
+    def done(self, state):
+        for i in self.terminating:
+            if self.leaves[i].done(state[i]):
+                return True
+        return False
+
+    def canTerminate(self):
+        return len(self.terminating) > 0
+
+class StepCompiler:
+    """
+    Internal use only.  Generates the body of the step function for
+    C{compile}, one line at a time.
+    """
+    def __init__(self, share = False):
+        """
+        @param share: if C{True}, share any machine that is reused with
+              the same input, not just the deterministic ones (see
+              C{canShare})
+        """
+        self.share = share
+        self.lines = []
+        self.env = {'safeAdd': safeAdd, 'safeMul': safeMul,
+                    'splitValue': splitValue, 'allDefined': allDefined,
+                    'definedTypes': definedTypes}
+        self.leaves = []
+        self.slots = {}
+        self.count = 0
+        self.shared = {}
+        """Output expression of each C{(id(machine), input expression)}"""
+        self.shareable = {}
+        self.loops = 0
+        """Number of feedback loops around the code being generated"""
+
+    def newVar(self):
+        self.count = self.count + 1
+        return 't%d' % self.count
+
+    def bind(self, value):
+        """
+        Make C{value} available to the generated code;  returns its name
+        """
+        name = 'c%d' % len(self.env)
+        self.env[name] = value
+        return name
+
+    def slot(self, m, key):
+        """
+        Index of the entry of the flat state that holds the state of
+        the machine at position C{key} in the tree
+        """
+        if key not in self.slots:
+            self.slots[key] = len(self.leaves)
+            self.leaves.append(m)
+        return self.slots[key]
+
+    def emit(self, m, x, key, maybeUndefined):
+        """
+        Generate code for one step of C{m} on the input expression
+        C{x}, in the same order of evaluation as C{m.getNextValues}.
+
+        A machine that appears in more than one place in the tree, and
+        gets the same input expression in each, has the same state in
+        each too;  so its code is generated once, its state is stored
+        once, and its output is used by all of them.  This is not done
+        inside feedback loops, where a machine may be run more than
+        once in a step, or for machines that C{canShare} rejects.
+        @param key: position of C{m} in the tree
+        @param maybeUndefined: C{True} if the values flowing through
+              this code can be C{'undefined'} (while probing a feedback
+              loop), in which case the safe arithmetic is used
+        @return: pair of the output expression and a dictionary
+              mapping flat state indices to next state expressions
+        """
+        if self.loops > 0 or not self.canShare(m):
+            return self.emitNode(m, x, key, maybeUndefined)
+        memo = (id(m), x)
+        if memo in self.shared:
+            return (self.shared[memo], {})
+        (o, nexts) = self.emitNode(m, x, key, maybeUndefined)
+        self.shared[memo] = o
+        return (o, nexts)
+
+    def canShare(self, m):
+        """
+        Do all the runs of C{m} on the same input give the same outputs?
+        Only machines known to be deterministic are shared:  C{R},
+        C{Gain}, C{Wire}, C{Constant} and C{Select}, and the compositions
+        that C{emitNode} inlines, when all of their parts are shared.  A
+        C{PureFunction} or a machine of another class could draw random
+        numbers.  With C{share} set, any machine is shared, unless it
+        has a part whose C{startState} is a method (for stochastic
+        machines), other than the compositions that build their start
+        state from their parts.
+        """
+        if id(m) not in self.shareable:
+            subs = m.subMachines()
+            if subs:
+                result = (self.share or \
+                          m.__class__ in self.sharedCompositions) and \
+                          all([self.canShare(sub) for sub in subs])
+            elif self.share:
+                result = not isinstance(m.startState, types.MethodType)
+            else:
+                result = m.__class__ in self.sharedPrimitives
+            self.shareable[id(m)] = result
+        return self.shareable[id(m)]
+
+    sharedPrimitives = (R, Gain, Wire, Constant, Select)
+    """Classes of the primitive machines shared by default"""
+    sharedCompositions = (Cascade, Parallel, ParallelAdd, CascadeN,
+                          ParallelN, ParallelAddN, Parallel2, Feedback,
+                          Feedback2, FeedbackAdd, FeedbackSubtract)
+    """Classes of the compositions shared by default"""
+
+    def emitNode(self, m, x, key, maybeUndefined):
+        """
+        Does the work of C{emit}
+        """
+        add = self.lines.append
+        c = m.__class__
+        if c is R:
+            i = self.slot(m, key)
+            return ('s%d' % i, {i: x})
+        elif c is Gain:
+            o = self.newVar()
+            if maybeUndefined:
+                add('%s = safeMul(%s, %s)' % (o, self.bind(m.k), x))
+            else:
+                add('%s = %s * %s' % (o, self.bind(m.k), x))
+            return (o, {})
+        elif c is Wire:
+            return (x, {})
+        elif c is Constant:
+            return (self.bind(m.c), {})
+        elif c is Select:
+            o = self.newVar()
+            add('%s = %s[%s]' % (o, x, self.bind(m.k)))
+            return (o, {})
+        elif c is PureFunction:
+            o = self.newVar()
+            add('%s = %s(%s)' % (o, self.bind(m.f), x))
+            return (o, {})
+        elif c is Cascade:
+            (o1, n1) = self.emit(m.m1, x, key + (0,), maybeUndefined)
+            (o2, n2) = self.emit(m.m2, o1, key + (1,), maybeUndefined)
+            n1.update(n2)
+            return (o2, n1)
+        elif c in (Parallel, ParallelAdd):
+            (o1, n1) = self.emit(m.m1, x, key + (0,), maybeUndefined)
+            (o2, n2) = self.emit(m.m2, x, key + (1,), maybeUndefined)
+            n1.update(n2)
+            o = self.newVar()
+            if c is Parallel:
+                add('%s = (%s, %s)' % (o, o1, o2))
+            else:
+                add('%s = %s + %s' % (o, o1, o2))
+            return (o, n1)
+        elif c is CascadeN:
+            nexts = {}
+            o = x
+            for (i, part) in enumerate(m.smList):
+                (o, n) = self.emit(part, o, key + (i,), maybeUndefined)
+                nexts.update(n)
+            return (o, nexts)
+        elif c in (ParallelN, ParallelAddN):
+            nexts = {}
+            outputs = []
+            for (i, part) in enumerate(m.smList):
+                (oi, n) = self.emit(part, x, key + (i,), maybeUndefined)
+                outputs.append(oi)
+                nexts.update(n)
+            o = self.newVar()
+            if c is ParallelN:
+                add('%s = (%s,)' % (o, ', '.join(outputs)))
+            else:
+                add('%s = %s' % (o, ' + '.join(outputs)))
+            return (o, nexts)
+        elif c is Parallel2:
+            (i1, i2) = (self.newVar(), self.newVar())
+            add('(%s, %s) = splitValue(%s)' % (i1, i2, x))
+            (o1, n1) = self.emit(m.m1, i1, key + (0,), maybeUndefined)
+            (o2, n2) = self.emit(m.m2, i2, key + (1,), maybeUndefined)
+            n1.update(n2)
+            o = self.newVar()
+            add('%s = (%s, %s)' % (o, o1, o2))
+            return (o, n1)
+        elif c in (Feedback, Feedback2):
+            self.loops += 1
+            if c is Feedback:
+                probe = "'undefined'"
+            else:
+                probe = self.newVar()
+                add("%s = (%s, 'undefined')" % (probe, x))
+            # Will only compute output
+            (o, ignore) = self.emit(m.m, probe, key + (0,), True)
+            add("assert %s != 'undefined', " \
+                "'Error in feedback; machine has no delay'" % o)
+            if c is Feedback:
+                fed = o
+            else:
+                fed = self.newVar()
+                add('%s = (%s, %s)' % (fed, x, o))
+            # Will only compute next state
+            (ignore, nexts) = self.emit(m.m, fed, key + (0,), maybeUndefined)
+            self.loops -= 1
+            return (o, nexts)
+        elif c in (FeedbackAdd, FeedbackSubtract):
+            self.loops += 1
+            (k1, k2) = (key + (0,), key + (1,))
+            (o1, ignore) = self.emit(m.m1, '99999999', k1, maybeUndefined)
+            (o2, ignore) = self.emit(m.m2, o1, k2, maybeUndefined)
+            e = self.newVar()
+            if c is FeedbackSubtract:
+                add('%s = %s - %s' % (e, x, o2))
+            elif maybeUndefined:
+                add('%s = safeAdd(%s, %s)' % (e, x, o2))
+            else:
+                add('%s = %s + %s' % (e, x, o2))
+            (o, n1) = self.emit(m.m1, e, k1, maybeUndefined)
+            (ignore, n2) = self.emit(m.m2, o, k2, maybeUndefined)
+            n1.update(n2)
+            self.loops -= 1
+            return (o, n1)
+        else:
+            # Not something we know how to inline;  call it
+            i = self.slot(m, key)
+            (n, o) = (self.newVar(), self.newVar())
+            add('(%s, %s) = %s.getNextValues(s%d, %s)' % \
+                (n, o, self.bind(m), i, x))
+            return (o, {i: n})
+
+    def source(self, out, nexts, guard = False):
+        """
+        Text of the complete step function
+        @param guard: if C{True}, the function starts by handing inputs
+              that are or contain C{'undefined'} to a function called
+              C{probe}, which must be bound in C{self.env}
+        """
+        names = ['s%d' % i for i in range(len(self.leaves))]
+        body = []
+        if guard:
+            body.append('if inp.__class__ not in definedTypes and ' \
+                        'not allDefined(inp):')
+            body.append('    return probe(state, inp)')
+        if names:
+            body.append('(%s,) = state' % ', '.join(names))
+        body.extend(self.lines)
+        newState = ', '.join([nexts[i] for i in range(len(self.leaves))])
+        if names:
+            newState = newState + ','
+        body.append('return ((%s), %s)' % (newState, out))
+        return 'def step(state, inp):\n' + \
+               ''.join(['    ' + line + '\n' for line in body])
+
+def compile(m, share = False):
+    """
+    Compile the composition tree of C{m} into a single Python function
+    that computes the next state and output of the whole machine.
+    Primitive machines (C{R}, C{Gain}, C{Wire}, C{Constant}, C{Select}
+    and C{PureFunction}) are inlined, the compositions are flattened
+    away, and the state is kept in a flat tuple.  Machines of any other
+    class are called through their own C{getNextValues}.  The outputs
+    of the compiled machine are the same as those of C{m}, computed in
+    the same order, except that a deterministic machine (made of
+    C{R}, C{Gain}, C{Wire}, C{Constant} and C{Select}) that is used in
+    several places with the same input is only run once (see
+    C{StepCompiler.emit}).
+
+    Two functions are generated from the same tree:  the step
+    function, with plain arithmetic, and a probe function that uses
+    the safe arithmetic throughout.  The step function hands inputs
+    that are (or contain) C{'undefined'} to the probe function, so that
+    the compiled machine can be probed inside a feedback loop just like
+    C{m}.  The machines in the tree should not be changed after they
+    are compiled.
+    @param m: C{SM}
+    @param share: if C{True}, run any machine used in several places
+          with the same input only once, including C{PureFunction}s and
+          machines of other classes;  only do this if they are
+          deterministic
+    @return: C{CompiledSM} with the same C{start}, C{step} and
+          C{transduce} behavior as C{m}
+    """
+    probe = compileFunction(m, True, share = share)
+    (source, stepFn, leaves) = compileFunction(m, False, probe[1], share)
+    assert [id(x) for x in leaves] == [id(x) for x in probe[2]], \
+           'Step and probe functions have different states'
+    return CompiledSM(m, source, stepFn, leaves, probe[1])
+
+definedTypes = frozenset([int, long, float, bool, type(None)])
+"""Classes of inputs that can't be C{'undefined'}"""
+
+def compileFunction(m, maybeUndefined, probe = None, share = False):
+    """
+    Internal use only.  Generate and compile one step function for C{m}.
+    @param probe: if not C{None}, the function to hand undefined
+          inputs to
+    @param share: passed on to C{StepCompiler}
+    @return: tuple of the source, the function and the list of leaves
+    """
+    compiler = StepCompiler(share)
+    (out, nexts) = compiler.emit(m, 'inp', (), maybeUndefined)
+    if probe is not None:
+        compiler.env['probe'] = probe
+    source = compiler.source(out, nexts, guard = probe is not None)
+    env = compiler.env
+    exec source in env
+    return (source, env['step'], compiler.leaves)
@@ -0,0 +1,119 @@
+import unittest
+from libdw import sm, fsm
+
+class Parity(sm.SM):
+    """
+    Output is 1 if an odd number of 1s have been seen;  the count is
+    kept modulo 6, so there are six states but only two that differ
+    """
+    startState = 0
+    legalInputs = [0, 1]
+    def getNextValues(self, state, inp):
+        n = (state + inp) % 6
+        return (n, n % 2)
+
+def counter():
+    body = sm.Cascade(sm.PureFunction(lambda x: (x + 1) % 3), sm.R(0))
+    body.legalInputs = [0, 1, 2]
+    return body
+
+class Ticks(sm.SM):
+    """
+    Counts 1s modulo 8, and outputs 1 whenever the count is a multiple
+    of 4;  the counts 1 and 2 have the same outputs, but lead to states
+    that don't
+    """
+    startState = 0
+    legalInputs = [0, 1]
+    def getNextValues(self, state, inp):
+        n = (state + inp) % 8
+        return (n, int(n % 4 == 0))
+
+class Finite(sm.SM):
+    """Steps up to 3 or down to -3, where it is done"""
+    startState = 0
+    legalInputs = [-1, 1]
+    def getNextValues(self, state, inp):
+        return (max(-3, min(3, state + inp)), 0)
+    def done(self, state):
+        return abs(state) == 3
+
+class TypeName(sm.SM):
+    startState = None
+    legalInputs = [1, True]
+    def getNextValues(self, state, inp):
+        return (state, type(inp).__name__)
+
+class Bits(sm.SM):
+    startState = 0
+    legalInputs = [[0], [1]]
+    def getNextValues(self, state, inp):
+        return ((state + inp[0]) % 2, state)
+
+class TabulateTest(unittest.TestCase):
+    def testSameOutputs(self):
+        inps = [1, 0, 1, 1, 0, 1] * 5
+        t = fsm.tabulate(Parity())
+        self.assertEqual(t.transduce(inps), Parity().transduce(inps))
+        self.assertEqual(t.originalState(t.state), 2)
+
+    def testIllegalInput(self):
+        t = fsm.tabulate(Parity())
+        self.assertRaises(Exception, t.transduce, [2])
+        self.assertTrue(t.name)
+
+    def testInputTypes(self):
+        t = fsm.tabulate(TypeName())
+        self.assertEqual(t.transduce([1, True]), ['int', 'bool'])
+        self.assertRaises(Exception, t.transduce, [1.0])
+
+    def testUnhashableInputs(self):
+        self.assertTrue(fsm.tabulate(Bits()).__class__ is Bits)
+
+    def testNotTabulated(self):
+        self.assertTrue(fsm.tabulate(Parity(), limit = 4).__class__ is Parity)
+
+    def testFeedback(self):
+        t = fsm.tabulate(counter())
+        self.assertEqual(t.dependsOnInput, False)
+        self.assertEqual(sm.Feedback(t).run(5), sm.Feedback(counter()).run(5))
+
+class MinimizeTest(unittest.TestCase):
+    def testMerge(self):
+        t = fsm.tabulate(Parity())
+        small = fsm.minimize(t)
+        self.assertEqual(len(small.states), 2)
+        inps = [1, 1, 0, 1, 0, 0, 1] * 4
+        self.assertEqual(small.transduce(inps), t.transduce(inps))
+
+    def testSplit(self):
+        t = fsm.tabulate(Ticks())
+        small = fsm.minimize(t)
+        self.assertEqual(len(t.states), 8)
+        self.assertEqual(len(small.states), 4)
+        self.assertEqual(small.states[0], 0)
+        inps = [1, 0, 1, 1, 0, 1, 1, 1, 1, 0, 1] * 3
+        self.assertEqual(small.transduce(inps), Ticks().transduce(inps))
+
+    def testDoneStatesMerged(self):
+        t = fsm.tabulate(Finite())
+        small = fsm.minimize(t)
+        # -3 and 3 are both done;  the states between them all differ
+        self.assertEqual(len(t.states), 7)
+        self.assertEqual(len(small.states), 6)
+        self.assertEqual(len(small.transduce([1] * 10)), 3)
+        self.assertEqual(len(small.transduce([-1, 1] * 3 + [-1] * 5)), 9)
+
+    def testAlreadyMinimal(self):
+        t = fsm.minimize(fsm.tabulate(Parity()))
+        again = fsm.minimize(t)
+        self.assertEqual(len(again.states), len(t.states))
+        self.assertEqual(again.tableBytes(), t.tableBytes())
+
+    def testFeedback(self):
+        small = fsm.minimize(fsm.tabulate(counter()))
+        self.assertEqual(sm.Feedback(small).run(7),
+                         sm.Feedback(counter()).run(7))
+
+if __name__ == '__main__':
+    unittest.main()
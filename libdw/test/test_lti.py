@@ -0,0 +1,34 @@
+import unittest
+from libdw import sm, lti
+
+def accumulator():
+    return sm.FeedbackAdd(sm.R(0), sm.Gain(1.01))
+
+class TransduceTest(unittest.TestCase):
+    def setUp(self):
+        self.inps = [0.1 * (i % 7) for i in range(2 * lti.minLength)]
+
+    def tearDown(self):
+        lti.inTransduce = False
+
+    def testSteppedByDefault(self):
+        m = accumulator()
+        expected = []
+        m.start()
+        for inp in self.inps:
+            expected.append(m.step(inp))
+        state = m.state
+        self.assertEqual(m.transduce(self.inps), expected)
+        self.assertEqual(m.state, state)
+        self.assertEqual(type(accumulator().transduce([1.0])[0]), int)
+
+    @unittest.skipIf(lti.numpy is None, 'needs NumPy')
+    def testOptIn(self):
+        m = accumulator()
+        expected = m.transduce(self.inps)
+        lti.inTransduce = True
+        for (a, b) in zip(m.transduce(self.inps), expected):
+            self.assertAlmostEqual(a / b if b else a, 1.0 if b else 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
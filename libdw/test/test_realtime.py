@@ -0,0 +1,115 @@
+import time
+import unittest
+from libdw import sm, realtime
+
+class Slow(sm.SM):
+    startState = 0
+    def getNextValues(self, state, inp):
+        time.sleep(0.003)
+        return (state + 1, state)
+
+class FakeTime:
+    """
+    Clock that only moves when something sleeps or works;  stands in
+    for both C{realtime.clock} and the C{time} module
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+    def __call__(self):
+        return self.now
+    def sleep(self, t):
+        self.sleeps.append(t)
+        self.now += t
+
+class Busy(sm.SM):
+    """Each step takes C{cost} seconds of the fake clock"""
+    startState = 0
+    def __init__(self, fake, cost):
+        self.fake = fake
+        self.cost = cost
+        self.starts = []
+    def getNextValues(self, state, inp):
+        self.starts.append(self.fake.now)
+        self.fake.now += self.cost
+        return (state + 1, state)
+
+class RealtimeRunnerTest(unittest.TestCase):
+    def testSteps(self):
+        out = []
+        runner = realtime.RealtimeRunner(sm.R(0), 0.001,
+                                         realtime.Latest(1), out.append)
+        self.assertEqual(runner.runFor(n = 5), 5)
+        self.assertEqual(out, [0, 1, 1, 1, 1])
+        self.assertEqual(runner.steps, 5)
+        self.assertEqual(runner.latency.n, 5)
+
+    def testStepsCountedWhileRunning(self):
+        runner = realtime.RealtimeRunner(sm.R(0), 0.001)
+        runner.start()
+        time.sleep(0.05)
+        self.assertTrue(runner.steps > 0)
+        runner.stop()
+        self.assertEqual(runner.steps, runner.latency.n)
+
+    def testDurationIsWallTime(self):
+        runner = realtime.RealtimeRunner(Slow(), 0.001, policy = 'catchUp')
+        t = time.time()
+        runner.runFor(duration = 0.05)
+        self.assertTrue(time.time() - t < 0.05 + 0.02)
+
+    def testSkip(self):
+        runner = realtime.RealtimeRunner(Slow(), 0.001)
+        runner.runFor(n = 5)
+        self.assertTrue(runner.skipped > 0)
+        self.assertEqual(runner.overrun.n, 5)
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeTime()
+        self.saved = (realtime.clock, realtime.time)
+        realtime.clock = self.fake
+        realtime.time = self.fake
+
+    def tearDown(self):
+        (realtime.clock, realtime.time) = self.saved
+
+    def testOnSchedule(self):
+        m = Busy(self.fake, 0.25)
+        runner = realtime.RealtimeRunner(m, 1.0)
+        self.assertEqual(runner.runFor(n = 4), 4)
+        self.assertEqual(m.starts, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(runner.skipped, 0)
+        self.assertEqual(runner.overrun.n, 0)
+
+    def testSkipDeadlines(self):
+        # A step of 2.5 periods misses the next two deadlines, and the
+        # one after starts on the third
+        m = Busy(self.fake, 2.5)
+        runner = realtime.RealtimeRunner(m, 1.0)
+        runner.runFor(n = 4)
+        self.assertEqual(m.starts, [0.0, 3.0, 6.0, 9.0])
+        self.assertEqual(runner.skipped, 8)
+        self.assertEqual(runner.jitter.max, 0.0)
+        self.assertEqual(runner.overrun.n, 4)
+
+    def testCatchUp(self):
+        m = Busy(self.fake, 2.5)
+        runner = realtime.RealtimeRunner(m, 1.0, policy = 'catchUp')
+        runner.runFor(n = 4)
+        self.assertEqual(m.starts, [0.0, 2.5, 5.0, 7.5])
+        self.assertEqual(runner.skipped, 0)
+        self.assertEqual(self.fake.sleeps, [])
+        self.assertEqual(runner.jitter.max, 4.5)
+
+    def testDuration(self):
+        # The wait for the deadline at 4 is cut short at the end of the
+        # run, and no step is taken then
+        m = Busy(self.fake, 0.1)
+        runner = realtime.RealtimeRunner(m, 1.0)
+        self.assertEqual(runner.runFor(duration = 3.5), 4)
+        self.assertEqual(m.starts, [0.0, 1.0, 2.0, 3.0])
+        self.assertAlmostEqual(self.fake.now, 3.5)
+
+if __name__ == '__main__':
+    unittest.main()
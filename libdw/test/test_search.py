@@ -0,0 +1,104 @@
+import unittest
+from libdw import sm, search
+
+class NumberLine(sm.SM):
+    """
+    Moves along the integers by the input;  the output is the cost of
+    the move.  Counts its calls to C{getNextValues}.
+    """
+    startState = 1
+    legalInputs = ['x2', '+1', '-1']
+    def __init__(self):
+        self.calls = 0
+    def getNextValues(self, state, inp):
+        self.calls += 1
+        if inp == 'x2':
+            return (state * 2, 3)
+        elif inp == '+1':
+            return (state + 1, 1)
+        else:
+            return (state - 1, 1)
+
+class Bounded(NumberLine):
+    """Stops at 5, so 10 can't be reached by going up"""
+    def done(self, state):
+        return state == 5
+
+def inputs(path):
+    return [inp for (inp, s) in path[1:]]
+
+def cost(path):
+    return sum(NumberLine().transduce(inputs(path)))
+
+def isTen(s):
+    return s == 10
+
+class SearchTest(unittest.TestCase):
+    def testBreadthFirst(self):
+        path = search.breadthFirst(NumberLine(), isTen)
+        self.assertEqual(path[0], (None, 1))
+        self.assertEqual(path[-1][1], 10)
+        # 1 -> 2 -> 4 -> 5 -> 10 is the fewest steps
+        self.assertEqual(len(path), 5)
+        m = NumberLine()
+        m.transduce(inputs(path))
+        self.assertEqual(m.state, 10)
+
+    def testUniformCost(self):
+        path = search.uniformCost(NumberLine(), isTen)
+        self.assertEqual(path[-1][1], 10)
+        self.assertEqual(cost(path), 7)
+
+    def testAStar(self):
+        path = search.aStar(NumberLine(), isTen, lambda s: 0)
+        self.assertEqual(path[-1][1], 10)
+        self.assertEqual(cost(path), 7)
+
+    def testCost(self):
+        # With every step costing 1, the cheapest path is the shortest
+        path = search.uniformCost(NumberLine(), isTen, cost = lambda o: 1)
+        self.assertEqual(len(path), 5)
+
+    def testVisitedOnce(self):
+        # Each state found is stepped with every input at most once
+        m = NumberLine()
+        model = search.TransitionModel(m)
+        search.breadthFirst(m, isTen, model = model)
+        stepped = [k for k in model.known if k == model.STEPPED]
+        self.assertEqual(m.calls, 3 * len(stepped))
+
+    def testMemoized(self):
+        m = NumberLine()
+        model = search.TransitionModel(m)
+        first = search.uniformCost(m, isTen, model = model)
+        calls = m.calls
+        expanded = model.expanded
+        self.assertEqual(search.uniformCost(m, isTen, model = model), first)
+        # The second search takes every step from the tables
+        self.assertEqual(m.calls, calls)
+        self.assertTrue(model.expanded > expanded)
+
+    def testNotMemoized(self):
+        m = NumberLine()
+        model = search.TransitionModel(m, memoize = False)
+        search.uniformCost(m, isTen, model = model)
+        calls = m.calls
+        search.uniformCost(m, isTen, model = model)
+        self.assertEqual(m.calls, 2 * calls)
+
+    def testDone(self):
+        m = Bounded()
+        path = search.breadthFirst(m, isTen)
+        # 5 can't be left, so 1, 2, 4, 8, 9, 10 is the shortest path
+        self.assertTrue(5 not in [s for (i, s) in path[:-1]])
+        self.assertEqual(path[-1][1], 10)
+        self.assertEqual(len(path), 6)
+
+    def testNoPath(self):
+        self.assertEqual(search.breadthFirst(NumberLine(), lambda s: s == 0.5,
+                                             maxNodes = 50), None)
+        self.assertEqual(search.aStar(NumberLine(), lambda s: s == 0.5,
+                                      lambda s: 0, maxNodes = 50), None)
+
+if __name__ == '__main__':
+    unittest.main()
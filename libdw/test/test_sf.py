@@ -0,0 +1,79 @@
+import cmath
+import unittest
+from libdw import sm, sf
+
+def lowPass():
+    return sm.FeedbackAdd(sm.Cascade(sm.Gain(0.5), sm.R(0.0)),
+                          sm.Gain(0.25))
+
+def secondOrder():
+    return sm.FeedbackSubtract(sm.CascadeN([sm.Gain(0.8), sm.R(0.0),
+                                            sm.R(0.0)]),
+                               sm.ParallelAddN([sm.Gain(0.5), sm.R(0.0)]))
+
+def powerSeries(h, n):
+    """
+    First C{n} coefficients of C{h} as a power series in R:  the
+    response to an impulse
+    """
+    num = h.numerator + [0.0] * n
+    den = h.denominator + [0.0] * n
+    result = []
+    for k in range(n):
+        result.append(num[k] - sum([den[i] * result[k - i] \
+                                    for i in range(1, k + 1)]))
+    return result
+
+class SystemFunctionTest(unittest.TestCase):
+    def testCoefficients(self):
+        h = sf.systemFunction(lowPass())
+        self.assertEqual(h.numerator, [0.0, 0.5])
+        self.assertEqual(h.denominator, [1.0, -0.125])
+        h = sf.systemFunction(sm.CascadeN([sm.Gain(2), sm.R(), sm.Wire()]))
+        self.assertEqual((h.numerator, h.denominator), ([0.0, 2.0], [1.0]))
+
+    def testNotLinear(self):
+        self.assertEqual(sf.systemFunction(sm.PureFunction(abs)), None)
+        self.assertEqual(sf.systemFunction(sm.Gain('k')), None)
+        self.assertEqual(sf.systemFunction(sm.Cascade(sm.R(0),
+                                                      sm.Select(0))), None)
+
+    def testDelayFree(self):
+        loop = sm.FeedbackAdd(sm.Wire(), sm.Wire())
+        self.assertEqual(sf.systemFunction(loop), None)
+
+    def testImpulseResponse(self):
+        for m in (lowPass(), secondOrder()):
+            h = sf.systemFunction(m)
+            impulse = m.transduce([1.0] + [0.0] * 19)
+            for (y, expected) in zip(impulse, powerSeries(h, 20)):
+                self.assertAlmostEqual(y, expected)
+
+    def testStartStateIgnored(self):
+        h = sf.systemFunction(sm.FeedbackAdd(sm.R(5.0), sm.Gain(0.5)))
+        self.assertEqual((h.numerator, h.denominator), ([0.0, 1.0],
+                                                        [1.0, -0.5]))
+
+    @unittest.skipIf(sf.numpy is None, 'needs NumPy')
+    def testPoles(self):
+        h = sf.systemFunction(lowPass())
+        self.assertEqual(len(h.poles()), 1)
+        self.assertAlmostEqual(h.dominantPole(), 0.125)
+        self.assertTrue(h.isStable())
+        h = sf.systemFunction(secondOrder())
+        self.assertEqual(len(h.poles()), 3)
+        growing = sf.systemFunction(sm.FeedbackAdd(sm.R(0), sm.Gain(2)))
+        self.assertAlmostEqual(growing.dominantPole(), 2)
+        self.assertFalse(growing.isStable())
+
+    @unittest.skipIf(sf.numpy is None, 'needs NumPy')
+    def testFrequencyResponse(self):
+        h = sf.systemFunction(lowPass())
+        omegas = sf.numpy.linspace(0, 3, 7)
+        response = h.frequencyResponse(omegas)
+        for (w, r) in zip(omegas, response):
+            z = cmath.exp(-1j * w)
+            self.assertAlmostEqual(r, 0.5 * z / (1 - 0.125 * z))
+
+if __name__ == '__main__':
+    unittest.main()
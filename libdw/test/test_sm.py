@@ -1 +1,703 @@
+import StringIO
+import gc
+import os
+import itertools
+import random
+import sys
+import unittest
+import weakref
+from libdw import sm, tracestore
 
+class Counter(sm.SM):
+    """
+    Counts up to C{n - 1}, then starts again at 0;  counts the calls
+    of getNextValues
+    """
+    startState = 0
+    def __init__(self, n):
+        self.n = n
+        self.calls = 0
+    def getNextValues(self, state, inp):
+        self.calls = self.calls + 1
+        return ((state + 1) % self.n, state)
+
+def printed(f, *args, **keys):
+    """
+    @return: pair of the result of calling C{f} and what it printed
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        result = f(*args, **keys)
+        return (result, sys.stdout.getvalue())
+    finally:
+        sys.stdout = stdout
+
+def lowPass():
+    return sm.FeedbackAdd(sm.Cascade(sm.Gain(0.5), sm.R(0.0)),
+                          sm.Gain(0.25))
+
+class CountedGain(sm.Gain):
+    """
+    Gain that counts the calls of its own getNextValues
+    """
+    def __init__(self, k):
+        sm.Gain.__init__(self, k)
+        self.calls = 0
+    def getNextValues(self, state, inp):
+        self.calls = self.calls + 1
+        return sm.Gain.getNextValues(self, state, inp)
+
+class Counted(sm.R):
+    def __init__(self):
+        sm.R.__init__(self, 0)
+        self.steps = 0
+    def step(self, inp):
+        self.steps = self.steps + 1
+        return sm.R.step(self, inp)
+
+class Token:
+    pass
+
+class TransduceIterTest(unittest.TestCase):
+    def testLazy(self):
+        m = sm.Cascade(sm.Gain(2), sm.R(0))
+        outs = m.transduceIter(itertools.count())
+        self.assertEqual(list(itertools.islice(outs, 4)), [0, 0, 2, 4])
+        self.assertEqual(m.state, (None, 6))
+
+    def testConstantMemory(self):
+        # Only the current state and output of an endless run are kept
+        alive = []
+        def tokens():
+            while True:
+                t = Token()
+                alive.append(weakref.ref(t))
+                yield t
+        outs = sm.R(None).transduceIter(tokens())
+        for o in itertools.islice(outs, 1000):
+            pass
+        del o
+        gc.collect()
+        self.assertTrue(len([r for r in alive if r() is not None]) <= 2)
+
+    def testRunIter(self):
+        c = Counter(3)
+        self.assertEqual(list(itertools.islice(c.runIter(), 5)),
+                         [0, 1, 2, 0, 1])
+        self.assertEqual(list(c.runIter(4)), c.run(4))
+        self.assertEqual(list(CountDown().runIter()), [2, 1, 0])
+
+class CountDown(sm.SM):
+    startState = 3
+    def getNextValues(self, state, inp):
+        return (state - 1, state - 1)
+    def done(self, state):
+        return state == 0
+
+class StopAtThree(sm.Cascade):
+    def done(self, state):
+        return state[1] >= 3
+
+class StepLoopTest(unittest.TestCase):
+    def testOwnStepIsCalled(self):
+        m = Counted()
+        self.assertEqual(m.transduce([1, 2, 3]), [0, 1, 2])
+        self.assertEqual(m.steps, 3)
+        self.assertEqual(list(m.transduceIter([1, 2])), [0, 1])
+        self.assertEqual(m.steps, 5)
+        self.assertEqual(m.transduce([1, 2, 3], inPlace = True), [0, 1, 2])
+        self.assertEqual(m.steps, 8)
+        self.assertEqual(m.state, 3)
+
+    def testStopsWhenDone(self):
+        m = CountDown()
+        self.assertEqual(m.transduce(range(10)), [2, 1, 0])
+        self.assertEqual(list(m.transduceIter(range(10))), [2, 1, 0])
+        self.assertEqual(m.transduce(range(10), inPlace = True), [2, 1, 0])
+
+    def testCompositionWithOwnDone(self):
+        m = StopAtThree(sm.Wire(), sm.R(0))
+        self.assertTrue(m.canTerminate())
+        self.assertEqual(m.transduce(range(10)), [0, 0, 1, 2])
+        self.assertEqual(list(m.transduceIter(range(10))), [0, 0, 1, 2])
+        outer = sm.Cascade(StopAtThree(sm.Wire(), sm.R(0)), sm.Wire())
+        self.assertEqual(outer.transduce(range(10)), [0, 0, 1, 2])
+        self.assertFalse(sm.Cascade(sm.Wire(), sm.R(0)).canTerminate())
+
+class Wrapper(sm.SM):
+    """
+    Composite that doesn't list its part in subMachines, and prints it
+    with its own printDebugInfo
+    """
+    def __init__(self, m):
+        self.m = m
+    def startState(self):
+        return self.m.getStartState()
+    def getNextValues(self, state, inp):
+        return self.m.getNextValues(state, inp)
+    def printDebugInfo(self, depth, state, nextState, inp, out, debugParams):
+        self.m.printDebugInfo(depth + 4, state, nextState, inp, out,
+                              debugParams)
+
+class TraceTasksTest(unittest.TestCase):
+    def testTraceByName(self):
+        m = sm.Cascade(sm.Gain(2), sm.R(0))
+        m.m2.name = 'delay'
+        fired = []
+        m.transduce([1, 2, 3],
+                    traceTasks = [('delay', 'state', fired.append)])
+        self.assertEqual(fired, [0, 2, 4])
+
+    def testInsideOwnPrintDebugInfo(self):
+        inner = sm.R(0)
+        inner.name = 'inner'
+        fired = []
+        sm.Cascade(Wrapper(inner), sm.Wire()).transduce(
+            [1, 2, 3], traceTasks = [('inner', 'output', fired.append)])
+        self.assertEqual(fired, [0, 1, 2])
+
+class DebugTest(unittest.TestCase):
+    def testStepsOnce(self):
+        # Printing the steps of the parts doesn't run them again
+        c = Counter(4)
+        c.name = 'counter'
+        m = sm.Cascade(c, sm.Gain(2))
+        (outs, text) = printed(m.transduce, range(6), verbose = True,
+                               compact = False)
+        self.assertEqual(outs, [0, 2, 4, 6, 0, 2])
+        self.assertEqual(c.calls, 6)
+        self.assertEqual(text.count('counter In:'), 6)
+        self.assertEqual(text.count('Step:'), 6)
+
+    def testFeedbackStepsOnce(self):
+        c = Counter(3)
+        m = sm.Feedback(sm.Cascade(c, sm.R(0)))
+        printed(m.run, 4, verbose = True, compact = False)
+        self.assertEqual(c.calls, 4)
+
+    def testFeedbackTrace(self):
+        m = lowPass()
+        m.m1.m2.name = 'delay'
+        states = []
+        outs = m.transduce([1.0] * 5,
+                           traceTasks = [('delay', 'state', states.append)])
+        self.assertEqual(outs, [0.0, 0.5, 0.5625, 0.5703125, 0.5712890625])
+        self.assertEqual(states, outs)
+
+class ProfilerTest(unittest.TestCase):
+    def testPaths(self):
+        r = sm.R(0)
+        r.name = 'r'
+        m = sm.Cascade(sm.Parallel(r, sm.Gain(3)), sm.Select(0), name = 'top')
+        (m.m1.name, m.m1.m2.name, m.m2.name) = ('par', 'g', 'sel')
+        profiler = sm.Profiler()
+        self.assertEqual(m.transduce(range(5), profiler = profiler),
+                         [0, 0, 1, 2, 3])
+        self.assertEqual(sorted(profiler.entries.keys()),
+                         [('top',), ('top', 'par'), ('top', 'par', 'g'),
+                          ('top', 'par', 'r'), ('top', 'sel')])
+        for e in profiler.entries.values():
+            self.assertEqual(e.calls, 5)
+            self.assertTrue(0 <= e.selfTime() <= e.cumulative)
+        top = profiler.entries[('top',)]
+        self.assertEqual(top.state, m.state)
+        (ignore, text) = printed(profiler.report, limit = 2)
+        self.assertEqual(len(text.splitlines()), 3)
+
+    def testRemovedAfterRun(self):
+        m = sm.Cascade(sm.R(0), sm.Gain(3))
+        m.transduce(range(3), profiler = sm.Profiler())
+        for x in (m, m.m1, m.m2):
+            self.assertFalse('getNextValues' in x.__dict__)
+
+    def testSharedMachine(self):
+        # A machine reached by two paths gets an entry for each
+        g = sm.Gain(2)
+        g.name = 'g'
+        m = sm.Cascade(g, g, name = 'top')
+        profiler = sm.Profiler()
+        m.transduce(range(4), profiler = profiler)
+        self.assertEqual(sorted(profiler.entries.keys()),
+                         [('top',), ('top', 'g')])
+        self.assertEqual(profiler.entries[('top', 'g')].calls, 8)
+
+def scaled(k, v0 = 0.0):
+    return sm.Cascade(sm.Gain(k), sm.R(v0))
+
+class WhichProcess(sm.SM):
+    def getNextValues(self, state, inp):
+        return (state, os.getpid())
+
+def whichProcess(i):
+    return WhichProcess()
+
+class SweepTest(unittest.TestCase):
+    def testGrid(self):
+        results = list(sm.sweep(scaled, {'k': [1, 2], 'v0': [0.0, 5.0]},
+                                [1.0, 2.0], workers = 1))
+        self.assertEqual(sorted([(sorted(s.items()), o) for (s, o) in results]),
+                         [([('k', 1), ('v0', 0.0)], [0.0, 1.0]),
+                          ([('k', 1), ('v0', 5.0)], [5.0, 1.0]),
+                          ([('k', 2), ('v0', 0.0)], [0.0, 2.0]),
+                          ([('k', 2), ('v0', 5.0)], [5.0, 2.0])])
+
+    def testSettingKinds(self):
+        self.assertEqual(list(sm.sweep(scaled, [2, (3, 1.0)], [1.0],
+                                       workers = 1)),
+                         [(2, [0.0]), ((3, 1.0), [1.0])])
+
+    def testWorkers(self):
+        results = list(sm.sweep(whichProcess, range(8), [None], workers = 2))
+        self.assertEqual(sorted([s for (s, o) in results]), range(8))
+        pids = set([o[0] for (s, o) in results])
+        self.assertFalse(os.getpid() in pids)
+        inputs = [0.5 * i for i in range(10)]
+        results = dict(sm.sweep(scaled, [1, 2, 3], inputs, workers = 2))
+        self.assertEqual(results[3], scaled(3).transduce(inputs))
+
+    def testSharedInputs(self):
+        shared = sm.shareInputs([1.0, 2.0])
+        self.assertEqual(list(shared), [1.0, 2.0])
+        self.assertFalse(isinstance(shared, list))
+        self.assertEqual(sm.shareInputs([1, None]), [1, None])
+
+class RandomWalk(sm.SM):
+    startState = 0.0
+    def getNextValues(self, state, inp):
+        state = state + random.gauss(0, 1)
+        return (state, state)
+
+class EnsembleTest(unittest.TestCase):
+    def testInProcess(self):
+        random.seed(3)
+        expected = [random.random() for i in range(3)]
+        random.seed(3)
+        stats = sm.ensemble(RandomWalk(), 50, [None] * 10, workers = 1)
+        self.assertEqual([random.random() for i in range(3)], expected)
+        self.assertEqual(stats.count, [50] * 10)
+        again = sm.ensemble(RandomWalk(), 50, [None] * 10, workers = 1)
+        self.assertEqual(stats.mean(), again.mean())
+
+class InPlaceTest(unittest.TestCase):
+    def machine(self):
+        return sm.FeedbackAdd(sm.CascadeN([sm.Gain(0.5), sm.R(1.0)]),
+                              sm.ParallelAdd(sm.Wire(), sm.R(0.0)))
+
+    def testSameOutputs(self):
+        inps = [1.0, 0.0, -2.0, 3.0] * 5
+        m = self.machine()
+        expected = m.transduce(inps)
+        state = m.state
+        self.assertEqual(m.transduce(inps, inPlace = True), expected)
+        self.assertEqual(m.state, state)
+
+    def testAssignState(self):
+        m = self.machine()
+        m.start(inPlace = True)
+        m.step(1.0)
+        saved = m.state
+        first = [m.step(2.0) for i in range(3)]
+        m.state = saved
+        self.assertEqual([m.step(2.0) for i in range(3)], first)
+
+    def testAttributeError(self):
+        for m in (sm.R(0), sm.Run(sm.R(0))):
+            try:
+                m.nmae
+            except AttributeError, e:
+                self.assertEqual(str(e), "%s instance has no attribute "
+                                 "'nmae'" % m.__class__.__name__)
+            else:
+                self.fail()
+
+class RunTest(unittest.TestCase):
+    def testIndependentRuns(self):
+        m = sm.Cascade(sm.Gain(2), sm.R(0))
+        (a, b) = (sm.Run(m), sm.Run(m))
+        self.assertEqual(a.transduce([1, 2]), [0, 2])
+        self.assertEqual(b.transduce([5]), [0])
+        self.assertEqual(a.transduce([3]), [4])
+        self.assertEqual(m.transduce([1, 2, 3]), [0, 2, 4])
+
+    def testInPlace(self):
+        m = sm.Cascade(sm.Gain(2), sm.R(0))
+        r = sm.Run(m, inPlace = True)
+        self.assertEqual(r.transduce([1, 2, 3]), [0, 2, 4])
+        self.assertEqual(r.state, (None, 6))
+
+    def testNamedAtStart(self):
+        inner = sm.R(0)
+        m = sm.Cascade(Wrapper(inner), sm.Wire())
+        recorder = tracestore.TraceRecorder()
+        try:
+            sm.Run(m, recorder = recorder)
+            for x in (m, m.m1, m.m2, inner):
+                self.assertTrue(x.name)
+        finally:
+            recorder.discard()
+
+class TransduceBatchTest(unittest.TestCase):
+    def testLanes(self):
+        m = sm.Cascade(sm.Gain(2), sm.R(0))
+        inputs = [[1, 2, 3], [], [5], [1, 1, 1, 1]]
+        self.assertEqual(sm.transduceBatch(m, inputs),
+                         [[0, 2, 4], [], [0], [0, 2, 2, 2]])
+        self.assertFalse('state' in m.__dict__)
+
+    def testLanesStopWhenDone(self):
+        m = sm.ParallelN([sm.Wire(), CountDown()])
+        self.assertEqual(sm.transduceBatch(m, [range(5), range(2)]),
+                         [[(0, 2), (1, 1), (2, 0)], [(0, 2), (1, 1)]])
+
+    def testFeedback(self):
+        m = sm.Feedback(sm.Cascade(sm.Gain(2), sm.R(1)))
+        self.assertEqual(sm.transduceBatch(m, [[None] * 4, [None] * 2]),
+                         [[1, 2, 4, 8], [1, 2]])
+
+    @unittest.skipIf(sm.numpy is None, 'needs NumPy')
+    def testArrayStepsOnce(self):
+        # With an array of inputs, each step is one batched operation,
+        # not one call of getNextValues per lane
+        g = CountedGain(0.5)
+        m = sm.FeedbackAdd(sm.Cascade(g, sm.R(0.0)), sm.Gain(0.25))
+        inputs = sm.numpy.arange(12.0).reshape(3, 4)
+        self.assertEqual(sm.transduceBatch(m, inputs),
+                         [lowPass().transduce(list(row)) for row in inputs])
+        self.assertEqual(g.calls, 0)
+
+class CompileTest(unittest.TestCase):
+    def testSameOutputs(self):
+        m = sm.FeedbackAdd(sm.Cascade(sm.Gain(0.5), sm.R(0.0)),
+                           sm.Gain(-1.0))
+        inps = [1.0, 2.0, -1.0, 0.5] * 5
+        self.assertEqual(sm.compile(m).transduce(inps), m.transduce(inps))
+
+    def testUndefinedInput(self):
+        m = sm.Cascade(sm.Gain(0.5), sm.R(1.0))
+        self.assertEqual(sm.Feedback(sm.compile(m)).run(5),
+                         sm.Feedback(m).run(5))
+        m = sm.Cascade(sm.Gain(2), sm.R(1))
+        c = sm.compile(m)
+        c.start()
+        self.assertEqual(c.step('undefined'), 1)
+        self.assertEqual(c.step('undefined'), 'undefined')
+
+    def testDelayedOutput(self):
+        m = sm.Cascade(sm.Gain(0.5), sm.R(1.0))
+        c = sm.compile(m)
+        self.assertEqual(c.dependsOnInput, False)
+        self.assertEqual(c.getDelayedOutput(c.getStartState()), 1.0)
+        self.assertEqual(sm.transduceBatch(sm.Feedback(c), [[None] * 4] * 2),
+                         [sm.Feedback(m).run(4)] * 2)
+
+    def testEmptyInput(self):
+        m = sm.Cascade(sm.Wire(), sm.PureFunction(len))
+        self.assertEqual(sm.compile(m).transduce([(), [], (1, 2)]), [0, 0, 2])
+
+    def testFlat(self):
+        m = sm.Cascade(sm.Cascade(sm.Gain(2), sm.R(0)),
+                       sm.Cascade(CountDown(), sm.R(5)))
+        c = sm.compile(m)
+        # The primitives are inlined;  only CountDown is called
+        self.assertEqual(c.source.count('getNextValues'), 1)
+        self.assertEqual(c.getStartState(), (0, 3, 5))
+        self.assertEqual(c.transduce(range(5)), m.transduce(range(5)))
+        self.assertEqual(c.state, (4, 0, 0))
+
+def accumulator():
+    return sm.FeedbackAdd(sm.R(0), sm.Wire())
+
+class AdvanceTest(unittest.TestCase):
+    @unittest.skipIf(sm.numpy is None, 'needs NumPy')
+    def testLinear(self):
+        (a, b) = (lowPass(), lowPass())
+        a.start()
+        b.start()
+        o = a.advance(50, 1.0)
+        for i in range(50):
+            p = b.step(1.0)
+        self.assertAlmostEqual(o, p)
+        self.assertAlmostEqual(a.step(1.0), b.step(1.0))
+
+    @unittest.skipIf(sm.numpy is None, 'needs NumPy')
+    def testClosedForm(self):
+        # Far too many steps to take one at a time;  the output settles
+        # at 0.5 / (1 - 0.125) of the input
+        m = lowPass()
+        m.start()
+        self.assertAlmostEqual(m.advance(10 ** 12, 7.0), 4.0)
+
+    def testIntegers(self):
+        (a, b) = (accumulator(), accumulator())
+        a.start()
+        b.start()
+        o = a.advance(10, 3)
+        for i in range(10):
+            p = b.step(3)
+        self.assertEqual(o, p)
+        self.assertEqual(a.state, b.state)
+        self.assertTrue(isinstance(o, int))
+        self.assertTrue(isinstance(a.state[0], int))
+
+    def testStepped(self):
+        c = Counter(7)
+        c.start()
+        self.assertEqual(c.advance(10), 2)
+        self.assertEqual(c.state, 3)
+        self.assertEqual(c.calls, 10)
+
+    def testDone(self):
+        m = CountDown()
+        m.start()
+        self.assertEqual(m.advance(10), 0)
+        self.assertEqual(m.state, 0)
+        self.assertEqual(m.advance(10), None)
+
+def countDownFrom(n):
+    """Counts down from C{n - 1} to 0, then stays there"""
+    return sm.Feedback(sm.Cascade(sm.PureFunction(lambda x: max(x - 1, 0)),
+                                  sm.R(n)))
+
+class RunPeriodicTest(unittest.TestCase):
+    def testCycle(self):
+        c = Counter(5)
+        self.assertEqual(c.runPeriodic(compact = True), ([], [0, 1, 2, 3, 4]))
+        outs = c.runPeriodic(12)
+        self.assertEqual(len(outs), 12)
+        self.assertEqual(outs.tolist(), Counter(5).run(12))
+
+    def testLazy(self):
+        # A billion steps are known from the few taken to find the cycle
+        c = Counter(5)
+        outs = c.runPeriodic(10 ** 9)
+        self.assertTrue(c.calls < 30)
+        self.assertEqual(len(outs), 10 ** 9)
+        self.assertEqual(outs[10 ** 9 - 1], (10 ** 9 - 1) % 5)
+        self.assertEqual(outs[-1], outs[10 ** 9 - 1])
+        forever = c.runPeriodic()
+        self.assertEqual(forever[10 ** 12 + 3], 3)
+        self.assertEqual(forever[10 ** 12:10 ** 12 + 3], [0, 1, 2])
+        self.assertRaises(Exception, len, forever)
+
+    def testPrefix(self):
+        m = countDownFrom(3)
+        self.assertEqual(m.runPeriodic(compact = True), ([3, 2, 1], [0]))
+        self.assertEqual(m.runPeriodic(6).tolist(), m.run(6))
+        self.assertEqual(m.runPeriodic(2).tolist(), [3, 2])
+
+    def testNotStarted(self):
+        c = Counter(5)
+        c.start()
+        c.step(None)
+        c.runPeriodic(10)
+        self.assertEqual(c.state, 1)
+
+    def testDone(self):
+        outs = CountDown().runPeriodic()
+        self.assertEqual(len(outs), 3)
+        self.assertEqual(outs.tolist(), [2, 1, 0])
+
+class RunSteadyTest(unittest.TestCase):
+    def testConvergedAt(self):
+        # Outputs 5, 4, 3, 2, 1, 0, 0, ...;  from step 7 on, nothing
+        # changes, and after 3 such steps the run stops
+        m = countDownFrom(5)
+        outs = m.runSteady(100, tolerance = 0, window = 3)
+        self.assertEqual(outs.convergedAt, 9)
+        self.assertEqual(outs.prefix, [5, 4, 3, 2, 1, 0, 0, 0, 0])
+        self.assertEqual(m.state, (None, 0))
+        self.assertEqual(countDownFrom(5).runSteady(100, tolerance = 0,
+                                                    window = 1).convergedAt,
+                         7)
+
+    def testStepsTaken(self):
+        c = CountedGain(1)
+        down = sm.PureFunction(lambda x: max(x - 1, 0))
+        m = sm.Feedback(sm.Cascade(sm.Cascade(down, c), sm.R(5)))
+        m.runSteady(10 ** 9, tolerance = 0, window = 3)
+        self.assertEqual(c.calls, 9)
+
+    def testRest(self):
+        m = lowPass()
+        outs = m.runSteady(1000, inp = 1.0)
+        self.assertTrue(outs.convergedAt < 100)
+        self.assertEqual(len(outs), 1000)
+        expected = lowPass().transduce([1.0] * 1000)
+        k = outs.convergedAt
+        self.assertEqual(outs[:k], expected[:k])
+        # Every later output is the last one computed
+        self.assertEqual(set(outs[k - 1:]), set([outs[k - 1]]))
+        self.assertAlmostEqual(outs[999], 4.0 / 7, places = 8)
+
+    def testNotSettled(self):
+        outs = Counter(3).runSteady(20)
+        self.assertEqual(outs.convergedAt, None)
+        self.assertEqual(len(outs), 20)
+        self.assertEqual(outs.tolist(), Counter(3).run(20))
+
+    def testDone(self):
+        outs = CountDown().runSteady()
+        self.assertEqual(outs.convergedAt, None)
+        self.assertEqual(outs.tolist(), [2, 1, 0])
+
+class SimplifyTest(unittest.TestCase):
+    def testSameOutputs(self):
+        m = sm.Cascade(sm.Cascade(sm.Wire(), sm.Gain(2)),
+                       sm.FeedbackAdd(sm.Cascade(sm.Gain(1), sm.R(0)),
+                                      sm.ParallelAdd(sm.Gain(3), sm.Wire())))
+        small = sm.simplify(m)
+        inps = [1, 0, 2, -1, 3]
+        self.assertEqual(small.transduce(inps), m.transduce(inps))
+
+    def testFusedGains(self):
+        small = sm.simplify(sm.Cascade(sm.Gain(2), sm.Gain(3)))
+        self.assertEqual((small.__class__, small.k), (sm.Gain, 6))
+        small = sm.simplify(sm.ParallelAdd(sm.Gain(3), sm.Wire()))
+        self.assertEqual((small.__class__, small.k), (sm.Gain, 4))
+        # Gains in neighbouring cascades are fused too
+        r = sm.R(0)
+        small = sm.simplify(sm.Cascade(sm.Gain(2), sm.Cascade(sm.Gain(3), r)))
+        self.assertEqual(small.__class__, sm.Cascade)
+        self.assertEqual(small.m1.k, 6)
+        self.assertTrue(small.m2 is r)
+
+    def testIdentities(self):
+        r = sm.R(0)
+        self.assertTrue(sm.simplify(sm.Cascade(sm.Wire(), r)) is r)
+        self.assertTrue(sm.simplify(sm.Cascade(r, sm.Gain(1))) is r)
+        m = sm.CascadeN([sm.Wire(), sm.Gain(2), sm.Gain(1), r, sm.Wire()])
+        small = sm.simplify(m)
+        self.assertEqual(len(small.smList), 2)
+        self.assertTrue(small.smList[1] is r)
+        # A symbolic gain is not an identity
+        m = sm.Cascade(sm.Gain('k'), r)
+        self.assertEqual(sm.simplify(m).m1.k, 'k')
+
+    def testConstantFolding(self):
+        calls = []
+        def square(x):
+            calls.append(x)
+            return x * x
+        m = sm.Cascade(sm.Constant(3), sm.PureFunction(square))
+        small = sm.simplify(m)
+        self.assertEqual(small.__class__, sm.Constant)
+        self.assertEqual(small.transduce([None] * 3), [9, 9, 9])
+        self.assertEqual(calls, [3])
+        small = sm.simplify(sm.Cascade(sm.Constant(3), sm.Gain(5)))
+        self.assertEqual((small.__class__, small.c), (sm.Constant, 15))
+
+    def testSelect(self):
+        r = sm.R(0)
+        m = sm.Cascade(sm.Parallel(r, sm.Gain(2)), sm.Select(0))
+        self.assertTrue(sm.simplify(m) is r)
+        # The other branch could end the run, so it stays
+        m = sm.Cascade(sm.Parallel(r, CountDown()), sm.Select(0))
+        self.assertEqual(sm.simplify(m).__class__, sm.Cascade)
+
+    def testOriginalUnchanged(self):
+        inner = sm.Cascade(sm.Wire(), sm.Gain(2))
+        m = sm.Feedback(sm.Cascade(inner, sm.R(1)))
+        small = sm.simplify(m)
+        self.assertTrue(m.m.m1 is inner)
+        self.assertEqual(inner.m1.__class__, sm.Wire)
+        self.assertEqual(small.m.m1.__class__, sm.Gain)
+        self.assertEqual(small.run(3), m.run(3))
+
+    def testVerbose(self):
+        (small, out) = printed(sm.simplify,
+                               sm.Cascade(sm.Gain(2), sm.Gain(3)),
+                               verbose = True)
+        self.assertEqual(out, 'Fused Gain and Gain into Gain(6)\n')
+        (small, out) = printed(sm.simplify,
+                               sm.Cascade(sm.Gain(2), sm.Gain(3)))
+        self.assertEqual(out, '')
+
+class CompileSharingTest(unittest.TestCase):
+    def testDeterministicShared(self):
+        f = lowPass()
+        # Different inputs, so f is run twice
+        m = sm.ParallelAdd(f, sm.Cascade(sm.Gain(2), f))
+        self.assertEqual(len(sm.compile(m).leaves), 2)
+        m = sm.ParallelAdd(f, f)
+        c = sm.compile(m)
+        self.assertEqual(len(c.leaves), 1)
+        inps = [1.0, 0.0, 2.0, -1.0]
+        self.assertEqual(c.transduce(inps), m.transduce(inps))
+
+    def testRandomNotShared(self):
+        noise = sm.PureFunction(lambda x: random.random())
+        outs = sm.compile(sm.Parallel(noise, noise)).transduce([None] * 10)
+        for (a, b) in outs:
+            self.assertNotEqual(a, b)
+
+    def testOptIn(self):
+        calls = []
+        def f(x):
+            calls.append(x)
+            return x
+        p = sm.PureFunction(f)
+        sm.compile(sm.Parallel(p, p)).transduce([1, 2])
+        self.assertEqual(calls, [1, 1, 2, 2])
+        del calls[:]
+        sm.compile(sm.Parallel(p, p), share = True).transduce([1, 2])
+        self.assertEqual(calls, [1, 2])
+        c = Counter(5)
+        self.assertEqual(len(sm.compile(sm.Parallel(c, c)).leaves), 2)
+        self.assertEqual(len(sm.compile(sm.Parallel(c, c),
+                                        share = True).leaves), 1)
+
+class NaryTest(unittest.TestCase):
+    def testCascadeN(self):
+        parts = lambda: [sm.Gain(2), sm.R(1), lowPass(), CountDown()]
+        nested = reduce(sm.Cascade, parts())
+        self.assertEqual(sm.CascadeN(parts()).transduce(range(10)),
+                         nested.transduce(range(10)))
+
+    def testFlatState(self):
+        m = sm.CascadeN([sm.R(1), sm.Gain(2), sm.R(3), Counter(4)])
+        m.start()
+        self.assertEqual(m.state, (1, None, 3, 0))
+        m.step(5)
+        self.assertEqual(m.state, (5, None, 2, 1))
+        m = sm.ParallelAddN([sm.R(1), sm.R(2), sm.R(3)])
+        m.start()
+        self.assertEqual(m.step(10), 6)
+        self.assertEqual(m.state, (10, 10, 10))
+
+    def testDeep(self):
+        # Far deeper than nested Cascades could go without recursing
+        # once per stage
+        depth = 5 * sys.getrecursionlimit()
+        m = sm.CascadeN([sm.R(i) for i in range(depth)])
+        self.assertEqual(m.transduce([-1, -2, -3]),
+                         [depth - 1, depth - 2, depth - 3])
+        self.assertEqual(m.state[:4], (-3, -2, -1, 0))
+        self.assertEqual(len(m.state), depth)
+
+    def testFeedback(self):
+        loop = sm.Feedback(sm.CascadeN([sm.Gain(0.5), sm.R(1.0), sm.Wire()]))
+        self.assertEqual(loop.run(4), [1.0, 0.5, 0.25, 0.125])
+
+    def testParallelN(self):
+        parts = lambda: [sm.Gain(2), sm.R(1), lowPass()]
+        m = sm.ParallelN(parts())
+        n = sm.ParallelAddN(parts())
+        inps = [1.0, 2.0, 3.0]
+        outs = m.transduce(inps)
+        self.assertEqual(n.transduce(inps), [sum(o) for o in outs])
+        self.assertEqual([o[:2] for o in outs],
+                         list(sm.Parallel(sm.Gain(2), sm.R(1)).transduce(inps)))
+
+    def testDone(self):
+        m = sm.ParallelN([sm.Wire(), CountDown()])
+        self.assertTrue(m.canTerminate())
+        self.assertEqual(len(m.transduce(range(10))), 3)
+        self.assertFalse(sm.CascadeN([sm.Wire(), sm.R()]).canTerminate())
+
+    def testBadArguments(self):
+        self.assertRaises(Exception, sm.CascadeN, [])
+        self.assertRaises(Exception, sm.ParallelN, sm.Wire())
+
+if __name__ == '__main__':
+    unittest.main()
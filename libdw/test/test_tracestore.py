@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from libdw import sm, tracestore
+
+class TraceRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.recorders = []
+
+    def tearDown(self):
+        for r in self.recorders:
+            r.discard()
+
+    def recorder(self, **args):
+        r = tracestore.TraceRecorder(**args)
+        self.recorders.append(r)
+        return r
+
+    def testQuery(self):
+        r = self.recorder(names = ['delay'], bufferRows = 7)
+        m = sm.Cascade(sm.Gain(2.0), sm.R(0.0), name = 'top')
+        m.m2.name = 'delay'
+        outs = m.transduce(range(100), recorder = r)
+        self.assertEqual(r.machines(), ['delay'])
+        (steps, values) = r.query('delay', 'output', 10, 20)
+        self.assertEqual(steps, range(10, 20))
+        self.assertEqual(values, outs[10:20])
+        (steps, values) = r.query('delay', 'input', 95)
+        self.assertEqual(values, [2.0 * i for i in range(95, 100)])
+
+    def testZeroWidth(self):
+        r = self.recorder(bufferRows = 4)
+        m = sm.R(0)
+        m.name = 'r'
+        m.transduce([[]] * 10, recorder = r)
+        self.assertEqual(r.query('r', 'input', 2, 5),
+                         ([2, 3, 4], [(), (), ()]))
+
+    def testManyMachines(self):
+        m = sm.CascadeN([sm.Gain(1) for i in range(300)])
+        with self.recorder() as r:
+            m.transduce([1, 2], recorder = r)
+            self.assertEqual(len(r.machines()), 301)
+
+    def testEvery(self):
+        r = self.recorder(every = 10, bufferRows = 3)
+        m = sm.Wire()
+        m.name = 'w'
+        m.transduce(range(100), recorder = r)
+        self.assertEqual(r.query('w', 'output', 15, 55),
+                         (range(20, 60, 10), [20.0, 30.0, 40.0, 50.0]))
+
+    def testDiscard(self):
+        with tracestore.TraceRecorder() as r:
+            sm.R(0).transduce(range(10), recorder = r)
+            self.assertTrue(os.listdir(r.directory))
+        self.assertFalse(os.path.exists(r.directory))
+        directory = tempfile.mkdtemp()
+        try:
+            with tracestore.TraceRecorder(directory = directory) as r:
+                sm.R(0).transduce(range(10), recorder = r)
+            # A directory given by the caller is kept, with the trace
+            self.assertEqual(len(os.listdir(directory)), 4)
+            r.discard()
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
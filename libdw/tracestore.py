@@ -0,0 +1,315 @@
+
+"""
+Recording traces of long runs of state machines.  A C{TraceRecorder}
+keeps, for each traced machine, a column of step numbers and a column
+each for the input, state and output of the machine.  The most recent
+rows of each column are kept in a preallocated buffer, and the rest
+are written out to a file, which is memory-mapped to answer queries;
+so a run of millions of steps can be recorded and queried without
+holding it all in memory.
+
+Values are stored as floating point numbers.  A tuple or list is
+stored as one number per element (recursively), and anything that is
+not a number (like C{None} or C{'undefined'}) is stored as NaN.  The
+number of elements of a column is set by the first value recorded;
+later values with more elements are cut short, and values with fewer
+are padded with NaN.
+
+Typical use::
+
+    with tracestore.TraceRecorder(names = ['plant'], every = 10) as recorder:
+        m.transduce(inputs, recorder = recorder)
+        (steps, outputs) = recorder.query('plant', 'output', 1000, 2000)
+
+The files are deleted at the end of the C{with} statement, if the
+recorder made its own temporary directory for them, or by C{discard}.
+"""
+import array
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+nan = float('nan')
+
+def flatten(v, result):
+    """
+    Append the numbers in C{v} to the list C{result}
+    """
+    if isinstance(v, (int, long, float)):
+        result.append(float(v))
+    elif isinstance(v, (tuple, list)):
+        for x in v:
+            flatten(x, result)
+    else:
+        result.append(nan)
+    return result
+
+class Column:
+    """
+    Internal use only.  A column of rows of C{width} numbers.  The last
+    rows are kept in a preallocated buffer of C{bufferRows} rows;  when
+    that is full, it is written to the end of the file C{path}.  The
+    file is only open while it is written or mapped, so recording many
+    machines doesn't use up file descriptors.
+    """
+    def __init__(self, path, typecode, width, bufferRows):
+        self.path = path
+        self.typecode = typecode
+        self.width = width
+        self.bufferRows = bufferRows
+        self.buffer = array.array(typecode, [0]) * (width * bufferRows)
+        self.used = 0
+        """Number of rows in the buffer"""
+        self.spilled = 0
+        """Number of rows in the file"""
+        self.rowSize = self.buffer.itemsize * width
+        open(path, 'wb').close()
+
+    def __len__(self):
+        return self.spilled + self.used
+
+    def append(self, values):
+        """
+        Add a row;  C{values} must have C{width} elements
+        """
+        i = self.used * self.width
+        for v in values:
+            self.buffer[i] = v
+            i = i + 1
+        self.used = self.used + 1
+        if self.used == self.bufferRows:
+            self.flush()
+
+    def openMap(self):
+        """
+        Memory-map the part of the column that is in the file.
+        @return: C{mmap}, or C{None} if nothing has been written yet
+        """
+        if self.spilled == 0 or self.rowSize == 0:
+            return None
+        f = open(self.path, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), self.spilled * self.rowSize,
+                             access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def read(self, fileMap, start, stop):
+        """
+        Rows C{start} up to (not including) C{stop}, as a flat array
+        """
+        result = array.array(self.typecode)
+        if start < self.spilled:
+            end = min(stop, self.spilled)
+            result.fromstring(fileMap[start * self.rowSize:
+                                      end * self.rowSize])
+        if stop > self.spilled:
+            first = max(start - self.spilled, 0)
+            result.extend(self.buffer[first * self.width:
+                                      (stop - self.spilled) * self.width])
+        return result
+
+    def value(self, fileMap, i):
+        """
+        First number in row C{i}
+        """
+        if i < self.spilled:
+            return struct.unpack_from(self.typecode, fileMap,
+                                      i * self.rowSize)[0]
+        return self.buffer[(i - self.spilled) * self.width]
+
+    def search(self, fileMap, v):
+        """
+        Index of the first row whose first number is at least C{v},
+        assuming that they are in increasing order
+        """
+        (lo, hi) = (0, len(self))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.value(fileMap, mid) < v:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def flush(self):
+        """
+        Write the rows in the buffer to the end of the file
+        """
+        if self.used == 0:
+            return
+        f = open(self.path, 'ab')
+        try:
+            self.buffer[:self.used * self.width].tofile(f)
+        finally:
+            f.close()
+        self.spilled = self.spilled + self.used
+        self.used = 0
+
+class MachineTrace:
+    """
+    Internal use only.  The columns recorded for one machine.
+    """
+    def __init__(self, prefix, values, bufferRows):
+        self.steps = Column(prefix + '.steps', 'l', 1, bufferRows)
+        self.columns = {}
+        for (mode, v) in values.items():
+            self.columns[mode] = Column(prefix + '.' + mode, 'd', len(v),
+                                        bufferRows)
+
+    def append(self, step, values):
+        self.steps.append((step,))
+        for (mode, v) in values.items():
+            column = self.columns[mode]
+            if len(v) != column.width:
+                v = (v + [nan] * column.width)[:column.width]
+            column.append(v)
+
+class TraceRecorder:
+    """
+    Records the input, state and output of machines on each step of a
+    run.  Pass it to C{start}, C{transduce}, C{run} or C{transduceF}
+    as the C{recorder} argument.  C{transduce} and the methods built on
+    it close the recorder when they finish;  after C{start}, close it
+    yourself, or use it in a C{with} statement.  Call C{discard} when
+    the trace is no longer needed, or use the recorder in a C{with}
+    statement, which discards it at the end unless it was given a
+    C{directory}.
+    """
+    modes = ('input', 'state', 'output')
+
+    def __init__(self, names = None, every = 1, directory = None,
+                 bufferRows = 4096):
+        """
+        @param names: list of names of the machines to record;  if
+              C{None}, record every machine
+        @param every: only record steps whose number is a multiple of
+              C{every}
+        @param directory: where to put the files;  a new temporary
+              directory if not specified, which is removed by
+              C{discard}
+        @param bufferRows: number of rows of each column to keep in
+              memory before writing them to the file
+        """
+        if names is None:
+            self.names = None
+        else:
+            self.names = set(names)
+        self.every = every
+        self.ownDirectory = directory is None
+        """Was C{self.directory} made by the recorder?"""
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix = 'smtrace')
+        self.directory = directory
+        self.bufferRows = bufferRows
+        self.traces = {}
+
+    def record(self, name, step, inp, state, out):
+        """
+        Called by C{SM.doTraceTasks} for each machine on each step
+        """
+        if step % self.every != 0 or \
+               (self.names is not None and name not in self.names):
+            return
+        values = {'input': flatten(inp, []), 'state': flatten(state, []),
+                  'output': flatten(out, [])}
+        trace = self.traces.get(name)
+        if trace is None:
+            prefix = os.path.join(self.directory, 'm%d' % len(self.traces))
+            trace = MachineTrace(prefix, values, self.bufferRows)
+            self.traces[name] = trace
+        trace.append(step, values)
+
+    def machines(self):
+        """
+        @return: list of the names of the machines recorded so far
+        """
+        return self.traces.keys()
+
+    def query(self, name, mode, start = 0, stop = None):
+        """
+        Recorded values of one column, for a range of steps.  Only that
+        range is read from the file.
+        @param name: name of the machine
+        @param mode: one of C{'input'}, C{'state'} or C{'output'}
+        @param start: first step number
+        @param stop: step number to stop before;  if C{None}, go to the
+              end of the run
+        @return: pair of the list of step numbers and the list of
+              values, one for each step;  each value is a number, or a
+              tuple of numbers for columns with more than one
+        """
+        if name not in self.traces:
+            raise Exception, 'No trace recorded for machine ' + str(name)
+        if mode not in self.modes:
+            raise Exception, 'Trace mode must be input, state or output'
+        trace = self.traces[name]
+        column = trace.columns[mode]
+        stepMap = trace.steps.openMap()
+        try:
+            first = trace.steps.search(stepMap, start)
+            if stop is None:
+                last = len(trace.steps)
+            else:
+                last = trace.steps.search(stepMap, stop)
+            steps = trace.steps.read(stepMap, first, last).tolist()
+        finally:
+            if stepMap is not None:
+                stepMap.close()
+        w = column.width
+        if w == 0:
+            return (steps, [()] * len(steps))
+        valueMap = column.openMap()
+        try:
+            values = column.read(valueMap, first, last).tolist()
+        finally:
+            if valueMap is not None:
+                valueMap.close()
+        if w != 1:
+            values = [tuple(values[i:i + w]) for i in range(0, len(values), w)]
+        return (steps, values)
+
+    def flush(self):
+        """
+        Write out the buffers, so that everything recorded so far is in
+        the files
+        """
+        for trace in self.traces.values():
+            trace.steps.flush()
+            for column in trace.columns.values():
+                column.flush()
+
+    def close(self):
+        """
+        Write out the buffers.  No files are kept open between steps,
+        so there is nothing else to release:  the trace can still be
+        queried, and more steps can be recorded.  The files are left in
+        C{self.directory}.
+        """
+        self.flush()
+
+    def discard(self):
+        """
+        Delete the recorded trace:  the files, and the directory if the
+        recorder made it.  Nothing more can be queried afterwards.
+        """
+        if self.ownDirectory:
+            shutil.rmtree(self.directory, True)
+        else:
+            for trace in self.traces.values():
+                for column in [trace.steps] + trace.columns.values():
+                    if os.path.exists(column.path):
+                        os.remove(column.path)
+        self.traces = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.ownDirectory:
+            self.discard()
+        else:
+            self.close()
+        return False